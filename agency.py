@@ -11,7 +11,8 @@ import json
 import logging
 from typing import Dict, Union
 
-import pandas as pd
+from feed import open_feed
+from schema import read_gtfs
 
 log = logging.getLogger(__name__)
 
@@ -26,7 +27,7 @@ TEMP_DIR = Path(THIS_DIR, 'temp_data')
 
 def read_agency(filepath: Path) -> T_AGENCY:
 
-    df = pd.read_csv(filepath).fillna('')
+    df = read_gtfs(filepath, 'agency.txt')
     df_dict = df.T.to_dict()
     d = {v['agency_id']: v for k, v in df_dict.items()}
 
@@ -66,14 +67,14 @@ def check_agency() -> None:
 
     base_data = Path(THIS_DIR, 'base_data2', 'agency.txt')
     archive_data = Path(ARCHIVE_DIR, 'agency.json')
-    new_data = Path(TEMP_DIR, 'agency.txt')
 
     if not os.path.isfile(archive_data):
         agency = read_agency(base_data)
         write_agency_to_archive(agency)
 
     archive_agency = read_archive_agency()
-    new_agency = read_agency(new_data)
+    with open_feed(TEMP_DIR) as feed, feed.open('agency.txt') as f:
+        new_agency = read_agency(f)
     find_dict_differences(archive_agency, new_agency)
 
     archive_agency.update(new_agency)
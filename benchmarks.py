@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Timing comparisons between the current archive/departure code and the
+implementations it replaced. Run from the repository directory against
+the feed in temp_data, eg.
+
+    python benchmarks.py stop_times
+    python benchmarks.py archive_reads
+    python benchmarks.py stop_times_parse
+
+@author: alkj
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Any, Optional, Tuple
+
+import pandas as pd
+
+from feed import open_feed
+from stoptimes import _split_trips, _read_stop_times_frame, read_stop_times_parallel
+from tools import find_date_range, ArchiveStore, ArchiveWriter
+
+THIS_DIR = Path(__file__).parent
+ARCHIVE_DIR = Path(THIS_DIR, 'archive')
+TEMP_DIR = Path(THIS_DIR, 'temp_data')
+
+ARCHIVE_DBS = ('stop_times', 'trips', 'trip_route')
+# the number of stop_times rows in the national feed
+NATIONAL_STOP_TIMES = 7_000_000
+
+
+def _timed(func: Callable[..., Any], *args: Any, repeat: int = 3) -> Tuple[float, Any]:
+    """
+    Run func repeat times and return the best time and the last result
+
+    :param func: the function to time
+    :type func: Callable[..., Any]
+    :param repeat: the number of runs, defaults to 3
+    :type repeat: int, optional
+    :return: the best run time in seconds and the result
+    :rtype: Tuple[float, Any]
+
+    """
+
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _split_trips_xs(df: pd.core.frame.DataFrame):
+    """the original per trip df.xs split of read_stop_times"""
+
+    df = df.set_index(['trip_id', 'stop_sequence'])
+
+    return {
+        level: df.xs(level).to_dict('index') for
+        level in df.index.levels[0]
+        }
+
+def benchmark_stop_times() -> None:
+    """
+    Compare the single pass stop_times split with the per trip xs split
+    on the stop_times of the current feed
+
+    """
+
+    with open_feed() as feed, feed.open('stop_times.txt') as f:
+        df = _read_stop_times_frame(f)
+
+    old_time, old = _timed(_split_trips_xs, df, repeat=1)
+    new_time, new = _timed(_split_trips, df)
+
+    assert old == new, "stop_times payloads differ"
+
+    print(f"stop_times: {len(df)} rows, {len(new)} trips")
+    print(f"  df.xs split:       {old_time:.2f}s")
+    print(f"  single pass split: {new_time:.2f}s ({old_time / new_time:.0f}x)")
+
+
+def _copy_archive(dates: str, name: str, compress: bool) -> int:
+    """
+    Write the lmdb databases of an archive to a benchmark archive
+
+    :param dates: the date range string of the archive to copy
+    :type dates: str
+    :param name: the name of the benchmark archive
+    :type name: str
+    :param compress: compress the values with zstd
+    :type compress: bool
+    :return: the bytes in the pages of the copied databases
+    :rtype: int
+
+    """
+
+    writer = ArchiveWriter(name, compress=compress)
+    for db_name in ARCHIVE_DBS:
+        writer.stage(
+            db_name,
+            ((k, bytes(v)) for k, v in ArchiveStore._iterate_db(dates, db_name))
+            )
+    writer.commit()
+
+    env = ArchiveStore.environment(name)
+    size = 0
+    with env.begin() as txn:
+        for db_name in ARCHIVE_DBS:
+            stat = txn.stat(env.open_db(bytes(db_name, 'utf-8'), txn=txn, create=False))
+            pages = stat['branch_pages'] + stat['leaf_pages'] + stat['overflow_pages']
+            size += stat['psize'] * pages
+
+    return size
+
+def benchmark_archive_reads(dates: Optional[str] = None) -> None:
+    """
+    Compare the size and read throughput of the archive's stop_times and
+    trips stored as plain msgpack values and as zstd compressed values
+
+    :param dates: the date range string of the archive,
+        defaults to None - the current feed
+    :type dates: Optional[str], optional
+
+    """
+
+    if dates is None:
+        dates = find_date_range()
+
+    stop_times = ArchiveStore.lazy_stop_times(dates)
+    trip_ids = list(stop_times)
+    stop_times.close()
+    sample = random.Random(0).sample(trip_ids, min(len(trip_ids), 1000))
+
+    def _lookups(name):
+        stop_times = ArchiveStore.lazy_stop_times(name)
+        out = dict(stop_times.subset(sample))
+        stop_times.close()
+        return out
+
+    results = {}
+    for label, compress in (('msgpack', False), ('zstd', True)):
+        name = f'benchmark_{label}'
+        try:
+            size = _copy_archive(dates, name, compress)
+            scan_time, stop_times = _timed(ArchiveStore.load_stop_times, name)
+            trips_time, trips = _timed(ArchiveStore.load_trips, name)
+            lookup_time, lookups = _timed(_lookups, name)
+            results[label] = (size, scan_time, trips_time, lookup_time)
+            if label == 'msgpack':
+                expected = (stop_times, trips, lookups)
+            else:
+                assert expected == (stop_times, trips, lookups), \
+                    "compressed archive values differ"
+        finally:
+            ArchiveStore.close(name)
+            shutil.rmtree(Path(ARCHIVE_DIR, name), ignore_errors=True)
+
+    print(f"archive {dates}: {len(trip_ids)} trips")
+    plain = results['msgpack']
+    for label, (size, scan_time, trips_time, lookup_time) in results.items():
+        print(f"  {label}:")
+        print(f"    size:               {size / 1024 ** 2:.1f}MB ({plain[0] / size:.1f}x)")
+        print(f"    stop_times scan:    {scan_time:.2f}s ({len(trip_ids) / scan_time:.0f} trips/s)")
+        print(f"    trips scan:         {trips_time:.2f}s")
+        print(f"    {len(sample)} trip lookups: {lookup_time:.3f}s")
+
+
+def _scaled_stop_times(fp: Path, rows: int) -> None:
+    """
+    Write the stop_times of the current feed repeated to at least rows
+    rows. Every repeat has new trip_ids
+
+    :param fp: the path to write the stop_times.txt file to
+    :type fp: Path
+    :param rows: the minimum number of rows
+    :type rows: int
+
+    """
+
+    with open_feed() as feed, feed.open('stop_times.txt') as f:
+        df = pd.read_csv(f, dtype=str)
+
+    trip_id = pd.to_numeric(df.loc[:, 'trip_id'])
+    step = int(trip_id.max()) + 1
+    repeats = -(-rows // len(df))
+    for i in range(repeats):
+        df.loc[:, 'trip_id'] = (trip_id + i * step).astype(str)
+        df.to_csv(fp, mode='a' if i else 'w', header=not i, index=False)
+
+def benchmark_stop_times_parse(
+        rows: int = NATIONAL_STOP_TIMES,
+        processes: Optional[int] = None
+        ) -> None:
+    """
+    Compare the single process read of stop_times.txt with the parallel
+    byte range read, from a file and from the bytes of a zip member, at
+    the size of the national feed
+
+    :param rows: the number of stop_times rows,
+        defaults to NATIONAL_STOP_TIMES
+    :type rows: int, optional
+    :param processes: the number of processes, defaults to None - the
+        number of cpus
+    :type processes: Optional[int], optional
+
+    """
+
+    processes = processes or os.cpu_count() or 1
+    with tempfile.TemporaryDirectory(dir=TEMP_DIR) as tmp:
+        fp = Path(tmp, 'stop_times.txt')
+        _scaled_stop_times(fp, rows)
+        data = fp.read_bytes()
+
+        single_time, expected = _timed(_read_stop_times_frame, fp, repeat=1)
+        path_time, from_path = _timed(
+            read_stop_times_parallel, fp, processes, repeat=1
+            )
+        bytes_time, from_bytes = _timed(
+            read_stop_times_parallel, data, processes, repeat=1
+            )
+
+    for df in (from_path, from_bytes):
+        pd.testing.assert_frame_equal(
+            expected.reset_index(drop=True), df.reset_index(drop=True)
+            )
+
+    print(f"stop_times parse: {len(expected)} rows, {len(data) / 1024 ** 2:.0f}MB")
+    print(f"  read_csv:                 {single_time:.2f}s")
+    print(f"  {processes} processes, path:     {path_time:.2f}s ({single_time / path_time:.1f}x)")
+    print(f"  {processes} processes, zip bytes: {bytes_time:.2f}s ({single_time / bytes_time:.1f}x)")
+
+
+BENCHMARKS = {
+    'stop_times': benchmark_stop_times,
+    'archive_reads': benchmark_archive_reads,
+    'stop_times_parse': benchmark_stop_times_parse,
+    }
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
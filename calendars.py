@@ -12,9 +12,14 @@ from pathlib import Path
 import logging
 from typing import Dict, Tuple, Optional
 
-import pandas as pd
+import numpy as np
 
-from tools import find_date_range
+from feed import open_feed
+from schema import read_gtfs
+from tools import (
+    find_date_range, update_catalog, make_service_dates, ServiceDates, SERVICE_DATES,
+    WEEKDAYS
+    )
 
 
 log = logging.getLogger(__name__)
@@ -33,13 +38,8 @@ def read_calendar(filepath: Path) -> Dict[int, Dict[str, int]]:
 
     """
 
-    df = pd.read_csv(
-        filepath,
-        low_memory=False,
-        usecols=['service_id', 'monday',
-                  'tuesday', 'wednesday',
-                  'thursday', 'friday',
-                  'saturday', 'sunday']).fillna(0)
+    df = read_gtfs(filepath, 'calendar.txt')
+    df = df.loc[:, ['service_id', *WEEKDAYS]]
 
     return df.set_index('service_id').T.to_dict()
 
@@ -53,7 +53,7 @@ def read_calendar_dates(filepath: Path) -> Dict[int, Tuple[Tuple[int, int], ...]
 
     """
     
-    df = pd.read_csv(filepath)
+    df = read_gtfs(filepath, 'calendar_dates.txt')
     df = df.sort_values('service_id')
     calendar_tuples = zip(df['service_id'],
                           df['date'],
@@ -100,6 +100,24 @@ def write_exceptions_to_archive(
         json.dump(exception_dict, f, indent=4)
     log.info(f"calendar exceptions written to archive in: {dates}")
 
+def write_service_dates_to_archive(service_dates: ServiceDates) -> None:
+    """
+    Write the service by date activity matrix to the archive
+
+    :param service_dates: the service dates made from the calendar
+        and calendar exceptions
+    :type service_dates: ServiceDates
+    :return: None
+    :rtype: None
+
+    """
+
+    dates = find_date_range(TEMP_DIR)
+    fp = Path(ARCHIVE_DIR, dates, SERVICE_DATES)
+
+    np.savez(fp, **service_dates._asdict())
+    log.info(f"service dates written to archive in: {dates}")
+
 def check_calendars() -> None:
     """
     
@@ -108,14 +126,23 @@ def check_calendars() -> None:
 
     """
 
-    new_calendar = Path(TEMP_DIR, 'calendar.txt')
-    new_calendar_dates = Path(TEMP_DIR, 'calendar_dates.txt')
+    with open_feed(TEMP_DIR) as feed:
+        with feed.open('calendar.txt') as f:
+            calendar = read_calendar(f)
+        with feed.open('calendar_dates.txt') as f:
+            calendar_dates = read_calendar_dates(f)
 
-    calendar = read_calendar(new_calendar)
     write_calendar_to_archive(calendar)
-
-    calendar_dates = read_calendar_dates(new_calendar_dates)
     write_exceptions_to_archive(calendar_dates)
 
+    service_dates = make_service_dates(
+        calendar, calendar_dates, find_date_range(TEMP_DIR)
+        )
+    write_service_dates_to_archive(service_dates)
+    update_catalog(find_date_range(TEMP_DIR), rows={
+        'calendar': len(calendar),
+        'calendar_dates': sum(len(x) for x in calendar_dates.values())
+        })
+
     return
 
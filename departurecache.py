@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent cache of the departure counts of each service date
+
+The counts of a date are keyed by the content hash of the archive they
+were counted from, the date and the counting parameters, so a changed
+archive never reads stale counts. Stations are assigned to the counted
+stop_ids after the cache, so the bus maps are not part of the key.
+"""
+
+import hashlib
+import logging
+import struct
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+import lmdb
+import msgpack
+import pandas as pd
+
+from tools import ArchiveStore, ARCHIVE_DIR, DB_SIZE, MAX_DBS
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = Path(ARCHIVE_DIR, 'departure_cache')
+CACHE_SIZE = 2 * 1024 * 1024 * 1024
+# bump when the counting changes so old counts are not read
+CACHE_VERSION = 1
+
+ACCESS_STRUCT = struct.Struct('>d')
+
+T_DAY_COUNTS = Dict[Tuple[int, int, int], int]
+
+
+class DayCountCache:
+
+    def __init__(
+            self,
+            dates: str,
+            pickup_type: Optional[int] = 0,
+            drop_last_stop: Optional[bool] = True,
+            max_size: Optional[int] = CACHE_SIZE,
+            path: Optional[Path] = None
+            ) -> None:
+        """
+        The cached departure counts of the service dates of an archive.
+        The least recently used dates are evicted when the cached counts
+        are larger than max_size bytes. Close the cache, or use it as a
+        context manager, to close its lmdb environment
+
+        :param dates: the date range string of the archive
+        :type dates: str
+        :param pickup_type: the pickup_type of the counted stop_times,
+            defaults to 0
+        :type pickup_type: Optional[int], optional
+        :param drop_last_stop: whether the last stop of each trip is not
+            counted, defaults to True
+        :type drop_last_stop: Optional[bool], optional
+        :param max_size: the maximum size of the cached counts in bytes,
+            defaults to CACHE_SIZE
+        :type max_size: Optional[int], optional
+        :param path: the cache directory, defaults to None - CACHE_DIR
+        :type path: Optional[Path], optional
+        :rtype: None
+
+        """
+
+        self.dates = dates
+        self.max_size = max_size
+        self._prefix = msgpack.packb([
+            CACHE_VERSION,
+            ArchiveStore.archive_hash(dates),
+            pickup_type,
+            drop_last_stop
+            ])
+
+        if path is None:
+            path = CACHE_DIR
+        # leave room in the map for the pages freed by evictions
+        Path(path).mkdir(parents=True, exist_ok=True)
+        self._env = lmdb.open(
+            str(path), map_size=max(max_size * 2, DB_SIZE), max_dbs=MAX_DBS
+            )
+        self._counts = self._env.open_db(b'counts')
+        self._access = self._env.open_db(b'access')
+
+    def _key(self, date: pd.Timestamp) -> bytes:
+        """the cache key of a service date"""
+
+        return hashlib.blake2b(
+            self._prefix + date.strftime('%Y%m%d').encode(), digest_size=16
+            ).digest()
+
+    def __enter__(self) -> 'DayCountCache':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def get(self, date: pd.Timestamp) -> Optional[T_DAY_COUNTS]:
+        """
+        The cached departure counts of a service date
+
+        :param date: the service date
+        :type date: pd.Timestamp
+        :return: the counts from count_day_departures, None if the
+            date is not cached
+        :rtype: Optional[T_DAY_COUNTS]
+
+        """
+
+        return self.get_many((date, )).get(date)
+
+    def get_many(
+            self,
+            dates: Iterable[pd.Timestamp]
+            ) -> Dict[pd.Timestamp, T_DAY_COUNTS]:
+        """
+        The cached departure counts of some service dates. The counts are
+        read in one transaction and the access times of the cached dates
+        are updated in one more
+
+        :param dates: the service dates
+        :type dates: Iterable[pd.Timestamp]
+        :return: the counts from count_day_departures of each cached date
+        :rtype: Dict[pd.Timestamp, T_DAY_COUNTS]
+
+        """
+
+        keys = {}
+        out = {}
+        with self._env.begin(db=self._counts) as txn:
+            for date in dates:
+                key = self._key(date)
+                value = txn.get(key)
+                if value is None:
+                    continue
+                keys[date] = key
+                out[date] = {
+                    (x[0], x[1], x[2]): x[3] for x in msgpack.unpackb(value)
+                    }
+        if not keys:
+            return out
+
+        access = ACCESS_STRUCT.pack(time.time())
+        with self._env.begin(write=True, db=self._access) as txn:
+            txn.cursor().putmulti([(k, access) for k in keys.values()])
+
+        return out
+
+    def put(self, date: pd.Timestamp, day_counts: T_DAY_COUNTS) -> None:
+        """
+        Cache the departure counts of a service date
+
+        :param date: the service date
+        :type date: pd.Timestamp
+        :param day_counts: the counts from count_day_departures
+        :type day_counts: T_DAY_COUNTS
+
+        """
+
+        self.put_many({date: day_counts})
+
+    def put_many(self, day_counts: Dict[pd.Timestamp, T_DAY_COUNTS]) -> None:
+        """
+        Cache the departure counts of some service dates in one
+        transaction
+
+        :param day_counts: the counts from count_day_departures of
+            each service date
+        :type day_counts: Dict[pd.Timestamp, T_DAY_COUNTS]
+
+        """
+
+        access = ACCESS_STRUCT.pack(time.time())
+        with self._env.begin(write=True) as txn:
+            for date, counts in day_counts.items():
+                key = self._key(date)
+                value = msgpack.packb([(*k, v) for k, v in counts.items()])
+                txn.put(key, value, db=self._counts)
+                txn.put(key, access, db=self._access)
+            self._evict(txn)
+
+    def _evict(self, txn: lmdb.Transaction) -> None:
+        """delete the least recently used counts until under max_size"""
+
+        if self._size(txn) <= self.max_size:
+            return
+
+        by_access = sorted(
+            (ACCESS_STRUCT.unpack(v)[0], bytes(k)) for
+            k, v in txn.cursor(db=self._access)
+            )
+        n = 0
+        for _, key in by_access:
+            if self._size(txn) <= self.max_size:
+                break
+            txn.delete(key, db=self._counts)
+            txn.delete(key, db=self._access)
+            n += 1
+        log.info(f"{n} dates evicted from the departure cache")
+
+    def _size(self, txn: lmdb.Transaction) -> int:
+        """the size in bytes of the pages used by the cached counts"""
+
+        stat = txn.stat(self._counts)
+        pages = stat['branch_pages'] + stat['leaf_pages'] + stat['overflow_pages']
+
+        return stat['psize'] * pages
+
+    def close(self) -> None:
+        """close the cache environment"""
+
+        self._env.close()
@@ -5,21 +5,37 @@ Created on Fri Dec  4 10:17:05 2020
 @author: alkj
 """
 
+import argparse
 import json
+import logging
+import multiprocessing
+from collections import Counter
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Tuple, NamedTuple, Type, TypeVar, Set, Dict, Generator
+from typing import (
+    Optional, Tuple, NamedTuple, Type, TypeVar, Set, Dict, Generator, Any, List,
+    Iterable, Union
+    )
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 from busstops import load_bus_maps
-from tools import find_date_range, ArchiveStore
+from departurecache import DayCountCache
+from tools import (
+    find_date_range, previous_archive, diff_archives, ArchiveStore, ArchiveDiff,
+    ServiceDates
+    )
 from rejsekortcollections import mappers as MAPPERS
 
 
 METRO_MAP = MAPPERS['metro_map']
 
+log = logging.getLogger(__name__)
+
 THIS_DIR = Path(__file__).parent
 ARCHIVE_DIR = Path(THIS_DIR, 'archive')
 TEMP_DIR = Path(THIS_DIR, 'temp_data')
@@ -28,6 +44,9 @@ TEMP_DIR = Path(THIS_DIR, 'temp_data')
 T = TypeVar('T', bound='DepartureRecord')
 DATE = pd._libs.tslibs.timestamps.Timestamp
 
+# (stop_id, departure_hour, agency) -> number of departures
+T_DAY_COUNTS = Dict[Tuple[int, int, int], int]
+
 class DepartureRecordBase(NamedTuple):
 
 
@@ -106,33 +125,26 @@ def filter_last_stop(stoptimes):
 
     return out
 
-def _find_changed_services(
-        date_int: int,
-        calendar_dates
-        ) -> Tuple[Set[int], Set[int]]:
+def _departure_hour(stop_info: Dict[str, Any]) -> int:
     """
+    The departure hour of a stop_times entry. Hours after midnight
+    are 24 or more
 
-    :param date_int: DESCRIPTION
-    :type date_int: int
-    :param calendar_dates: DESCRIPTION
-    :type calendar_dates: TYPE
-    :return: DESCRIPTION
-    :rtype: Tuple[Set[int], Set[int]]
+    :param stop_info: the stop_times entry of a stop
+    :type stop_info: Dict[str, Any]
+    :return: the hour of departure
+    :rtype: int
 
     """
 
+    seconds = stop_info.get('departure_seconds')
+    if seconds is None:
+        # archives written before departure_seconds
+        time = stop_info['departure_time']
+        return int(time.split(':')[0]) if time else 0
 
-    added = set()
-    removed = set()
-    for service_id, exceptions in calendar_dates.items():
-        date_exceptions = tuple(filter(lambda x: x[0] == date_int, exceptions))
-        for exception in date_exceptions:
-            if exception[1] == 1:
-                added.add(service_id)
-            elif exception[1] == 2:
-                removed.add(service_id)
-    return added, removed
-
+    # missing times are -1 and are counted in hour 0 as in the sparse engine
+    return max(seconds, 0) // 3600
 
 def validate_date(departure_hour: int, date: datetime) -> datetime:
     """
@@ -153,8 +165,8 @@ def validate_date(departure_hour: int, date: datetime) -> datetime:
 
 def create_day_schedule(
         date: DATE,
-        calendar,
-        trips_service, calendar_dates,
+        services: Set[int],
+        service_trips: Dict[int, Tuple[int, ...]],
         stop_times,
         trip_agency
         ) -> Generator[DepartureRecord, None, None]:
@@ -162,12 +174,10 @@ def create_day_schedule(
 
     :param date: DESCRIPTION
     :type date: DATE - pandas Timestamp
-    :param calendar: DESCRIPTION
-    :type calendar: TYPE
-    :param trips_service: DESCRIPTION
-    :type trips_service: TYPE
-    :param calendar_dates: DESCRIPTION
-    :type calendar_dates: TYPE
+    :param services: the service_ids running on the date
+    :type services: Set[int]
+    :param service_trips: dict mapping of service_id to trip_ids
+    :type service_trips: Dict[int, Tuple[int, ...]]
     :param stop_times: DESCRIPTION
     :type stop_times: TYPE
     :param trip_agency: DESCRIPTION
@@ -177,26 +187,18 @@ def create_day_schedule(
 
     """
 
-    weekday = date.strftime("%A").lower()
-    date_int = int(date.strftime('%Y%m%d'))
-
-    services_for_weekday = {
-        k for k, v in calendar.items() if v[weekday] == 1
-        }
-    added, removed = _find_changed_services(date_int, calendar_dates)
-    final_services = services_for_weekday.union(added) - removed
-    trips_for_date = {
-        k for k, v in trips_service.items() if v in final_services
-        }
+    trips_for_date = set()
+    for service_id in services:
+        trips_for_date.update(service_trips.get(service_id, ()))
 
     stop_times_date = {
-        k: v for k, v in stop_times.items() if k in trips_for_date
+        k: stop_times[k] for k in trips_for_date if k in stop_times
         }
 
     for k, v in stop_times_date.items():
         agency = trip_agency[k]
         for stop_info in v.values():
-            departure_hour = int(stop_info['departure_time'].split(':')[0])
+            departure_hour = _departure_hour(stop_info)
             stop_id = stop_info['stop_id']
 
             record = DepartureRecord(
@@ -207,6 +209,132 @@ def create_day_schedule(
                 )
             yield record
 
+class TripPatterns(NamedTuple):
+    """Trips grouped by their timetable pattern, the multiset of
+    (stop_id, departure_hour, agency) of the trip's departures.
+    service_patterns maps service_id -> {pattern index: number of trips}"""
+
+    patterns: Tuple[T_DAY_COUNTS, ...]
+    service_patterns: Dict[int, Dict[int, int]]
+
+def make_trip_patterns(
+        service_trips: Dict[int, Tuple[int, ...]],
+        stop_times,
+        trip_agency
+        ) -> TripPatterns:
+    """
+    Group the trips into timetable patterns. Trips that differ only in
+    trip_id and service_id share a pattern
+
+    :param service_trips: dict mapping of service_id to trip_ids
+    :type service_trips: Dict[int, Tuple[int, ...]]
+    :param stop_times: the stop_times of the departing stops
+    :type stop_times: T_STOPS_TIMES
+    :param trip_agency: dict mapping of trip_id to agency_id
+    :type trip_agency: Dict[int, int]
+    :return: the trip patterns
+    :rtype: TripPatterns
+
+    """
+
+    pattern_index: Dict[Tuple[Tuple[Tuple[int, int, int], int], ...], int] = {}
+    patterns = []
+    service_patterns: Dict[int, Dict[int, int]] = {}
+
+    for service_id, trip_ids in service_trips.items():
+        service = service_patterns.setdefault(service_id, {})
+        for k in trip_ids:
+            if k not in stop_times:
+                continue
+            agency = trip_agency[k]
+            trip_counts = Counter(
+                (x['stop_id'], _departure_hour(x), agency)
+                for x in stop_times[k].values()
+                )
+            key = tuple(sorted(trip_counts.items()))
+            if key not in pattern_index:
+                pattern_index[key] = len(patterns)
+                patterns.append(dict(trip_counts))
+            pattern = pattern_index[key]
+            service[pattern] = service.get(pattern, 0) + 1
+
+    return TripPatterns(tuple(patterns), service_patterns)
+
+def count_day_departures(
+        services: Set[int],
+        trip_patterns: TripPatterns
+        ) -> T_DAY_COUNTS:
+    """
+    Count the departures of a single service date by stop, departure
+    hour and agency. Each active pattern is counted once and multiplied
+    by its number of active trips. The departure hour is as in the
+    stop_times, so hours after midnight are 24 or more
+
+    :param services: the service_ids running on the date
+    :type services: Set[int]
+    :param trip_patterns: the trip patterns from make_trip_patterns
+    :type trip_patterns: TripPatterns
+    :return: the departure counts for the date
+    :rtype: T_DAY_COUNTS
+
+    """
+
+    active = Counter()
+    for service_id in services:
+        active.update(trip_patterns.service_patterns.get(service_id, {}))
+
+    counts = Counter()
+    for pattern, ntrips in active.items():
+        for key, n in trip_patterns.patterns[pattern].items():
+            counts[key] += n * ntrips
+
+    return counts
+
+def _add_day_counts(
+        rail: Counter,
+        bus: Counter,
+        date: DATE,
+        day_counts: T_DAY_COUNTS
+        ) -> None:
+    """
+    Add the counts of one service date to the rail and bus counters
+    keyed by (stop_id, departure_hour, agency, date). Departures after
+    midnight are moved to the next date as in DepartureRecord
+
+    :param rail: the rail departure counter
+    :type rail: Counter
+    :param bus: the bus departure counter
+    :type bus: Counter
+    :param date: the service date
+    :type date: DATE - pandas Timestamp
+    :param day_counts: the counts from count_day_departures
+    :type day_counts: T_DAY_COUNTS
+
+    """
+
+    same_day = date.date()
+    next_day = (date + pd.Timedelta(1, unit='D')).date()
+
+    for (stop_id, departure_hour, agency), n in day_counts.items():
+        if departure_hour > 23:
+            key = (stop_id, departure_hour - 24, agency, next_day)
+        else:
+            key = (stop_id, departure_hour, agency, same_day)
+        if (7400000 < stop_id < 8700000) or stop_id in LETBANE:
+            rail[key] += n
+        else:
+            bus[key] += n
+
+def _counter_frame(counts: Counter) -> pd.core.frame.DataFrame:
+    """departure counter to a frame of departure counts"""
+
+    frame = pd.DataFrame(
+        list(counts), columns=['stop_id', 'departure_hour', 'agency', 'date']
+        )
+    frame.loc[:, 'count'] = list(counts.values())
+
+    return frame
+
 def _load_bus_closest_station_stops() -> Dict[int, int]:
     """
 
@@ -241,15 +369,27 @@ def _period_departures(dates: str) -> Tuple[pd.core.frame.DataFrame, pd.core.fra
 
     """
 
-    trips_service = ArchiveStore.trip_service_map(dates)
+    service_trips = ArchiveStore.load_service_trips(dates)
     trip_agency = ArchiveStore.trip_agency_map(dates)
 
-    stop_times = ArchiveStore.load_stop_times(dates, pickup_type=0)
-    stop_times = filter_last_stop(stop_times)
-
-    calendar = ArchiveStore.load_calendar(dates)
-    calendar_dates = ArchiveStore.load_calendar_dates(dates)
+    service_dates = ArchiveStore.load_service_dates(dates)
     date_range = make_date_range(dates)
+    date_services = {
+        date: service_dates.services_on(int(date.strftime('%Y%m%d'))) for
+        date in date_range
+        }
+
+    # the stop_times of each trip running in the period are decoded once
+    trips = set()
+    for service_id in set().union(*date_services.values()):
+        trips.update(service_trips.get(service_id, ()))
+    lazy_stop_times = ArchiveStore.lazy_stop_times(
+        dates, pickup_type=0, drop_last_stop=True
+        )
+    try:
+        stop_times = dict(lazy_stop_times.subset(trips))
+    finally:
+        lazy_stop_times.close()
 
     rail = []
     bus = []
@@ -259,9 +399,8 @@ def _period_departures(dates: str) -> Tuple[pd.core.frame.DataFrame, pd.core.fra
             ):
 
         day_schedule = create_day_schedule(
-            date, calendar,
-            trips_service,
-            calendar_dates,
+            date, date_services[date],
+            service_trips,
             stop_times,
             trip_agency
             )
@@ -274,6 +413,426 @@ def _period_departures(dates: str) -> Tuple[pd.core.frame.DataFrame, pd.core.fra
     return pd.DataFrame(rail), pd.DataFrame(bus)
 
 
+def _load_departure_inputs(dates: str) -> Dict[str, Any]:
+    """
+    Load the archive data needed to count the departures of any date
+
+    :param dates: the date range string of the archive
+    :type dates: str
+    :return: the trip patterns and the service dates
+    :rtype: Dict[str, Any]
+
+    """
+
+    stop_times = ArchiveStore.lazy_stop_times(
+        dates, pickup_type=0, drop_last_stop=True
+        )
+    try:
+        trip_patterns = make_trip_patterns(
+            ArchiveStore.load_service_trips(dates),
+            stop_times,
+            ArchiveStore.trip_agency_map(dates)
+            )
+    finally:
+        stop_times.close()
+
+    return {
+        'trip_patterns': trip_patterns,
+        'service_dates': ArchiveStore.load_service_dates(dates)
+        }
+
+def _count_dates(
+        date_range: Tuple[DATE, ...],
+        inputs: Dict[str, Any]
+        ) -> Tuple[Counter, Counter, Dict[DATE, T_DAY_COUNTS]]:
+    """
+    Count the rail and bus departures for the given dates
+
+    :param date_range: the dates to count
+    :type date_range: Tuple[DATE, ...]
+    :param inputs: the archive data from _load_departure_inputs. The
+        counts of each date are returned if 'keep_day_counts' is True
+    :type inputs: Dict[str, Any]
+    :return: rail and bus departure counters and the counts of each
+        date to cache
+    :rtype: Tuple[Counter, Counter, Dict[DATE, T_DAY_COUNTS]]
+
+    """
+
+    keep_day_counts = inputs.get('keep_day_counts', False)
+    rail = Counter()
+    bus = Counter()
+    counted = {}
+    for date in date_range:
+        services = inputs['service_dates'].services_on(int(date.strftime('%Y%m%d')))
+        day_counts = count_day_departures(services, inputs['trip_patterns'])
+        if keep_day_counts:
+            counted[date] = day_counts
+        _add_day_counts(rail, bus, date, day_counts)
+
+    return rail, bus, counted
+
+def _pack_trip_patterns(trip_patterns: TripPatterns) -> Dict[str, np.ndarray]:
+    """
+    The trip patterns as flat arrays, which are far smaller to send to
+    the departure workers than the pattern dictionaries. The keys of
+    pattern i are pattern_keys[pattern_offsets[i]:pattern_offsets[i + 1]]
+
+    :param trip_patterns: the trip patterns from make_trip_patterns
+    :type trip_patterns: TripPatterns
+    :return: pattern_offsets, pattern_keys (stop_id, departure_hour,
+        agency), pattern_counts and services (service_id, pattern,
+        number of trips)
+    :rtype: Dict[str, np.ndarray]
+
+    """
+
+    sizes = [len(x) for x in trip_patterns.patterns]
+    keys = [k for x in trip_patterns.patterns for k in x]
+    counts = [n for x in trip_patterns.patterns for n in x.values()]
+    services = [
+        (service_id, pattern, ntrips) for
+        service_id, patterns in trip_patterns.service_patterns.items() for
+        pattern, ntrips in patterns.items()
+        ]
+
+    return {
+        'pattern_offsets': np.r_[0, np.cumsum(sizes, dtype=np.int64)].astype(np.int64),
+        'pattern_keys': np.array(keys, dtype=np.int64).reshape(-1, 3),
+        'pattern_counts': np.array(counts, dtype=np.int64),
+        'services': np.array(services, dtype=np.int64).reshape(-1, 3)
+        }
+
+def _unpack_trip_patterns(arrays: Dict[str, np.ndarray]) -> TripPatterns:
+    """the trip patterns from the arrays of _pack_trip_patterns"""
+
+    offsets = arrays['pattern_offsets'].tolist()
+    keys = [tuple(x) for x in arrays['pattern_keys'].tolist()]
+    counts = arrays['pattern_counts'].tolist()
+    patterns = tuple(
+        dict(zip(keys[start:end], counts[start:end])) for
+        start, end in zip(offsets[:-1], offsets[1:])
+        )
+
+    service_patterns: Dict[int, Dict[int, int]] = {}
+    for service_id, pattern, ntrips in arrays['services'].tolist():
+        service_patterns.setdefault(service_id, {})[pattern] = ntrips
+
+    return TripPatterns(patterns, service_patterns)
+
+# archive data sent once to each departure worker process
+_WORKER_INPUTS: Dict[str, Any] = {}
+
+def _init_departure_worker(
+        patterns: Dict[str, np.ndarray],
+        service_dates: ServiceDates,
+        keep_day_counts: bool
+        ) -> None:
+    """set the trip patterns and service dates of a departure worker"""
+
+    _WORKER_INPUTS['trip_patterns'] = _unpack_trip_patterns(patterns)
+    _WORKER_INPUTS['service_dates'] = service_dates
+    _WORKER_INPUTS['keep_day_counts'] = keep_day_counts
+
+def _count_worker_dates(
+        date_range: Tuple[DATE, ...]
+        ) -> Tuple[Counter, Counter, Dict[DATE, T_DAY_COUNTS]]:
+    """count departures in a departure worker process"""
+
+    return _count_dates(date_range, _WORKER_INPUTS)
+
+def _parallel_count_dates(
+        date_range: Tuple[DATE, ...],
+        inputs: Dict[str, Any],
+        processes: int,
+        keep_day_counts: Optional[bool] = False
+        ) -> Tuple[Counter, Counter, Dict[DATE, T_DAY_COUNTS]]:
+    """
+    Count the departures of the dates in a pool of processes. The trip
+    patterns are built once, in this process, and sent to every worker
+    as flat arrays when it starts, so the workers do not read the
+    archive. The worker counts are summed
+
+    :param date_range: the dates to count
+    :type date_range: Tuple[DATE, ...]
+    :param inputs: the archive data from _load_departure_inputs
+    :type inputs: Dict[str, Any]
+    :param processes: the number of worker processes
+    :type processes: int
+    :param keep_day_counts: whether the workers return the counts of
+        each date to cache, defaults to False
+    :type keep_day_counts: Optional[bool], optional
+    :return: rail and bus departure counters and the counts of each
+        date to cache
+    :rtype: Tuple[Counter, Counter, Dict[DATE, T_DAY_COUNTS]]
+
+    """
+
+    nchunks = min(len(date_range), processes * 4)
+    chunks: List[Tuple[DATE, ...]] = [
+        tuple(date_range[i::nchunks]) for i in range(nchunks)
+        ]
+
+    rail = Counter()
+    bus = Counter()
+    counted = {}
+    with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_departure_worker,
+            initargs=(
+                _pack_trip_patterns(inputs['trip_patterns']),
+                inputs['service_dates'],
+                keep_day_counts
+                )
+            ) as pool:
+        futures = [pool.submit(_count_worker_dates, x) for x in chunks]
+        for future in tqdm(
+                as_completed(futures),
+                f'count departures for {date_range[0].date()} to '
+                f'{date_range[-1].date()}', total=len(futures)
+                ):
+            chunk_rail, chunk_bus, chunk_counted = future.result()
+            rail.update(chunk_rail)
+            bus.update(chunk_bus)
+            counted.update(chunk_counted)
+
+    return rail, bus, counted
+
+def _count_archive_dates(
+        dates: str,
+        date_range: Tuple[DATE, ...],
+        processes: Optional[int] = None,
+        cache: Optional[bool] = False
+        ) -> Tuple[Counter, Counter]:
+    """
+    Count the rail and bus departures of some dates of an archive. With
+    the cache, the counts of dates already counted from the same archive
+    content are read from the cache and only the other dates are counted
+
+    :param dates: the date range string of the archive
+    :type dates: str
+    :param date_range: the dates to count
+    :type date_range: Tuple[DATE, ...]
+    :param processes: split the dates over this many processes,
+        defaults to None - count in this process
+    :type processes: Optional[int], optional
+    :param cache: whether to use the DayCountCache, defaults to False
+    :type cache: Optional[bool], optional
+    :return: rail and bus departure counters
+    :rtype: Tuple[Counter, Counter]
+
+    """
+
+    rail = Counter()
+    bus = Counter()
+
+    # the cache is only opened in this process, the counts of the dates
+    # that are not cached are written to it together
+    with (DayCountCache(dates) if cache else nullcontext()) as day_cache:
+        if day_cache is not None:
+            cached = day_cache.get_many(date_range)
+            for date, day_counts in cached.items():
+                _add_day_counts(rail, bus, date, day_counts)
+            log.info(
+                f"{len(cached)} of {len(date_range)} dates "
+                f"read from the departure cache for {dates}"
+                )
+            date_range = tuple(x for x in date_range if x not in cached)
+
+        counted = {}
+        if not date_range:
+            pass
+        elif processes is not None and processes > 1:
+            range_rail, range_bus, counted = _parallel_count_dates(
+                date_range, _load_departure_inputs(dates), processes,
+                keep_day_counts=cache
+                )
+            rail.update(range_rail)
+            bus.update(range_bus)
+        else:
+            inputs = _load_departure_inputs(dates)
+            inputs['keep_day_counts'] = cache
+            for date in tqdm(
+                    date_range,
+                    f'count departures for {date_range[0].date()} to {date_range[-1].date()}'
+                    ):
+                day_rail, day_bus, day_counted = _count_dates((date, ), inputs)
+                rail.update(day_rail)
+                bus.update(day_bus)
+                counted.update(day_counted)
+
+        if day_cache is not None and counted:
+            day_cache.put_many(counted)
+
+    return rail, bus
+
+def _stream_period_departures(
+        dates: str,
+        processes: Optional[int] = None,
+        cache: Optional[bool] = False
+        ) -> Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]:
+    """
+    Count the departures for the period date by date, adding each
+    day's counts into rail and bus counters. No DepartureRecords are
+    kept, so memory is bounded by the number of output cells
+
+    :param dates: the date range string of the archive
+    :type dates: str
+    :param processes: split the dates over this many processes,
+        defaults to None - count in this process
+    :type processes: Optional[int], optional
+    :param cache: whether to use the DayCountCache, defaults to False
+    :type cache: Optional[bool], optional
+    :return: rail and bus departure counts
+    :rtype: Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]
+
+    """
+
+    rail, bus = _count_archive_dates(
+        dates, make_date_range(dates), processes=processes, cache=cache
+        )
+
+    return _counter_frame(rail), _counter_frame(bus)
+
+def _is_rail(stop_ids: np.ndarray) -> np.ndarray:
+    """rail station/letbane mask for an array of stop_ids"""
+
+    return ((stop_ids > 7400000) & (stop_ids < 8700000)) | \
+        np.isin(stop_ids, list(LETBANE))
+
+def _departure_stop_times(
+        columns: Dict[str, np.ndarray],
+        pickup_type: Optional[int] = 0
+        ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Filter the columnar stop_times to the departing stops, as
+    load_stop_times(pickup_type=0) followed by filter_last_stop does
+    for the stop_times dictionary
+
+    :param columns: the columns from ArchiveStore.load_stop_time_columns
+    :type columns: Dict[str, np.ndarray]
+    :param pickup_type: the pickup_type to keep, defaults to 0
+    :type pickup_type: Optional[int], optional
+    :return: the trip_id, stop_id and departure hour of each departure
+    :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+    """
+
+    keep = np.asarray(columns['pickup_type']) == pickup_type
+    trip_id = np.asarray(columns['trip_id'])[keep]
+    sequence = np.asarray(columns['stop_sequence'])[keep]
+    stop_id = np.asarray(columns['stop_id'])[keep]
+    # missing times are -1 and are counted in hour 0 as in _departure_hour
+    hour = np.maximum(np.asarray(columns['departure_seconds'])[keep], 0) // 3600
+
+    # rows are sorted on trip_id/stop_sequence so the last row of
+    # each trip has the highest remaining stop_sequence
+    last = np.r_[trip_id[1:] != trip_id[:-1], True] if len(trip_id) else keep[:0]
+    departs = ~(last & (sequence != 0))
+
+    return trip_id[departs], stop_id[departs], hour[departs]
+
+def _count_frame(
+        stop_id: np.ndarray,
+        departure_hour: np.ndarray,
+        agency: np.ndarray,
+        date_ints: np.ndarray,
+        count: np.ndarray
+        ) -> pd.core.frame.DataFrame:
+    """
+    Make a frame of departure counts, moving departures after midnight
+    to the next date as DepartureRecord does
+
+    :return: frame with columns stop_id, departure_hour, agency, date, count
+    :rtype: pd.core.frame.DataFrame
+
+    """
+
+    next_day = departure_hour > 23
+    dates = pd.to_datetime(date_ints.astype(str), format='%Y%m%d')
+    dates = dates + pd.to_timedelta(next_day.astype(int), unit='D')
+
+    return pd.DataFrame({
+        'stop_id': stop_id,
+        'departure_hour': departure_hour - 24 * next_day,
+        'agency': agency,
+        'date': dates.date,
+        'count': count
+        })
+
+def _sparse_period_departures(
+        dates: str
+        ) -> Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]:
+    """
+    Count the departures for the period as the product of a
+    trip x (stop, hour, agency) incidence matrix and the trip x date
+    activity matrix. The trip x date activity is the product of the
+    trip x service incidence and the service x date activity
+
+    :param dates: the date range string of the archive
+    :type dates: str
+    :return: rail and bus departure counts
+    :rtype: Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]
+
+    """
+
+    from scipy import sparse
+
+    trips_service = ArchiveStore.trip_service_map(dates)
+    trip_agency = ArchiveStore.trip_agency_map(dates)
+    service_dates = ArchiveStore.load_service_dates(dates)
+
+    columns = ArchiveStore.load_stop_time_columns(dates)
+    trip_id, stop_id, hour = _departure_stop_times(columns, pickup_type=0)
+
+    trips = np.array(
+        [k for k in np.unique(trip_id).tolist()
+         if k in trips_service and k in trip_agency],
+        dtype=np.int64
+        )
+    known = np.isin(trip_id, trips)
+    trip_id, stop_id, hour = trip_id[known], stop_id[known], hour[known]
+
+    trip_rows = np.searchsorted(trips, trip_id)
+    agency = np.array([trip_agency[k] for k in trips.tolist()], dtype=np.int64)
+
+    keys, key_columns = np.unique(
+        np.stack([stop_id, hour, agency[trip_rows]], axis=1),
+        axis=0, return_inverse=True
+        )
+    key_columns = key_columns.ravel()
+    trip_keys = sparse.csr_matrix(
+        (np.ones(len(trip_rows), dtype=np.int64), (trip_rows, key_columns)),
+        shape=(len(trips), len(keys))
+        )
+
+    trip_services = np.array(
+        [trips_service[k] for k in trips.tolist()], dtype=np.int64
+        )
+    service_rows = np.searchsorted(service_dates.service_ids, trip_services)
+    service_rows = np.minimum(service_rows, len(service_dates.service_ids) - 1)
+    has_service = service_dates.service_ids[service_rows] == trip_services
+    trip_service = sparse.csr_matrix(
+        (np.ones(has_service.sum(), dtype=np.int64),
+         (np.flatnonzero(has_service), service_rows[has_service])),
+        shape=(len(trips), len(service_dates.service_ids))
+        )
+
+    trip_dates = trip_service @ sparse.csr_matrix(service_dates.active.astype(np.int64))
+    counts = (trip_keys.T @ trip_dates).tocoo()
+
+    keys = keys[counts.row]
+    frame = _count_frame(
+        keys[:, 0], keys[:, 1], keys[:, 2],
+        service_dates.dates[counts.col], counts.data
+        )
+    rail = _is_rail(frame.loc[:, 'stop_id'].values)
+
+    return (frame[rail].reset_index(drop=True),
+            frame[~rail].reset_index(drop=True))
+
+
 def _process_frame_for_output(
         frame: pd.core.frame.DataFrame,
         agency_map: Dict[int, str]
@@ -290,10 +849,18 @@ def _process_frame_for_output(
 
     """
 
+    if frame.empty:
+        return pd.DataFrame(columns=['date', 'station', 'hour'])
+
     frame.loc[:, 'agency'] = \
         frame.loc[:, 'agency'].replace(agency_map)
 
-    frame = frame.groupby(list(frame.columns)).size()
+    if 'count' in frame.columns:
+        frame = frame.groupby(
+            ['stop_id', 'departure_hour', 'agency', 'date']
+            )['count'].sum()
+    else:
+        frame = frame.groupby(list(frame.columns)).size()
     frame.name = 'count'
     frame = frame.reset_index()
     frame = frame.pivot_table(
@@ -346,17 +913,166 @@ def _set_totals(df, col_name='total'):
 
     return df
 
+ENGINES = ('records', 'sparse', 'stream')
+
 def calculate_departures(
-        dates: str
+        dates: str,
+        engine: Optional[str] = 'records',
+        processes: Optional[int] = None,
+        cache: Optional[bool] = False
         ) -> Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]:
     """
-    :return: DESCRIPTION
-    :rtype: TYPE
+    Calculate the hourly departures at rail stations and at the bus
+    stops mapped to rail stations
+
+    :param dates: the date range string of the archive
+    :type dates: str
+    :param engine: 'records' to build a DepartureRecord for every departure,
+        'sparse' to count departures with sparse matrix products or
+        'stream' to count departures date by date, defaults to 'records'
+    :type engine: Optional[str], optional
+    :param processes: the number of processes to split the dates over with
+        the stream engine, defaults to None
+    :type processes: Optional[int], optional
+    :param cache: read and write the counts of each date in the
+        DayCountCache with the stream engine, defaults to False
+    :type cache: Optional[bool], optional
+    :raises ValueError: if processes or cache are given for an engine
+        other than stream
+    :return: rail and bus departures in the dwh format
+    :rtype: Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]
 
     """
 
+    if cache and engine != 'stream':
+        raise ValueError("the departure cache is only used by the stream engine")
+    if processes is not None and processes > 1 and engine != 'stream':
+        raise ValueError("processes are only used by the stream engine")
+
+    if engine == 'records':
+        rail, bus = _period_departures(dates)
+    elif engine == 'sparse':
+        rail, bus = _sparse_period_departures(dates)
+    elif engine == 'stream':
+        rail, bus = _stream_period_departures(
+            dates, processes=processes, cache=cache
+            )
+    else:
+        raise ValueError(f"engine must be one of {ENGINES}, not {engine}")
+
+    return _departures_for_output(rail, bus)
+
+def calculate_departures_between(
+        start_date: Union[int, str],
+        end_date: Union[int, str],
+        processes: Optional[int] = None,
+        cache: Optional[bool] = False
+        ) -> Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]:
+    """
+    Calculate the hourly departures for any period, spanning as many
+    archives as needed. Each date is counted from the newest archive
+    that covers it (see ArchiveStore.resolve_archives) and the counts
+    are stitched into one result
+
+    :param start_date: the first date YYYYMMDD
+    :type start_date: Union[int, str]
+    :param end_date: the last date YYYYMMDD
+    :type end_date: Union[int, str]
+    :param processes: read this many archives in parallel,
+        defaults to None - read them in this process
+    :type processes: Optional[int], optional
+    :param cache: read and write the counts of each date in the
+        DayCountCache, defaults to False
+    :type cache: Optional[bool], optional
+    :return: rail and bus departures in the dwh format
+    :rtype: Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]
+
+    """
+
+    # departures after midnight of the day before the start date
+    # fall on the start date
+    start = pd.Timestamp(str(start_date))
+    end = pd.Timestamp(str(end_date))
+    archives = ArchiveStore.resolve_archives(
+        (start - pd.Timedelta(1, unit='D')).strftime('%Y%m%d'),
+        end.strftime('%Y%m%d')
+        )
+    if not archives:
+        raise ValueError(f"no archive covers {start_date} to {end_date}")
+
+    rail = Counter()
+    bus = Counter()
+    if processes is not None and processes > 1 and len(archives) > 1:
+        with ProcessPoolExecutor(
+                max_workers=min(processes, len(archives)),
+                mp_context=multiprocessing.get_context('spawn')
+                ) as pool:
+            futures = [
+                pool.submit(_count_archive_dates, k, tuple(v), cache=cache) for
+                k, v in archives.items()
+                ]
+            for future in tqdm(
+                    as_completed(futures),
+                    f'count departures for {start.date()} to {end.date()}',
+                    total=len(futures)
+                    ):
+                archive_rail, archive_bus = future.result()
+                rail.update(archive_rail)
+                bus.update(archive_bus)
+    else:
+        for k, v in tqdm(
+                archives.items(),
+                f'count departures for {start.date()} to {end.date()}'
+                ):
+            archive_rail, archive_bus = _count_archive_dates(
+                k, tuple(v), cache=cache
+                )
+            rail.update(archive_rail)
+            bus.update(archive_bus)
 
-    rail, bus = _period_departures(dates)
+    in_range = lambda x: start.date() <= x[3] <= end.date()
+    rail = Counter({k: v for k, v in rail.items() if in_range(k)})
+    bus = Counter({k: v for k, v in bus.items() if in_range(k)})
+
+    return _departures_for_output(_counter_frame(rail), _counter_frame(bus))
+
+def check_engine_parity(dates: str, engine: str) -> None:
+    """
+    Check that an engine gives the same departures as the records
+    engine for an archive. Raises an AssertionError if they differ
+
+    :param dates: the date range string of the archive
+    :type dates: str
+    :param engine: the engine to compare to the records engine
+    :type engine: str
+
+    """
+
+    expected = calculate_departures(dates, engine='records')
+    result = calculate_departures(dates, engine=engine)
+
+    for left, right in zip(expected, result):
+        keys = ['date', 'station', 'hour']
+        left = left.sort_values(keys).reset_index(drop=True)
+        right = right.sort_values(keys).reset_index(drop=True)
+        pd.testing.assert_frame_equal(left, right.loc[:, left.columns])
+
+def _departures_for_output(
+        rail: pd.core.frame.DataFrame,
+        bus: pd.core.frame.DataFrame
+        ) -> Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]:
+    """
+    Map the rail and bus departures to parent stations and aggregate
+    them to the dwh format
+
+    :param rail: rail departures or departure counts
+    :type rail: pd.core.frame.DataFrame
+    :param bus: bus departures or departure counts
+    :type bus: pd.core.frame.DataFrame
+    :return: rail and bus departures in the dwh format
+    :rtype: Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]
+
+    """
 
     # ensure only the parent station has results
     rail.loc[:, 'stop_id'] = rail.loc[:, 'stop_id'].replace(METRO_MAP)
@@ -382,3 +1098,509 @@ def calculate_departures(
         rail_frame.loc[:, 'date'].apply(lambda x: int(x.strftime('%Y%m%d')))
 
     return rail_frame, bus_frame
+
+
+GRANULARITIES = ('hour', 'day')
+
+def _stop_station(stop_id: int, bus_maps: Dict[int, int]) -> Optional[int]:
+    """
+    The station that the departures of a stop are counted at. Rail
+    stops are mapped to their parent station and bus stops to their
+    closest station as in calculate_departures
+
+    :param stop_id: the stop_id
+    :type stop_id: int
+    :param bus_maps: dict mapping of bus stop_id to station
+    :type bus_maps: Dict[int, int]
+    :return: the station, None for bus stops without a station
+    :rtype: Optional[int]
+
+    """
+
+    parent = METRO_MAP.get(stop_id, stop_id)
+    if (7400000 < stop_id < 8700000) or stop_id in LETBANE:
+        return parent
+
+    return bus_maps.get(parent)
+
+def _station_stops(
+        stations: Set[int],
+        stop_ids: Iterable[int],
+        bus_maps: Dict[int, int]
+        ) -> Set[int]:
+    """
+    The stop_ids whose departures are counted at the stations
+
+    :param stations: the station stop_ids
+    :type stations: Set[int]
+    :param stop_ids: the stop_ids to choose from
+    :type stop_ids: Iterable[int]
+    :param bus_maps: dict mapping of bus stop_id to station
+    :type bus_maps: Dict[int, int]
+    :return: the stop_ids to count
+    :rtype: Set[int]
+
+    """
+
+    return {x for x in stop_ids if _stop_station(x, bus_maps) in stations}
+
+def _station_counts(
+        stations: Set[int],
+        dates: str,
+        date_range: Tuple[DATE, ...]
+        ) -> Tuple[Counter, Counter]:
+    """
+    Count the rail and bus departures at the stations on some service
+    dates of an archive. Only the trips that serve the stations, found
+    with the stop index, and run on the services of the dates, found
+    with the service index, are read from the archive
+
+    :param stations: the station stop_ids
+    :type stations: Set[int]
+    :param dates: the date range string of the archive
+    :type dates: str
+    :param date_range: the service dates to count
+    :type date_range: Tuple[DATE, ...]
+    :return: rail and bus departure counters as from _add_day_counts
+    :rtype: Tuple[Counter, Counter]
+
+    """
+
+    bus_maps = load_bus_maps()
+    # only the stations and the metro and bus stops mapped to a station
+    # can be counted at one, so the stop index is not scanned
+    stops = _station_stops(
+        stations, set(stations) | set(METRO_MAP) | set(bus_maps), bus_maps
+        )
+
+    service_dates = ArchiveStore.load_service_dates(dates)
+    days = np.isin(
+        service_dates.dates, [int(x.strftime('%Y%m%d')) for x in date_range]
+        )
+    services = service_dates.service_ids[service_dates.active[:, days].any(axis=1)]
+
+    trips = set()
+    trip_service = {}
+    with ArchiveStore.read_transaction(dates) as txn:
+        for stop_id in stops:
+            trips.update(ArchiveStore.trips_for_stop(stop_id, dates, txn=txn))
+        for service_id in services.tolist():
+            for k in ArchiveStore.trips_for_service(service_id, dates, txn=txn):
+                if k in trips:
+                    trip_service[k] = service_id
+        trip_agency = ArchiveStore.trip_agency_map(
+            dates, txn=txn, trip_ids=trip_service
+            )
+
+    stop_times = ArchiveStore.lazy_stop_times(
+        dates, pickup_type=0, drop_last_stop=True
+        )
+    trip_counts = {}
+    try:
+        for k, v in stop_times.subset(trip_service):
+            trip_counts[k] = Counter(
+                (x['stop_id'], _departure_hour(x), trip_agency[k])
+                for x in v.values() if x['stop_id'] in stops
+                )
+    finally:
+        stop_times.close()
+
+    rail = Counter()
+    bus = Counter()
+    for date in date_range:
+        services = service_dates.services_on(int(date.strftime('%Y%m%d')))
+        day_counts = Counter()
+        for k, counts in trip_counts.items():
+            if trip_service[k] in services:
+                day_counts.update(counts)
+        _add_day_counts(rail, bus, date, day_counts)
+
+    return rail, bus
+
+def departures_for(
+        stations: Iterable[int],
+        start_date: Union[int, str],
+        end_date: Union[int, str],
+        granularity: Optional[str] = 'hour',
+        dates: Optional[str] = None
+        ) -> Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]:
+    """
+    Calculate the departures at the given stations without counting the
+    rest of the network. Only the trips serving the stations, found
+    with the stop index, are read from the archive
+
+    :param stations: the station stop_ids
+    :type stations: Iterable[int]
+    :param start_date: the first date YYYYMMDD
+    :type start_date: Union[int, str]
+    :param end_date: the last date YYYYMMDD
+    :type end_date: Union[int, str]
+    :param granularity: 'hour' for departures per hour as in the dwh or
+        'day' for departures per day, defaults to 'hour'
+    :type granularity: Optional[str], optional
+    :param dates: the date range string of the archive, defaults to None
+    :type dates: Optional[str], optional
+    :return: rail and bus departures at the stations
+    :rtype: Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]
+
+    """
+
+    if granularity not in GRANULARITIES:
+        raise ValueError(
+            f"granularity must be one of {GRANULARITIES}, not {granularity}"
+            )
+    if dates is None:
+        dates = find_date_range()
+
+    # departures after midnight of the day before the start date
+    # fall on the start date
+    start = pd.Timestamp(str(start_date))
+    end = pd.Timestamp(str(end_date))
+    rail, bus = _station_counts(
+        set(int(x) for x in stations), dates,
+        tuple(pd.date_range(start - pd.Timedelta(1, unit='D'), end, freq='D'))
+        )
+
+    in_range = lambda x: start.date() <= x[3] <= end.date()
+    rail = Counter({k: v for k, v in rail.items() if in_range(k)})
+    bus = Counter({k: v for k, v in bus.items() if in_range(k)})
+
+    rail_frame, bus_frame = _departures_for_output(
+        _counter_frame(rail), _counter_frame(bus)
+        )
+
+    if granularity == 'day':
+        rail_frame = rail_frame.drop('hour', axis=1).groupby(
+            ['date', 'station'], as_index=False
+            ).sum()
+        bus_frame = bus_frame.drop('hour', axis=1).groupby(
+            ['date', 'station'], as_index=False
+            ).sum()
+
+    return rail_frame, bus_frame
+
+
+def _affected_cells(
+        old_dates: str,
+        new_dates: str,
+        diff: ArchiveDiff
+        ) -> Set[Tuple[int, int]]:
+    """
+    The (date, station) cells whose departures may differ between two
+    archives. A cell is affected when a changed trip runs on the date in
+    either archive, or a service starts or stops running on the date,
+    and the trip stops at the station. Departures after midnight also
+    affect the next date
+
+    :param old_dates: the date range string of the previous archive
+    :type old_dates: str
+    :param new_dates: the date range string of the new archive
+    :type new_dates: str
+    :param diff: the difference of the archives from diff_archives
+    :type diff: ArchiveDiff
+    :return: the affected (date YYYYMMDD, station) cells
+    :rtype: Set[Tuple[int, int]]
+
+    """
+
+    bus_maps = load_bus_maps()
+    changed_services = set().union(*diff.services.values())
+
+    cells = set()
+    for dates in (old_dates, new_dates):
+        service_trips = ArchiveStore.load_service_trips(dates)
+        service_dates = ArchiveStore.load_service_dates(dates)
+
+        changed_trips = {}
+        for service_id, trip_ids in service_trips.items():
+            trip_ids = [k for k in trip_ids if k in diff.trips]
+            if trip_ids:
+                changed_trips[service_id] = trip_ids
+
+        trips = set(diff.trips)
+        for service_id in changed_services:
+            trips.update(service_trips.get(service_id, ()))
+
+        stop_times = ArchiveStore.lazy_stop_times(
+            dates, pickup_type=0, drop_last_stop=True
+            )
+        trip_stations = {}
+        try:
+            for k, v in stop_times.subset(trips):
+                stations = {_stop_station(x['stop_id'], bus_maps) for x in v.values()}
+                stations.discard(None)
+                trip_stations[k] = stations
+        finally:
+            stop_times.close()
+
+        for date in diff.dates:
+            day_trips = set()
+            for service_id in service_dates.services_on(date) & changed_trips.keys():
+                day_trips.update(changed_trips[service_id])
+            for service_id in diff.services.get(date, ()):
+                day_trips.update(service_trips.get(service_id, ()))
+            if not day_trips:
+                continue
+            stations = set().union(*(trip_stations.get(k, ()) for k in day_trips))
+            next_day = pd.Timestamp(str(date)) + pd.Timedelta(1, unit='D')
+            for day in (date, int(next_day.strftime('%Y%m%d'))):
+                cells.update((day, x) for x in stations)
+
+    return cells
+
+def _station_departures_between(
+        stations: Set[int],
+        start_date: Union[int, str],
+        end_date: Union[int, str]
+        ) -> Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]:
+    """
+    The departures at the stations for any period, each date counted
+    from the newest archive that covers it as in
+    calculate_departures_between
+
+    :param stations: the station stop_ids
+    :type stations: Set[int]
+    :param start_date: the first date YYYYMMDD
+    :type start_date: Union[int, str]
+    :param end_date: the last date YYYYMMDD
+    :type end_date: Union[int, str]
+    :return: rail and bus departures at the stations in the dwh format
+    :rtype: Tuple[pd.core.frame.DataFrame, pd.core.frame.DataFrame]
+
+    """
+
+    start = pd.Timestamp(str(start_date))
+    end = pd.Timestamp(str(end_date))
+    archives = ArchiveStore.resolve_archives(
+        (start - pd.Timedelta(1, unit='D')).strftime('%Y%m%d'),
+        end.strftime('%Y%m%d')
+        )
+
+    rail = Counter()
+    bus = Counter()
+    for k, v in archives.items():
+        archive_rail, archive_bus = _station_counts(stations, k, tuple(v))
+        rail.update(archive_rail)
+        bus.update(archive_bus)
+
+    in_range = lambda x: start.date() <= x[3] <= end.date()
+    rail = Counter({k: v for k, v in rail.items() if in_range(k)})
+    bus = Counter({k: v for k, v in bus.items() if in_range(k)})
+
+    return _departures_for_output(_counter_frame(rail), _counter_frame(bus))
+
+
+class DeparturesDelta(NamedTuple):
+    """The departures to write to the dwh for a new archive. The rows
+    of the dwh on the dates and in the (date, station) cells are
+    replaced by the rail and bus rows"""
+
+    rail: pd.core.frame.DataFrame
+    bus: pd.core.frame.DataFrame
+    # (date YYYYMMDD, station) cells
+    cells: Set[Tuple[int, int]]
+    # dates YYYYMMDD
+    dates: Tuple[int, ...]
+
+
+def _in_cells(
+        frame: pd.core.frame.DataFrame,
+        cells: Set[Tuple[int, int]],
+        dates: Iterable[int]
+        ) -> np.ndarray:
+    """mask of the rows of a dwh frame on the dates or in the cells"""
+
+    in_dates = frame['date'].isin(list(dates)).values
+    in_cells = np.array(
+        [x in cells for x in zip(frame['date'], frame['station'])], dtype=bool
+        )
+
+    return in_dates | in_cells
+
+def apply_departures_delta(
+        frame: pd.core.frame.DataFrame,
+        rows: pd.core.frame.DataFrame,
+        cells: Set[Tuple[int, int]],
+        dates: Iterable[int]
+        ) -> pd.core.frame.DataFrame:
+    """
+    Replace the rows of a frame of departures on the dates and in the
+    cells of a delta, as write_to_dwh does in the dwh table. Applying
+    the same delta again gives the same frame
+
+    :param frame: departures in the dwh format
+    :type frame: pd.core.frame.DataFrame
+    :param rows: the rail or bus rows of the DeparturesDelta
+    :type rows: pd.core.frame.DataFrame
+    :param cells: the cells of the DeparturesDelta
+    :type cells: Set[Tuple[int, int]]
+    :param dates: the dates of the DeparturesDelta
+    :type dates: Iterable[int]
+    :return: the departures with the delta applied
+    :rtype: pd.core.frame.DataFrame
+
+    """
+
+    kept = frame.loc[~_in_cells(frame, cells, dates)]
+    out = pd.concat([kept, rows], ignore_index=True)
+    counts = [x for x in out.columns if x not in ('date', 'station', 'hour')]
+    out.loc[:, counts] = out.loc[:, counts].fillna(0).astype(int)
+
+    return out
+
+def remapped_stations(
+        old_maps: Dict[int, int],
+        new_maps: Dict[int, int]
+        ) -> Set[int]:
+    """
+    The stations that gained or lost bus stops between two bus to
+    station maps, so their bus departures must be counted again
+
+    :param old_maps: the bus stop_id to station map before bus_mapping
+    :type old_maps: Dict[int, int]
+    :param new_maps: the bus stop_id to station map after bus_mapping
+    :type new_maps: Dict[int, int]
+    :return: the stations of the changed bus stops
+    :rtype: Set[int]
+
+    """
+
+    stations = set()
+    for stop_id in old_maps.keys() | new_maps.keys():
+        old, new = old_maps.get(stop_id), new_maps.get(stop_id)
+        if old != new:
+            stations.update(x for x in (old, new) if x is not None)
+
+    return stations
+
+def departures_delta(
+        new_dates: Optional[str] = None,
+        old_dates: Optional[str] = None,
+        stations: Optional[Set[int]] = None
+        ) -> DeparturesDelta:
+    """
+    The departures to replace in the dwh when a new archive is added.
+    The dwh holds the departures of each date counted from the newest
+    archive that covers it, as calculate_departures_between counts them
+
+    The archives are diffed and on the dates they share only the (date,
+    station) cells affected by the changed trips and services are
+    counted again. The other dates of the new archive, and the date
+    after it for the departures after midnight, are counted in full.
+    Without a previous archive every date is counted in full. The
+    stations whose bus stops were mapped differently since the last
+    delta, see remapped_stations, are counted again on every shared date.
+    The rows of older archives' dates keep the map they were counted with
+
+    The rows of the cells and dates are replaced, not added to, so the
+    departures that are no longer in the new archive are removed and a
+    delta can be written again
+
+    :param new_dates: the date range string of the new archive,
+        defaults to None - the current feed
+    :type new_dates: Optional[str], optional
+    :param old_dates: the date range string of the previous archive,
+        defaults to None - the newest archive older than the new one
+    :type old_dates: Optional[str], optional
+    :param stations: count these stations again on the shared dates,
+        defaults to None
+    :type stations: Optional[Set[int]], optional
+    :return: the rail and bus rows and the cells and dates they replace
+    :rtype: DeparturesDelta
+
+    """
+
+    if new_dates is None:
+        new_dates = find_date_range()
+    if old_dates is None:
+        old_dates = previous_archive(new_dates)
+
+    new_range = pd.date_range(
+        new_dates[:8], pd.Timestamp(new_dates[9:]) + pd.Timedelta(1, unit='D'),
+        freq='D'
+        )
+    new_range = [int(x) for x in new_range.strftime('%Y%m%d')]
+
+    cells = set()
+    whole_dates = new_range
+    if old_dates is None:
+        log.info(f"no archive before {new_dates}, all departures are new")
+    else:
+        diff = diff_archives(old_dates, new_dates)
+        if not diff.dates:
+            log.info(f"{old_dates} and {new_dates} do not overlap")
+        else:
+            # the departures of the dates the old archive covers only
+            # change in the cells affected by the diff
+            old_range = pd.date_range(old_dates[:8], old_dates[9:], freq='D')
+            old_range = {int(x) for x in old_range.strftime('%Y%m%d')}
+            whole_dates = [x for x in new_range if x not in old_range]
+            cells = {
+                x for x in _affected_cells(old_dates, new_dates, diff) if
+                x[0] in new_range and x[0] not in whole_dates
+                }
+            cells.update(
+                (x, y) for x in new_range if x not in whole_dates for
+                y in stations or ()
+                )
+            log.info(
+                f"{len(cells)} date/station cells affected from "
+                f"{old_dates} to {new_dates}"
+                )
+
+    rail_frames = []
+    bus_frames = []
+    if cells:
+        rail, bus = _station_departures_between(
+            {x[1] for x in cells}, min(x[0] for x in cells), max(x[0] for x in cells)
+            )
+        rail_frames.append(rail.loc[_in_cells(rail, cells, ())])
+        bus_frames.append(bus.loc[_in_cells(bus, cells, ())])
+    if whole_dates:
+        rail, bus = calculate_departures_between(whole_dates[0], whole_dates[-1])
+        rail_frames.append(rail.loc[rail['date'].isin(whole_dates)])
+        bus_frames.append(bus.loc[bus['date'].isin(whole_dates)])
+
+    out = []
+    for frames, col_name in ((rail_frames, 'total'), (bus_frames, 'total_bus')):
+        if not frames:
+            out.append(pd.DataFrame(columns=['date', 'station', 'hour', col_name]))
+            continue
+        frame = pd.concat(frames, ignore_index=True)
+        counts = [x for x in frame.columns if x not in ('date', 'station', 'hour')]
+        frame.loc[:, counts] = frame.loc[:, counts].fillna(0).astype(int)
+        frame = frame.loc[:, [x for x in frame.columns if x != col_name] + [col_name]]
+        out.append(frame.reset_index(drop=True))
+
+    return DeparturesDelta(out[0], out[1], cells, tuple(whole_dates))
+
+
+def _parse_args() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(
+        description='Departures at rail stations and their nearby bus stops'
+        )
+    parser.add_argument('stations', nargs='+', type=int,
+                        help='station stop_ids')
+    parser.add_argument('--start', required=True,
+                        help='first date YYYYMMDD')
+    parser.add_argument('--end', required=True,
+                        help='last date YYYYMMDD')
+    parser.add_argument('--granularity', choices=GRANULARITIES, default='hour')
+    parser.add_argument('--dates', default=None,
+                        help='the archive date range YYYYMMDD_YYYYMMDD')
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _parse_args()
+    rail_departures, bus_departures = departures_for(
+        args.stations, args.start, args.end,
+        granularity=args.granularity,
+        dates=args.dates
+        )
+    print('rail')
+    print(rail_departures.to_string(index=False))
+    print('bus')
+    print(bus_departures.to_string(index=False))
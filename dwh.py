@@ -9,15 +9,47 @@ import urllib
 import logging
 
 import pyodbc
-from sqlalchemy import create_engine
+from sqlalchemy import bindparam, create_engine, text
 from sqlalchemy.engine import reflection
 from sqlalchemy.exc import SQLAlchemyError
 
 log = logging.getLogger(__name__)
 
-def write_to_dwh(df, table_name=None, departure_type='rail'):
+def _replace_rows(engine, df, table_name, replace_cells=None, replace_dates=None):
+    """delete the rows on the dates and in the (date, station) cells and
+    insert the new rows, in one transaction"""
+
+    with engine.begin() as conn:
+        if replace_dates:
+            sql = text(
+                """DELETE FROM dbDwhExtract.Rejseplanen.{}
+                   WHERE [date] IN :dates""".format(table_name)
+                ).bindparams(bindparam('dates', expanding=True))
+            conn.execute(sql, {'dates': [int(x) for x in replace_dates]})
+        if replace_cells:
+            sql = text(
+                """DELETE FROM dbDwhExtract.Rejseplanen.{}
+                   WHERE [date] = :date AND [station] = :station""".format(table_name)
+                )
+            conn.execute(sql, [
+                {'date': int(date), 'station': int(station)} for
+                date, station in sorted(replace_cells)
+                ])
+        df.to_sql(table_name,
+                  conn,
+                  chunksize=1000,
+                  index=False,
+                  if_exists='append',
+                  schema='Rejseplanen')
+
+def write_to_dwh(
+        df, table_name=None, departure_type='rail',
+        replace_cells=None, replace_dates=None
+        ):
 
-    """put it in the data warehouse"""
+    """put it in the data warehouse. The rows already in the table on
+    replace_dates and in the (date, station) replace_cells are replaced
+    by the rows of df, see departures.departures_delta"""
 
     params = urllib.parse.quote_plus(
         'DRIVER={SQL Server};'+'SERVER='+'TSDW03'+
@@ -61,12 +93,7 @@ def write_to_dwh(df, table_name=None, departure_type='rail'):
             engine.execute(sql_2)
 
     try:
-        df.to_sql(table_name,
-                  engine, 
-                  chunksize=1000,
-                  index=False,
-                  if_exists='append',
-                  schema='Rejseplanen')
+        _replace_rows(engine, df, table_name, replace_cells, replace_dates)
     except (SQLAlchemyError, pyodbc.ProgrammingError):
 
         for new_col in new_columns_f:
@@ -80,12 +107,7 @@ def write_to_dwh(df, table_name=None, departure_type='rail'):
                        ALTER COLUMN {} nvarchar""".format(table_name, new_col)
             engine.execute(sql_2)
 
-        df.to_sql(table_name,
-                  engine, 
-                  chunksize=1000,
-                  index=False,
-                  if_exists='append',
-                  schema='Rejseplanen')
+        _replace_rows(engine, df, table_name, replace_cells, replace_dates)
     except Exception as e:
         log.warning(f"Can't write to warehouse. {table_name}. Error -> {str(e)}")
         with open('last_write_fail.txt', 'w') as fp:
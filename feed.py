@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Read the files of a gtfs feed from the downloaded zip or from a
+directory of extracted txt files
+
+The members of the zip are inflated as they are read, so the readers
+parse them without the feed being extracted to disk first.
+"""
+
+import logging
+import zipfile
+from pathlib import Path
+from typing import IO, Dict, List, Optional, Union
+
+log = logging.getLogger(__name__)
+
+THIS_DIR = Path(__file__).parent
+TEMP_DIR = Path(THIS_DIR, 'temp_data')
+
+GTFS_ZIP = 'GTFS.zip'
+
+T_MEMBER_STAT = Dict[str, Union[str, int]]
+
+
+class GTFSFeed:
+
+    def __init__(self, path: Path) -> None:
+        """
+        A gtfs feed in a zip file or a directory of txt files
+
+        :param path: the path of the zip file or the directory
+        :type path: Path
+        :rtype: None
+
+        """
+
+        self.path = Path(path)
+        self._zip = zipfile.ZipFile(self.path) if self.path.is_file() else None
+
+    def __enter__(self) -> 'GTFSFeed':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.members()
+
+    def members(self) -> List[str]:
+        """
+        The names of the files in the feed
+
+        :return: the sorted file names
+        :rtype: List[str]
+
+        """
+
+        if self._zip is not None:
+            return sorted(
+                x.filename for x in self._zip.infolist() if not x.is_dir()
+                )
+        if not self.path.is_dir():
+            return []
+
+        return sorted(x.name for x in self.path.iterdir() if x.is_file())
+
+    def open(self, name: str) -> IO[bytes]:
+        """
+        Open a file of the feed for reading. A zip member is inflated
+        as it is read
+
+        :param name: the file name, eg. stop_times.txt
+        :type name: str
+        :raises FileNotFoundError: if the file is not in the feed
+        :return: a binary file object
+        :rtype: IO[bytes]
+
+        """
+
+        if self._zip is None:
+            return open(Path(self.path, name), 'rb')
+        try:
+            return self._zip.open(name)
+        except KeyError:
+            raise FileNotFoundError(f"{name} not in {self.path}")
+
+    def member_path(self, name: str) -> Optional[Path]:
+        """
+        The path of a txt file of the feed on disk
+
+        :param name: the file name
+        :type name: str
+        :return: the path, None if the feed is a zip
+        :rtype: Optional[Path]
+
+        """
+
+        if self._zip is not None:
+            return None
+
+        return Path(self.path, name)
+
+    def stat(self, name: str) -> T_MEMBER_STAT:
+        """
+        The path, size and a change marker of a file of the feed. The
+        modification time of a txt file or the crc of a zip member
+
+        :param name: the file name
+        :type name: str
+        :return: the stat of the file
+        :rtype: T_MEMBER_STAT
+
+        """
+
+        if self._zip is None:
+            fp = Path(self.path, name)
+            stat = fp.stat()
+            return {
+                'path': str(fp.resolve()),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns
+                }
+        try:
+            info = self._zip.getinfo(name)
+        except KeyError:
+            raise FileNotFoundError(f"{name} not in {self.path}")
+
+        return {
+            'path': str(Path(self.path.resolve(), name)),
+            'size': info.file_size,
+            'crc': info.CRC
+            }
+
+    def close(self) -> None:
+        """close the zip file"""
+
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+
+def open_feed(dirpath: Optional[Path] = None) -> GTFSFeed:
+    """
+    Open the gtfs feed in a directory. The downloaded GTFS.zip is read
+    when it exists, otherwise the txt files in the directory
+
+    :param dirpath: the directory of the feed, defaults to None
+    :type dirpath: Optional[Path], optional
+    :return: the feed
+    :rtype: GTFSFeed
+    """
+
+    if not dirpath:
+        dirpath = Path(TEMP_DIR)
+
+    zip_path = Path(dirpath, GTFS_ZIP)
+    if zip_path.is_file():
+        return GTFSFeed(zip_path)
+
+    return GTFSFeed(Path(dirpath))
@@ -5,45 +5,273 @@ Created on Wed Jun 20 11:28:53 2018
 @author: alkj
 """
 
+import hashlib
+import json
 import logging
 import os
 import sys
 import zipfile
-from io import BytesIO
+from http.client import IncompleteRead
 from pathlib import Path
-from urllib.request import urlopen
+from typing import Any, Dict, Optional
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 
+from feed import GTFS_ZIP
 from tools import load_config
 
 
 THIS_DIR = Path(__file__).parent
 TEMP_DIR = Path(THIS_DIR, 'temp_data')
 
+DOWNLOAD_STATE = 'download_state.json'
+CHUNK_SIZE = 1024 * 1024
+
 log = logging.getLogger(__name__)
 
 
-def unzip_gtfs() -> None:
+def _load_state(dirpath: Path) -> Dict[str, Any]:
+    """load the state of the last download"""
+
+    fp = Path(dirpath, DOWNLOAD_STATE)
+    if not fp.is_file():
+        return {}
+    with open(fp, 'r') as f:
+        return json.load(f)
+
+def _save_state(dirpath: Path, state: Dict[str, Any]) -> None:
+    """save the state of the download"""
+
+    fp = Path(dirpath, DOWNLOAD_STATE)
+    with open(fp, 'w') as f:
+        json.dump(state, f, indent=4)
+
+def _file_hash(fp: Path) -> str:
+    """the content hash of a file"""
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def _validators(headers) -> Dict[str, Optional[str]]:
+    """the ETag and Last-Modified headers of a response"""
+
+    return {
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified')
+        }
+
+def _content_length(resp) -> Optional[int]:
+    """the length of the whole file from the response headers"""
+
+    content_range = resp.headers.get('Content-Range')
+    if resp.status == 206 and content_range:
+        total = content_range.rsplit('/', 1)[-1]
+        return int(total) if total.isdigit() else None
+    length = resp.headers.get('Content-Length')
+
+    return int(length) if length is not None else None
+
+def _range_start(resp) -> Optional[int]:
+    """the first byte of a partial response from its Content-Range"""
+
+    content_range = resp.headers.get('Content-Range') or ''
+    unit, _, byte_range = content_range.partition(' ')
+    start = byte_range.split('-', 1)[0]
+    if unit != 'bytes' or not start.isdigit():
+        return None
+
+    return int(start)
+
+def _restart_download(url: str, dirpath: Path, state: Dict[str, Any]) -> Optional[Path]:
+    """discard the partial download and download the whole feed"""
+
+    Path(dirpath, GTFS_ZIP + '.part').unlink(missing_ok=True)
+    state.pop('partial', None)
+    _save_state(dirpath, state)
+
+    return download_gtfs(url, dirpath)
+
+def download_gtfs(url: str, dirpath: Optional[Path] = None) -> Optional[Path]:
     """
-    download and extract gtfs zip
+    Download the gtfs zip to disk in chunks. The request is conditional
+    on the ETag and Last-Modified of the last download, so nothing is
+    downloaded if the feed has not been republished. An interrupted
+    download is kept in GTFS.zip.part and resumed with a Range request
+
+    :param url: the url of the gtfs zip
+    :type url: str
+    :param dirpath: the directory to download to, defaults to None
+    :type dirpath: Optional[Path], optional
+    :return: the path of the complete download, None if the feed is
+        not modified
+    :rtype: Optional[Path]
     """
 
-    gtfs_url = load_config()['gtfs_url']
-    resp = urlopen(gtfs_url)
+    if not dirpath:
+        dirpath = Path(TEMP_DIR)
+    Path(dirpath).mkdir(parents=True, exist_ok=True)
+
+    state = _load_state(dirpath)
+    zip_path = Path(dirpath, GTFS_ZIP)
+    part_path = Path(dirpath, GTFS_ZIP + '.part')
+
+    headers = {}
+    if zip_path.is_file():
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
 
-    code = resp.code
-    if code == 200:
-        log.info("GTFS response success")
+    offset = part_path.stat().st_size if part_path.is_file() else 0
+    partial = state.get('partial') or {}
+    if offset and (partial.get('etag') or partial.get('last_modified')):
+        headers['Range'] = f'bytes={offset}-'
+        # the whole feed is sent instead if it changed since the partial download
+        headers['If-Range'] = partial.get('etag') or partial['last_modified']
     else:
-        log.critical("GTFS download failed - system exit")
+        offset = 0
+
+    try:
+        resp = urlopen(Request(url, headers=headers))
+    except HTTPError as e:
+        if e.code == 304:
+            log.info("GTFS not modified since the last download")
+            return None
+        if e.code == 416 and offset:
+            # the partial download is stale, start again
+            log.info("GTFS partial download not resumable, restarting")
+            return _restart_download(url, dirpath, state)
+        log.critical(f"GTFS download failed with {e.code} - system exit")
         sys.exit(1)
 
-    with zipfile.ZipFile(BytesIO(resp.read())) as zfile:
+    with resp:
+        if resp.status == 206:
+            start = _range_start(resp)
+            if start != offset:
+                # appending would corrupt the zip
+                log.info(
+                    f"GTFS partial response starts at {start}, not at "
+                    f"{offset} bytes, restarting"
+                    )
+                return _restart_download(url, dirpath, state)
+            log.info(f"GTFS download resumed at {offset} bytes")
+            mode = 'ab'
+        elif resp.status == 200:
+            log.info("GTFS response success")
+            mode = 'wb'
+        else:
+            log.critical(f"GTFS download failed with {resp.status} - system exit")
+            sys.exit(1)
+
+        state['partial'] = _validators(resp.headers)
+        _save_state(dirpath, state)
+
+        try:
+            with open(part_path, mode) as f:
+                for chunk in iter(lambda: resp.read(CHUNK_SIZE), b''):
+                    f.write(chunk)
+        except (IncompleteRead, OSError) as e:
+            log.critical(f"GTFS download interrupted, it is resumed on the next run: {e}")
+            sys.exit(1)
+
+        expected = _content_length(resp)
+        if expected is not None and part_path.stat().st_size != expected:
+            log.critical(
+                f"GTFS download incomplete, {part_path.stat().st_size} of "
+                f"{expected} bytes. It is resumed on the next run - system exit"
+                )
+            sys.exit(1)
+
+        validators = _validators(resp.headers)
+
+    os.replace(part_path, zip_path)
+    state.pop('partial', None)
+    state.update(validators)
+    _save_state(dirpath, state)
+
+    return zip_path
+
+def fetch_gtfs(url: Optional[str] = None, dirpath: Optional[Path] = None) -> bool:
+    """
+    download the gtfs zip. The zip is kept so that the next download is
+    only made when the feed has been republished, and the feed is read
+    from the zip with feed.open_feed. The feed is changed when the
+    content of the zip differs from the last feed marked archived with
+    set_feed_archived
+
+    :param url: the url of the gtfs zip, defaults to None - the
+        gtfs_url of the config
+    :type url: Optional[str], optional
+    :param dirpath: the directory to download to, defaults to None
+    :type dirpath: Optional[Path], optional
+    :return: whether the feed changed
+    :rtype: bool
+    """
+
+    if not url:
+        url = load_config()['gtfs_url']
+    if not dirpath:
+        dirpath = Path(TEMP_DIR)
+
+    path = download_gtfs(url, dirpath)
+    state = _load_state(dirpath)
+    if path is None:
+        if state.get('content_hash') and \
+                state['content_hash'] == state.get('archived_hash'):
+            return False
+        # the last feed was downloaded but not archived
+        path = Path(dirpath, GTFS_ZIP)
+
+    content_hash = _file_hash(path)
+    if content_hash == state.get('archived_hash'):
+        log.info("GTFS content unchanged")
+        return False
+
+    state['content_hash'] = content_hash
+    _save_state(dirpath, state)
+
+    return True
+
+def unzip_gtfs(url: Optional[str] = None, dirpath: Optional[Path] = None) -> bool:
+    """
+    download the gtfs zip and extract the files when the feed changed
+
+    :param url: the url of the gtfs zip, defaults to None - the
+        gtfs_url of the config
+    :type url: Optional[str], optional
+    :param dirpath: the directory to extract to, defaults to None
+    :type dirpath: Optional[Path], optional
+    :return: whether a changed feed was extracted
+    :rtype: bool
+    """
+
+    if not dirpath:
+        dirpath = Path(TEMP_DIR)
+
+    if not fetch_gtfs(url, dirpath):
+        return False
+
+    with zipfile.ZipFile(Path(dirpath, GTFS_ZIP)) as zfile:
         for x in zfile.namelist():
-            zfile.extract(x, path=TEMP_DIR)
+            zfile.extract(x, path=dirpath)
+
+    return True
 
-    path = Path(TEMP_DIR, 'GTFS.zip')
-    if path.exists():
-        os.remove(path)
+def set_feed_archived(dirpath: Optional[Path] = None) -> None:
+    """
+    Mark the extracted feed as archived, so it is not extracted again
+
+    :param dirpath: the directory of the gtfs zip, defaults to None
+    :type dirpath: Optional[Path], optional
+    """
 
-    return
+    if not dirpath:
+        dirpath = Path(TEMP_DIR)
 
+    state = _load_state(dirpath)
+    state['archived_hash'] = state.get('content_hash')
+    _save_state(dirpath, state)
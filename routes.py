@@ -11,7 +11,9 @@ import json
 import logging
 from typing import Dict, Union
 
-import pandas as pd
+
+from feed import open_feed
+from schema import read_gtfs
 
 log = logging.getLogger(__name__)
 
@@ -30,7 +32,7 @@ def read_routes(routes_filepath: Path) -> T_ROUTE:
     :return: [description]
     :rtype: T_ROUTE
     """
-    df = pd.read_csv(routes_filepath).fillna('')
+    df = read_gtfs(routes_filepath, 'routes.txt')
 
     return df.set_index('route_id').T.to_dict()
 
@@ -70,14 +72,14 @@ def check_routes():
 
     base_data = Path(THIS_DIR, 'base_data2', 'routes.txt')
     archive_data = Path(ARCHIVE_DIR, 'routes.json')
-    new_data = Path(TEMP_DIR, 'routes.txt')
 
     if not os.path.isfile(archive_data):
         routes = read_routes(base_data)
         write_routes_to_archive(routes)
 
     archive_routes = read_archive_routes()
-    new_routes = read_routes(new_data)
+    with open_feed(TEMP_DIR) as feed, feed.open('routes.txt') as f:
+        new_routes = read_routes(f)
     find_dict_differences(archive_routes, new_routes)
 
     archive_routes.update(new_routes)
@@ -10,10 +10,11 @@ from pathlib import Path
 import warnings
 
 
-import lmdb
-
-from tools import find_date_range
-from getgtfsdata import unzip_gtfs
+from tools import (
+    find_date_range, hash_feed, update_catalog, load_config, load_bus_maps,
+    delta_base, ArchiveWriter
+    )
+from getgtfsdata import fetch_gtfs, set_feed_archived
 from agency import check_agency
 from busstops import bus_mapping
 from calendars import check_calendars
@@ -24,7 +25,7 @@ from stoptimes import check_stop_times
 from trips import check_trips
 from transfers import check_transfers
 from validate import validate_files
-from departures import calculate_departures
+from departures import departures_delta, remapped_stations
 from dwh import write_to_dwh
 
 
@@ -36,6 +37,8 @@ LOG_DIR = Path(THIS_DIR, 'logs')
 if not LOG_DIR.is_dir():
     LOG_DIR.mkdir(parents=True)
 
+log = logging.getLogger(__name__)
+
 logging.basicConfig(
     filename=Path(LOG_DIR, 'log.log'),
     filemode='a',
@@ -53,38 +56,70 @@ def main():
     """
 
 
-    unzip_gtfs()
+    # the feed is read from the downloaded zip, nothing is extracted
+    if not fetch_gtfs():
+        log.info("GTFS feed unchanged, nothing to archive")
+        return
+
     validate_files()
 
     check_agency()
     check_routes()
     check_stops()
 
-    # TODO. This will just ignore this write because the memory map is full
-    # from previously writing the exact same time period
-    # change in future to check for duplicates and update if changes
-    try:
-        check_stop_times()
-        check_trips()
-    except lmdb.MapFullError:
-        pass
+    # stop_times and trips are committed together, unless stop_times is
+    # read in chunks. Unchanged trips are skipped so rerunning the same
+    # feed period writes nothing
+    dates = find_date_range()
+    base = None
+    if load_config().get('delta_archives', False):
+        # only store the trips that differ from the last full archive
+        base = delta_base(dates)
+    writer = ArchiveWriter(
+        dates, base=base, compress=load_config().get('compress_archives', False),
+        replace=True
+        )
+    # a chunksize bounds the memory of the stop_times and shapes ingest.
+    # stop_times.txt can instead be parsed in a pool of processes, which
+    # is off by default as it was slower than one process on one cpu
+    chunksize = load_config().get('ingest_chunksize')
+    check_stop_times(
+        writer,
+        processes=load_config().get('ingest_processes'),
+        chunksize=chunksize
+        )
+    check_trips(writer)
+    writer.commit()
 
     check_transfers()
     check_calendars()
-    check_shapes()
+    check_shapes(chunksize=chunksize)
 
+    old_bus_maps = load_bus_maps()
     bus_mapping() # update the bus maps
 
     dates = find_date_range()
-    rail_departures, bus_departures = calculate_departures(dates)
-
-    write_to_dwh(bus_departures,
+    update_catalog(dates, feed_hash=hash_feed())
+    # only the departures that differ from the previous archive, they
+    # replace the rows of their dates and date/station cells. Stations
+    # with changed bus stops are counted again
+    delta = departures_delta(
+        dates, stations=remapped_stations(old_bus_maps, load_bus_maps())
+        )
+
+    write_to_dwh(delta.bus,
                  table_name='bus_departures',
-                 departure_type='bus')
+                 departure_type='bus',
+                 replace_cells=delta.cells,
+                 replace_dates=delta.dates)
 
-    write_to_dwh(rail_departures,
+    write_to_dwh(delta.rail,
                  table_name='departures',
-                 departure_type='rail')
+                 departure_type='rail',
+                 replace_cells=delta.cells,
+                 replace_dates=delta.dates)
+
+    set_feed_archived()
 
 
 if __name__ == "__main__":
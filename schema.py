@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+The column types of the gtfs files
+
+Every reader parses its file with read_gtfs, so the columns have fixed
+dtypes instead of the types read_csv infers, and missing values are
+filled per column instead of the whole frame becoming object columns.
+Missing values take the default of the gtfs reference where it has one,
+eg. an empty location_type is 0 - a stop. Optional enumerations without
+a default are -1, and missing text is ''. An empty pickup_type or
+drop_off_type is also -1, so those stops stay out of the departures as
+they were before the schema.
+"""
+
+import logging
+from typing import Any, Callable, Dict, IO, Iterator, NamedTuple, Optional, Union
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+# 'pyarrow' parses with pyarrow.csv, it needs pandas >= 1.4 and pyarrow
+CSV_ENGINE = 'c'
+
+
+class Column(NamedTuple):
+    """the dtype of a column and the value of its missing fields"""
+    dtype: Any
+    default: Any = None
+
+
+class FileSchema(NamedTuple):
+    """the typed columns of a gtfs file. Only the typed columns are read
+    unless other_columns, then the other columns are read as text"""
+    columns: Dict[str, Column]
+    other_columns: bool = False
+
+
+TEXT = Column(str, '')
+
+GTFS_SCHEMA: Dict[str, FileSchema] = {
+    'agency.txt': FileSchema({
+        'agency_id': Column(np.int64),
+        'agency_name': TEXT,
+        'agency_url': TEXT,
+        'agency_timezone': TEXT,
+        'agency_lang': TEXT,
+        'agency_phone': TEXT,
+        }, other_columns=True),
+    'routes.txt': FileSchema({
+        'route_id': Column(str),
+        'agency_id': Column(np.int64, -1),
+        'route_short_name': TEXT,
+        'route_long_name': TEXT,
+        'route_desc': TEXT,
+        'route_type': Column(np.int64),
+        'route_color': TEXT,
+        'route_text_color': TEXT,
+        }, other_columns=True),
+    'stops.txt': FileSchema({
+        # older Rejseplan feeds prefix the stop_ids with G
+        'stop_id': Column(str),
+        'stop_code': TEXT,
+        'stop_name': TEXT,
+        'stop_desc': TEXT,
+        'stop_lat': Column(np.float64),
+        'stop_lon': Column(np.float64),
+        'location_type': Column(np.int64, 0),
+        'parent_station': TEXT,
+        'wheelchair_boarding': Column(np.int64, 0),
+        'platform_code': TEXT,
+        }, other_columns=True),
+    'trips.txt': FileSchema({
+        'route_id': Column(str),
+        'service_id': Column(np.int64),
+        'trip_id': Column(np.int64),
+        'trip_headsign': Column('category', ''),
+        'trip_short_name': TEXT,
+        'direction_id': Column(np.int64, -1),
+        'block_id': TEXT,
+        'shape_id': Column(np.int64, -1),
+        'wheelchair_accessible': Column(np.int64, 0),
+        'bikes_allowed': Column(np.int64, 0),
+        }, other_columns=True),
+    'stop_times.txt': FileSchema({
+        'trip_id': Column(np.int64),
+        'arrival_time': TEXT,
+        'departure_time': TEXT,
+        # a missing stop_id is 0 as it was before the schema
+        'stop_id': Column(str, '0'),
+        'stop_sequence': Column(np.int64),
+        'stop_headsign': Column('category', ''),
+        'pickup_type': Column(np.int8, -1),
+        'drop_off_type': Column(np.int8, -1),
+        }),
+    'calendar.txt': FileSchema({
+        'service_id': Column(np.int64),
+        'monday': Column(np.int8, 0),
+        'tuesday': Column(np.int8, 0),
+        'wednesday': Column(np.int8, 0),
+        'thursday': Column(np.int8, 0),
+        'friday': Column(np.int8, 0),
+        'saturday': Column(np.int8, 0),
+        'sunday': Column(np.int8, 0),
+        'start_date': Column(np.int64),
+        'end_date': Column(np.int64),
+        }),
+    'calendar_dates.txt': FileSchema({
+        'service_id': Column(np.int64),
+        'date': Column(np.int64),
+        'exception_type': Column(np.int8),
+        }),
+    'shapes.txt': FileSchema({
+        'shape_id': Column(np.int64),
+        'shape_pt_lat': Column(np.float64),
+        'shape_pt_lon': Column(np.float64),
+        'shape_pt_sequence': Column(np.int64),
+        }),
+    'transfers.txt': FileSchema({
+        # older Rejseplan feeds prefix the stop_ids with G
+        'from_stop_id': Column(str),
+        'to_stop_id': Column(str),
+        'from_route_id': TEXT,
+        'to_route_id': TEXT,
+        'transfer_type': Column(np.int64, 0),
+        'min_transfer_time': Column(np.int64, 0),
+        }),
+    }
+
+
+def _parse_dtype(column: Column) -> Any:
+    """the dtype to parse a column with. Integers with a default
+    are parsed as float so that missing fields can be filled"""
+
+    if column.default is not None and column.dtype not in (str, 'category') \
+            and np.issubdtype(column.dtype, np.integer):
+        return np.float64
+
+    return column.dtype
+
+def parse_dtypes(name: str) -> Dict[str, Any]:
+    """
+    The read_csv dtypes of a gtfs file
+
+    :param name: the gtfs file name, eg. stop_times.txt
+    :type name: str
+    :return: the dtypes of the typed columns
+    :rtype: Dict[str, Any]
+    """
+
+    return {
+        k: _parse_dtype(v) for k, v in GTFS_SCHEMA[name].columns.items()
+        }
+
+def select_columns(name: str) -> Optional[Callable[[str], bool]]:
+    """
+    The read_csv usecols of a gtfs file
+
+    :param name: the gtfs file name
+    :type name: str
+    :return: the column filter, None if every column is read
+    :rtype: Optional[Callable[[str], bool]]
+    """
+
+    schema = GTFS_SCHEMA[name]
+    if schema.other_columns:
+        return None
+
+    return lambda x: x in schema.columns
+
+def apply_schema(df: pd.core.frame.DataFrame, name: str) -> pd.core.frame.DataFrame:
+    """
+    Fill the missing values of a parsed gtfs file and cast the columns
+    to their schema dtypes. The optional columns of the files that are
+    only read for the typed columns are added when they are not in the
+    file
+
+    :param df: the frame parsed with parse_dtypes and select_columns
+    :type df: pd.core.frame.DataFrame
+    :param name: the gtfs file name
+    :type name: str
+    :return: the typed frame
+    :rtype: pd.core.frame.DataFrame
+    """
+
+    schema = GTFS_SCHEMA[name]
+    for col in df.columns:
+        column = schema.columns.get(col)
+        if column is None:
+            if not schema.other_columns:
+                df = df.drop(col, axis=1)
+                continue
+            column = TEXT
+        values = df.loc[:, col]
+        if column.default is not None and values.isnull().any():
+            if values.dtype.name == 'category' and \
+                    column.default not in values.cat.categories:
+                values = values.cat.add_categories([column.default])
+            values = values.fillna(column.default)
+        if column.dtype is str:
+            # text parsed as numbers by the pyarrow engine or unknown columns
+            if values.dtype != np.object_:
+                values = values.astype(str)
+        elif values.dtype != column.dtype:
+            values = values.astype(column.dtype)
+        df[col] = values
+
+    if not schema.other_columns:
+        for col, column in schema.columns.items():
+            if col not in df.columns and column.default is not None:
+                df[col] = pd.Series(
+                    column.default, index=df.index, dtype=column.dtype
+                    )
+
+    return df
+
+def read_gtfs(
+        filepath: Union[Path, IO[bytes]],
+        name: str,
+        engine: Optional[str] = CSV_ENGINE,
+        **kwargs: Any
+        ) -> pd.core.frame.DataFrame:
+    """
+    Read a gtfs file with the dtypes of its schema
+
+    :param filepath: the path of the file or the open file
+    :type filepath: Union[Path, IO[bytes]]
+    :param name: the gtfs file name, eg. stop_times.txt
+    :type name: str
+    :param engine: the read_csv engine, defaults to CSV_ENGINE
+    :type engine: Optional[str], optional
+    :param kwargs: more read_csv keyword arguments
+    :return: the typed frame
+    :rtype: pd.core.frame.DataFrame
+    """
+
+    usecols = select_columns(name)
+    if engine == 'pyarrow':
+        # only a list of columns is supported, the others are dropped by
+        # apply_schema
+        usecols = None
+    else:
+        kwargs.setdefault('low_memory', False)
+
+    df = pd.read_csv(
+        filepath,
+        dtype=parse_dtypes(name),
+        usecols=usecols,
+        engine=engine,
+        **kwargs
+        )
+
+    return apply_schema(df, name)
+
+def read_gtfs_groups(
+        filepath: Union[Path, IO[bytes]],
+        name: str,
+        key: str,
+        chunksize: int
+        ) -> Iterator[pd.core.frame.DataFrame]:
+    """
+    Read a gtfs file in chunks of chunksize rows and yield the whole
+    groups of rows with the same key, eg. the trips of stop_times.txt.
+    The rows of a group must be together in the file. The last group of
+    a chunk may continue in the next chunk, so it is carried over. The
+    keys of the yielded groups are kept in a sorted array to check that
+    the groups are together, so memory grows with the number of groups,
+    not with the rows of the file
+
+    :param filepath: the path of the file or the open file
+    :type filepath: Union[Path, IO[bytes]]
+    :param name: the gtfs file name, eg. stop_times.txt
+    :type name: str
+    :param key: the column of the group key, eg. trip_id
+    :type key: str
+    :param chunksize: the number of rows read at a time
+    :type chunksize: int
+    :raises ValueError: if the rows of a group are not together in the
+        file
+    :yield: frames of whole groups in the order of the file
+    :rtype: Iterator[pd.core.frame.DataFrame]
+    """
+
+    reader = pd.read_csv(
+        filepath,
+        dtype=parse_dtypes(name),
+        usecols=select_columns(name),
+        chunksize=chunksize
+        )
+
+    # the sorted keys of the groups yielded so far
+    yielded = None
+    carry = None
+    for chunk in reader:
+        if not len(chunk):
+            continue
+        chunk = apply_schema(chunk, name)
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        values = chunk.loc[:, key].values
+        keys = pd.unique(values)
+        groups = 1 + np.count_nonzero(values[1:] != values[:-1])
+        if groups != len(keys) or (
+                yielded is not None and np.isin(keys, yielded).any()):
+            raise ValueError(
+                f"the rows of each {key} in {name} must be together "
+                f"to read it in chunks"
+                )
+        last = values[-1]
+        is_last = values == last
+        carry = chunk.loc[is_last].reset_index(drop=True)
+        if not is_last.all():
+            done = keys[keys != last]
+            yielded = done if yielded is None else np.union1d(yielded, done)
+            yield chunk.loc[~is_last].reset_index(drop=True)
+
+    if carry is not None and len(carry):
+        yield carry
@@ -8,11 +8,12 @@ Created on Mon Dec  7 10:48:57 2020
 
 
 import logging
+import os
 
 from itertools import groupby
 from operator import itemgetter
 from pathlib import Path
-from typing import Dict, Any, List, Union
+from typing import Dict, Any, List, Union, Optional, IO
 
 
 import geojson
@@ -20,7 +21,9 @@ import pandas as pd
 from shapely import geometry, wkt
 
 
-from tools import find_date_range
+from feed import open_feed
+from schema import read_gtfs, read_gtfs_groups
+from tools import find_date_range, update_catalog
 
 log = logging.getLogger(__name__)
 
@@ -35,7 +38,7 @@ FEAT_COL_TYPE = Dict[str, Union[str, List[FEATURE_TYPE]]]
 
 def read_shapes(filepath: Path) -> pd.core.frame.DataFrame:
 
-    return pd.read_csv(filepath)
+    return read_gtfs(filepath, 'shapes.txt')
 
 def process_shapes(shapes: pd.core.frame.DataFrame) -> FEAT_COL_TYPE:
 
@@ -85,12 +88,58 @@ def write_shapes_to_archive(shape_dict: FEAT_COL_TYPE) -> None:
     log.info(f"Shapes written to {dates}")
 
 
-def check_shapes() -> None:
+def write_shapes_to_archive_in_chunks(f: IO[bytes], chunksize: int) -> int:
+    """
+    Read shapes.txt in chunks of whole shapes and write the features of
+    each chunk to the archive shapes.geojson before reading the next.
+    The rows of each shape must be together in the file and the features
+    are in the order of the file
 
-    new_shapes = Path(TEMP_DIR, 'shapes.txt')
-    new_shapes = read_shapes(new_shapes)
-    new_shapes = process_shapes(new_shapes)
-    write_shapes_to_archive(new_shapes)
+    :param f: the open shapes.txt file
+    :type f: IO[bytes]
+    :param chunksize: the number of rows read at a time
+    :type chunksize: int
+    :return: the number of shapes rows
+    :rtype: int
+    """
+
+    dates = find_date_range()
+    fp = Path(ARCHIVE_DIR, dates, 'shapes.geojson')
+    part = fp.with_suffix('.geojson.part')
+
+    rows = 0
+    separator = ''
+    with open(part, 'w') as out:
+        out.write('{"type": "FeatureCollection", "features": [')
+        for chunk in read_gtfs_groups(f, 'shapes.txt', 'shape_id', chunksize):
+            for feature in process_shapes(chunk)['features']:
+                out.write(separator + geojson.dumps(feature))
+                separator = ', '
+            rows += len(chunk)
+        out.write(']}')
+    os.replace(part, fp)
+    log.info(f"Shapes written to {dates}")
+
+    return rows
+
+def check_shapes(chunksize: Optional[int] = None) -> None:
+    """
+    Read the new shapes and write them to the archive
+
+    :param chunksize: read shapes.txt this many rows at a time, defaults
+        to None - read the whole file. The rows of each shape must be
+        together in the file
+    :type chunksize: Optional[int], optional
+    """
+
+    with open_feed(TEMP_DIR) as feed, feed.open('shapes.txt') as f:
+        if chunksize is not None:
+            rows = write_shapes_to_archive_in_chunks(f, chunksize)
+        else:
+            new_shapes = read_shapes(f)
+            rows = len(new_shapes)
+            write_shapes_to_archive(process_shapes(new_shapes))
+    update_catalog(find_date_range(), rows={'shapes': rows})
 
     return
 
@@ -11,7 +11,10 @@ import json
 import logging
 from typing import Dict, Optional, Union
 
-import pandas as pd
+import numpy as np
+
+from feed import open_feed
+from schema import read_gtfs
 
 log = logging.getLogger(__name__)
 
@@ -34,11 +37,10 @@ def read_stops(stops_filepath: Path) -> T_STOPS:
     :rtype: T_STOPS
     """
 
-    df = pd.read_csv(stops_filepath).fillna('')
-    if not 'int' in df.loc[:, 'stop_id'].dtype.name:
-        df.loc[:, 'stop_id'] = \
-            df.loc[:, 'stop_id'].str.strip('G').astype(int)
-        df = df.drop_duplicates('stop_id')
+    df = read_gtfs(stops_filepath, 'stops.txt')
+    # this deals with older format gtfs from Rejseplan
+    df.loc[:, 'stop_id'] = df.loc[:, 'stop_id'].str.strip('G').astype(np.int64)
+    df = df.drop_duplicates('stop_id')
 
     return df.set_index('stop_id').T.to_dict()
 
@@ -119,14 +121,14 @@ def check_stops(
         write_stops_to_archive(base_stops)
 
     archive_stops_path = ARCHIVE_DIR / 'stops.json'
-    new_data = TEMP_DIR / 'stops.txt'
 
     if archive_stops_path.is_file():
         archive_stops = read_archive_stops()
     else:
         archive_stops = {}
 
-    new_stops = read_stops(new_data)
+    with open_feed(TEMP_DIR) as feed, feed.open('stops.txt') as f:
+        new_stops = read_stops(f)
     find_dict_differences(archive_stops, new_stops)
 
     archive_stops.update(new_stops)
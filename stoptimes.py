@@ -5,15 +5,27 @@ Created on Thu Dec  3 09:28:42 2020
 @author: alkj
 """
 
-from pathlib import Path
+import csv
+import io
 import logging
-from typing import Dict, Union
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+from pathlib import Path
+from typing import Dict, Union, Optional, List, IO, Iterator, Tuple
 
-import pandas as pd
 import lmdb
+import numpy as np
+import pandas as pd
 import msgpack
 
-from tools import find_date_range
+from feed import open_feed
+from schema import read_gtfs, read_gtfs_groups, apply_schema
+from tools import (
+    find_date_range, update_catalog, decode_key, encode_key, _retry_map_full,
+    ArchiveWriter, DB_SIZE, STOP_TIME_COLUMNS, STOP_INDEX
+    )
 
 log = logging.getLogger(__name__)
 
@@ -22,8 +34,190 @@ ARCHIVE_DIR = Path(THIS_DIR, 'archive')
 TEMP_DIR = Path(THIS_DIR, 'temp_data')
 
 T_STOPS_TIMES = Dict[int, Dict[int, Dict[str, Union[str, int, float]]]]
+T_STOP_TIME_COLUMNS = Dict[str, np.ndarray]
+
+# the dtypes of the stop_times column arrays
+COLUMN_DTYPES = {
+    'trip_id': np.int64,
+    'stop_sequence': np.int32,
+    'stop_id': np.int64,
+    'arrival_seconds': np.int32,
+    'departure_seconds': np.int32,
+    'pickup_type': np.int8,
+    'drop_off_type': np.int8,
+    'trips': np.int64,
+    'offsets': np.int64
+    }
+# the chunks per process, so a slow chunk does not hold up the pool
+CHUNKS_PER_PROCESS = 4
+
+def _read_stop_times_frame(
+        stoptimes_filepath: Union[Path, IO[bytes]]
+        ) -> pd.core.frame.DataFrame:
+    """Load the stop_times.txt file into a frame sorted on trip_id
+    and stop_sequence
+
+    :param stoptimes_filepath: path to the stop_times.txt file or
+        an open stop_times.txt file
+    :type stoptimes_filepath: Union[Path, IO[bytes]]
+    :return: the sorted stop_times frame
+    :rtype: pd.core.frame.DataFrame
+    """
+
+    df = read_gtfs(stoptimes_filepath, 'stop_times.txt')
+
+    return _prepare_stop_times_frame(_add_seconds(df))
+
+def _add_seconds(df: pd.core.frame.DataFrame) -> pd.core.frame.DataFrame:
+    """add the arrival_seconds and departure_seconds columns"""
+
+    df.loc[:, 'arrival_seconds'] = _time_to_seconds(df.loc[:, 'arrival_time'])
+    df.loc[:, 'departure_seconds'] = _time_to_seconds(df.loc[:, 'departure_time'])
+
+    return df
+
+def _prepare_stop_times_frame(
+        df: pd.core.frame.DataFrame
+        ) -> pd.core.frame.DataFrame:
+    """Convert the stop_ids of a parsed stop_times frame with the
+    seconds columns and sort it on trip_id and stop_sequence
+
+    :param df: the stop_times frame from _add_seconds
+    :type df: pd.core.frame.DataFrame
+    :return: the sorted stop_times frame
+    :rtype: pd.core.frame.DataFrame
+    """
+
+    # this deals with older format gtfs from Rejseplan
+    df.loc[:, 'stop_id'] = df.loc[:, 'stop_id'].str.strip('G').astype(np.int64)
+
+    return df.sort_values(['trip_id', 'stop_sequence'])
+
+def _line_offsets(f: IO[bytes], size: int, n: int) -> List[int]:
+    """
+    Split the data rows of a csv file into at most n byte ranges that
+    start and end at line ends
+
+    :param f: the open file, positioned at the first data row
+    :type f: IO[bytes]
+    :param size: the size of the file in bytes
+    :type size: int
+    :param n: the number of ranges
+    :type n: int
+    :return: the sorted start offsets of the ranges and the file size
+    :rtype: List[int]
+    """
+
+    first = f.tell()
+    offsets = [first]
+    step = max((size - first) // n, 1)
+    for i in range(1, n):
+        position = first + i * step
+        if position <= offsets[-1]:
+            continue
+        f.seek(position - 1)
+        f.readline()
+        if f.tell() >= size:
+            break
+        if f.tell() > offsets[-1]:
+            offsets.append(f.tell())
+    offsets.append(size)
+
+    return offsets
+
+def _parse_stop_times_range(
+        source: Union[Path, bytes],
+        columns: Tuple[str, ...],
+        start: int,
+        end: int
+        ) -> pd.core.frame.DataFrame:
+    """
+    Parse the rows of stop_times.txt in a byte range and add the
+    seconds columns. A path is read by the worker, bytes are the
+    content of the range, sliced from the inflated file of a zipped
+    feed, so only the range is sent to the worker
+
+    :param source: the path of stop_times.txt or the range content
+    :type source: Union[Path, bytes]
+    :param columns: the header of the file
+    :type columns: Tuple[str, ...]
+    :param start: the offset of the first row of the range in the file
+    :type start: int
+    :param end: the offset of the end of the range in the file
+    :type end: int
+    :return: the parsed rows
+    :rtype: pd.core.frame.DataFrame
+    """
+
+    if isinstance(source, bytes):
+        data = source
+    else:
+        with open(source, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+
+    df = read_gtfs(
+        io.BytesIO(data), 'stop_times.txt', header=None, names=list(columns)
+        )
+
+    return _add_seconds(df)
 
-DB_SIZE = 1 * 1024 * 1024 * 1024
+def read_stop_times_parallel(
+        source: Union[Path, bytes],
+        processes: Optional[int] = None
+        ) -> pd.core.frame.DataFrame:
+    """
+    Parse stop_times.txt in a pool of processes. The file is split into
+    byte ranges at line ends and the ranges are parsed with the schema
+    dtypes. The frame is the same as from _read_stop_times_frame, sorted
+    on trip_id and stop_sequence so every trip is one block of rows.
+    Quoted values must not contain line breaks
+
+    :param source: the path of stop_times.txt or the content of the
+        stop_times.txt member of a zipped feed
+    :type source: Union[Path, bytes]
+    :param processes: the number of processes, defaults to None - the
+        number of cpus
+    :type processes: Optional[int], optional
+    :return: the sorted stop_times frame
+    :rtype: pd.core.frame.DataFrame
+    """
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    if isinstance(source, bytes):
+        size = len(source)
+        f = io.BytesIO(source)
+    else:
+        size = os.path.getsize(source)
+        f = open(source, 'rb')
+    with f:
+        header = f.readline().decode('utf-8-sig')
+        columns = tuple(next(csv.reader([header])))
+        offsets = _line_offsets(f, size, processes * CHUNKS_PER_PROCESS)
+
+    ranges = list(zip(offsets[:-1], offsets[1:]))
+    with ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn')
+            ) as pool:
+        futures = [
+            pool.submit(
+                _parse_stop_times_range,
+                source[start:end] if isinstance(source, bytes) else source,
+                columns, start, end
+                ) for start, end in ranges
+            ]
+        frames = [x.result() for x in futures]
+
+    if frames:
+        df = pd.concat(frames, ignore_index=True)
+    else:
+        df = apply_schema(pd.DataFrame(columns=list(columns)), 'stop_times.txt')
+        df = _add_seconds(df)
+
+    return _prepare_stop_times_frame(df)
 
 def read_stop_times(stoptimes_filepath: Path)-> T_STOPS_TIMES:
     """Load the stop_times.txt file, process it and convert it
@@ -36,6 +230,8 @@ def read_stop_times(stoptimes_filepath: Path)-> T_STOPS_TIMES:
             stopsequencenum:{
                 'arrival_time': time,
                 'departure_time': time,
+                'arrival_seconds': seconds past midnight,
+                'departure_seconds': seconds past midnight,
                 'stop_id': stopid,
                 'pickup_type': 1/0,
                 'drop_off_type':, 1/0
@@ -46,25 +242,44 @@ def read_stop_times(stoptimes_filepath: Path)-> T_STOPS_TIMES:
     :rtype: T_STOPS_TIMES
     """
 
-    df = pd.read_csv(stoptimes_filepath, low_memory=False)
-    df = df.fillna('0')
+    return _split_trips(_read_stop_times_frame(stoptimes_filepath))
 
-    # this deals with older format gtfs from Rejseplan
-    if not 'int' in df.loc[:, 'stop_id'].dtype.name:
-        df.loc[:, 'stop_id'] = \
-            df.loc[:, 'stop_id'].astype(str).str.strip('G').astype(int)
+def _split_trips(df: pd.core.frame.DataFrame) -> T_STOPS_TIMES:
+    """Split a stop_times frame sorted on trip_id and stop_sequence into
+    the nested stop_times dictionary in a single pass
 
-    df = df.sort_values(['trip_id', 'stop_sequence'])
-    df = df.set_index(['trip_id', 'stop_sequence'])
+    :param df: the sorted stop_times frame
+    :type df: pd.core.frame.DataFrame
+    :return: the stop_times dictionary, see read_stop_times
+    :rtype: T_STOPS_TIMES
+    """
+
+    if df.empty:
+        return {}
+
+    columns = [x for x in df.columns if x not in ('trip_id', 'stop_sequence')]
+
+    trip_values = df.loc[:, 'trip_id'].values
+    # the first row of every trip block
+    starts = np.flatnonzero(
+        np.r_[True, trip_values[1:] != trip_values[:-1]]
+        )
+    ends = np.r_[starts[1:], len(trip_values)]
+
+    trip_ids = df.loc[:, 'trip_id'].tolist()
+    sequences = df.loc[:, 'stop_sequence'].tolist()
+    rows = list(zip(*(df.loc[:, col].tolist() for col in columns)))
 
     return {
-        level: df.xs(level).to_dict('index') for
-        level in df.index.levels[0]
+        trip_ids[start]: {
+            sequences[i]: dict(zip(columns, rows[i])) for i in range(start, end)
+            } for start, end in zip(starts, ends)
         }
 
 def write_stops_times_to_archive(
         stop_times: T_STOPS_TIMES,
-        dates: str
+        dates: str,
+        writer: Optional[ArchiveWriter] = None
         ) -> None:
     """Write the stop_times data to the archive
     This data set is placed in an lmdb key-value store
@@ -73,28 +288,358 @@ def write_stops_times_to_archive(
     :type stop_times: T_STOPS_TIMES
     :param dates: a daterange string
     :type dates: str
+    :param writer: stage the stop_times in this writer instead of
+        committing them, defaults to None
+    :type writer: Optional[ArchiveWriter], optional
     """
 
-    archive_loc = str(Path(ARCHIVE_DIR, dates))
+    commit = writer is None
+    if commit:
+        writer = ArchiveWriter(dates)
 
-    with lmdb.open(archive_loc, map_size=DB_SIZE, max_dbs=5) as env:
-        child_db = env.open_db(bytes('stop_times', 'utf-8'))
-        with env.begin(db=child_db, write=True) as txn:
-            for k, v in stop_times.items():
-                key = bytes(str(k), 'utf-8')
-                value = msgpack.packb(v)
-                txn.put(key, value)
+    writer.stage(
+        'stop_times',
+        ((k, msgpack.packb(v)) for k, v in stop_times.items())
+        )
 
-    log.info(f"Stoptimes data written to archive in : {dates}")
+    if commit:
+        writer.commit()
 
+def _time_to_seconds(times: pd.core.series.Series) -> np.ndarray:
+    """Convert gtfs HH:MM:SS strings to seconds past midnight of the
+    service day. Hours may be 24 or more. Missing times are -1
 
-def check_stop_times() -> None:
+    :param times: a series of gtfs time strings
+    :type times: pd.core.series.Series
+    :return: an array of seconds
+    :rtype: np.ndarray
     """
-    Read the new stoptimes data and write it to the archive
+
+    parts = times.astype(str).str.extract(r'^\s*(\d+):(\d\d):(\d\d)')
+    parts = parts.astype(float)
+    seconds = parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+    return seconds.fillna(-1).values.astype(np.int32)
+
+def stop_times_to_columns(df: pd.core.frame.DataFrame) -> T_STOP_TIME_COLUMNS:
+    """Convert the sorted stop_times frame to typed column arrays
+    with a trip offset index. The rows of trip trips[i] are
+    offsets[i]:offsets[i + 1]
+
+    :param df: the sorted stop_times frame from _read_stop_times_frame
+    :type df: pd.core.frame.DataFrame
+    :return: a dictionary of column name to array
+    :rtype: T_STOP_TIME_COLUMNS
+    """
+
+    columns = {
+        name: df.loc[:, name].values.astype(dtype) for
+        name, dtype in COLUMN_DTYPES.items() if name not in ('trips', 'offsets')
+        }
+    trip_id = columns['trip_id']
+    starts = np.flatnonzero(np.r_[True, trip_id[1:] != trip_id[:-1]]) \
+        if len(trip_id) else np.array([], dtype=np.int64)
+
+    columns['trips'] = trip_id[starts]
+    columns['offsets'] = np.r_[starts, len(trip_id)].astype(np.int64)
+
+    return columns
+
+def write_stop_time_columns_to_archive(
+        columns: T_STOP_TIME_COLUMNS,
+        dates: str
+        ) -> None:
+    """Write the stop_times column arrays to the archive. Each
+    column is saved as an .npy file so that it can be memory mapped
+
+    :param columns: the column arrays from stop_times_to_columns
+    :type columns: T_STOP_TIME_COLUMNS
+    :param dates: a daterange string
+    :type dates: str
     """
 
-    new_data = TEMP_DIR / 'stop_times.txt'
+    column_dir = Path(ARCHIVE_DIR, dates, STOP_TIME_COLUMNS)
+    column_dir.mkdir(parents=True, exist_ok=True)
+
+    for name, values in columns.items():
+        np.save(Path(column_dir, f'{name}.npy'), values)
+
+    log.info(f"Stoptimes columns written to archive in : {dates}")
+
+
+def make_stop_index(df: pd.core.frame.DataFrame) -> Dict[int, List[int]]:
+    """Make the stop_id -> trip_ids index of the stop_times
+
+    :param df: the stop_times frame
+    :type df: pd.core.frame.DataFrame
+    :return: dictionary of stop_id to the sorted trip_ids serving the stop
+    :rtype: Dict[int, List[int]]
+    """
+
+    pairs = df.loc[:, ['stop_id', 'trip_id']].drop_duplicates()
+    pairs = pairs.sort_values(['stop_id', 'trip_id'])
+
+    return {
+        k: grp.tolist() for k, grp in
+        pairs.groupby('stop_id', sort=False)['trip_id']
+        }
+
+def write_stop_index_to_archive(
+        stop_index: Dict[int, List[int]],
+        dates: str,
+        writer: Optional[ArchiveWriter] = None
+        ) -> None:
+    """Write the stop_id -> trip_ids index to the archive
+
+    :param stop_index: the index from make_stop_index
+    :type stop_index: Dict[int, List[int]]
+    :param dates: a daterange string
+    :type dates: str
+    :param writer: stage the index in this writer instead of
+        committing it, defaults to None
+    :type writer: Optional[ArchiveWriter], optional
+    """
+
+    commit = writer is None
+    if commit:
+        writer = ArchiveWriter(dates)
+
+    writer.stage(
+        STOP_INDEX,
+        ((k, msgpack.packb(v)) for k, v in stop_index.items())
+        )
+
+    if commit:
+        writer.commit()
+
+def _append_stop_time_columns(
+        columns: T_STOP_TIME_COLUMNS,
+        column_dir: Path,
+        rows: int
+        ) -> None:
+    """
+    Append the column arrays of a chunk of whole trips to the .part
+    files of the columns
+
+    :param columns: the column arrays from stop_times_to_columns
+    :type columns: T_STOP_TIME_COLUMNS
+    :param column_dir: the stop_times columns directory of the archive
+    :type column_dir: Path
+    :param rows: the number of rows in the earlier chunks
+    :type rows: int
+    """
+
+    for name, values in columns.items():
+        if name == 'offsets':
+            # the end offset is appended by _finish_stop_time_columns
+            values = values[:-1] + rows
+        with open(Path(column_dir, f'{name}.part'), 'ab') as f:
+            values.tofile(f)
+
+def _finish_stop_time_columns(column_dir: Path, rows: int) -> None:
+    """
+    Save the .part files of the columns as the .npy column files. The
+    parts are memory mapped so they are not read into memory
+
+    :param column_dir: the stop_times columns directory of the archive
+    :type column_dir: Path
+    :param rows: the number of rows in all the chunks
+    :type rows: int
+    """
+
+    with open(Path(column_dir, 'offsets.part'), 'ab') as f:
+        np.array([rows], dtype=np.int64).tofile(f)
+
+    for name, dtype in COLUMN_DTYPES.items():
+        part = Path(column_dir, f'{name}.part')
+        if part.is_file() and part.stat().st_size:
+            values = np.memmap(part, dtype=dtype, mode='r')
+        else:
+            values = np.array([], dtype=dtype)
+        np.save(Path(column_dir, f'{name}.npy'), values)
+        del values
+        if part.is_file():
+            part.unlink()
+
+def _spill_stop_index(
+        env: lmdb.Environment,
+        db,
+        frame: pd.core.frame.DataFrame
+        ) -> None:
+    """
+    Add the (stop_id, trip_id) pairs of a chunk of stop_times to the
+    scratch stop index, a database of the sorted trip_ids of each stop_id
+
+    :param env: the scratch environment from _ingest_stop_times_chunks
+    :type env: lmdb.Environment
+    :param db: the dupsort database of the scratch stop index
+    :param frame: the stop_times of the chunk
+    :type frame: pd.core.frame.DataFrame
+    """
+
+    pairs = frame.loc[:, ['stop_id', 'trip_id']].drop_duplicates().values
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))].astype(np.int64)
+    items = [(encode_key(x), encode_key(y)) for x, y in pairs.tolist()]
+
+    def put():
+        with env.begin(write=True) as txn:
+            txn.cursor(db=db).putmulti(items, dupdata=True)
+
+    _retry_map_full(env, env.path(), put)
+
+def _spilled_stop_index_batches(
+        env: lmdb.Environment,
+        db,
+        batch_size: int
+        ) -> Iterator[List[Tuple[int, bytes]]]:
+    """
+    The packed stop index values of the scratch stop index, as
+    write_stop_index_to_archive packs make_stop_index, in batches of
+    about batch_size trip_ids
+
+    :param env: the scratch environment from _ingest_stop_times_chunks
+    :type env: lmdb.Environment
+    :param db: the dupsort database of the scratch stop index
+    :param batch_size: the number of trip_ids in a batch
+    :type batch_size: int
+    :yield: batches of stop_ids and their packed sorted trip_ids
+    :rtype: Iterator[List[Tuple[int, bytes]]]
+    """
+
+    batch = []
+    ntrips = 0
+    with env.begin() as txn:
+        # the pairs are sorted on stop_id and trip_id
+        for key, pairs in groupby(txn.cursor(db=db), key=lambda x: x[0]):
+            trip_ids = [decode_key(x[1]) for x in pairs]
+            batch.append((decode_key(key), msgpack.packb(trip_ids)))
+            ntrips += len(trip_ids)
+            if ntrips >= batch_size:
+                yield batch
+                batch = []
+                ntrips = 0
+    if batch:
+        yield batch
+
+def _ingest_stop_times_chunks(
+        f: IO[bytes],
+        dates: str,
+        writer: ArchiveWriter,
+        chunksize: int
+        ) -> int:
+    """
+    Write stop_times.txt to the archive in chunks of whole trips. The
+    stop_times of each chunk are committed and its column arrays are
+    appended to the column files before the next chunk is read. The
+    unique (stop_id, trip_id) pairs of each chunk are spilled to a
+    scratch lmdb file, stop_trips.part, and the stop index is committed
+    from it in batches once every chunk is read, so memory does not grow
+    with the feed
+
+    :param f: the open stop_times.txt file
+    :type f: IO[bytes]
+    :param dates: a daterange string
+    :type dates: str
+    :param writer: the writer to commit each chunk with
+    :type writer: ArchiveWriter
+    :param chunksize: the number of rows read at a time
+    :type chunksize: int
+    :return: the number of stop_times rows
+    :rtype: int
+    """
+
+    column_dir = Path(ARCHIVE_DIR, dates, STOP_TIME_COLUMNS)
+    column_dir.mkdir(parents=True, exist_ok=True)
+    # the parts of an ingest that did not finish
+    for part in column_dir.glob('*.part'):
+        part.unlink()
+
+    rows = 0
+    scratch = Path(column_dir, f'{STOP_INDEX}.part')
+    # only this ingest uses the scratch file, so it is not locked
+    with lmdb.open(
+            str(scratch), map_size=DB_SIZE, subdir=False, lock=False,
+            max_dbs=1, sync=False, metasync=False
+            ) as env:
+        db = env.open_db(bytes(STOP_INDEX, 'utf-8'), dupsort=True, dupfixed=True)
+        for chunk in read_gtfs_groups(f, 'stop_times.txt', 'trip_id', chunksize):
+            frame = _prepare_stop_times_frame(_add_seconds(chunk))
+            write_stops_times_to_archive(_split_trips(frame), dates, writer=writer)
+            writer.commit(final=False)
+
+            _spill_stop_index(env, db, frame)
+            _append_stop_time_columns(stop_times_to_columns(frame), column_dir, rows)
+            rows += len(frame)
+
+        for batch in _spilled_stop_index_batches(env, db, chunksize):
+            writer.stage(STOP_INDEX, batch)
+            writer.commit(final=False)
+    scratch.unlink()
+
+    _finish_stop_time_columns(column_dir, rows)
+    log.info(f"Stoptimes columns written to archive in : {dates}")
+
+    return rows
+
+def check_stop_times(
+        writer: Optional[ArchiveWriter] = None,
+        processes: Optional[int] = None,
+        chunksize: Optional[int] = None
+        ) -> None:
+    """
+    Read the new stoptimes data and write it and the stop index
+    to the archive
+
+    :param writer: stage the stop_times in this writer instead of
+        committing them, defaults to None
+    :type writer: Optional[ArchiveWriter], optional
+    :param processes: parse stop_times.txt in this many processes,
+        defaults to None - parsed in this process
+    :type processes: Optional[int], optional
+    :param chunksize: read stop_times.txt this many rows at a time and
+        commit the stop_times of each chunk of whole trips with the
+        writer, defaults to None - read the whole file. The rows of each
+        trip must be together in the file
+    :type chunksize: Optional[int], optional
+    :raises ValueError: if both processes and chunksize are given, or the
+        rows of a trip are not together when read in chunks
+    """
+
+    if chunksize is not None and processes is not None and processes > 1:
+        raise ValueError("stop_times can not be read in chunks and in processes")
 
     new_dates = find_date_range(TEMP_DIR)
-    new_stop_times = read_stop_times(new_data)
-    write_stops_times_to_archive(new_stop_times, new_dates)
\ No newline at end of file
+    if chunksize is not None:
+        commit = writer is None
+        if commit:
+            writer = ArchiveWriter(new_dates, replace=True)
+        with open_feed(TEMP_DIR) as feed, feed.open('stop_times.txt') as f:
+            rows = _ingest_stop_times_chunks(f, new_dates, writer, chunksize)
+        if commit:
+            writer.commit()
+        update_catalog(new_dates, rows={'stop_times': rows})
+        return
+
+    with open_feed(TEMP_DIR) as feed:
+        if processes is not None and processes > 1:
+            source = feed.member_path('stop_times.txt')
+            if source is None:
+                with feed.open('stop_times.txt') as f:
+                    source = f.read()
+            frame = read_stop_times_parallel(source, processes=processes)
+        else:
+            with feed.open('stop_times.txt') as f:
+                frame = _read_stop_times_frame(f)
+
+    commit = writer is None
+    if commit:
+        writer = ArchiveWriter(new_dates, replace=True)
+
+    write_stops_times_to_archive(_split_trips(frame), new_dates, writer=writer)
+    write_stop_index_to_archive(make_stop_index(frame), new_dates, writer=writer)
+
+    if commit:
+        writer.commit()
+
+    write_stop_time_columns_to_archive(stop_times_to_columns(frame), new_dates)
+    update_catalog(new_dates, rows={'stop_times': len(frame)})
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures that build small synthetic gtfs feeds and ingest them into an
+archive in a temporary directory, as run.main does without the download,
+the bus mapping and the dwh
+"""
+
+import csv
+import importlib
+import random
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas as pd
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+import departurecache
+from agency import read_agency, write_agency_to_archive
+from calendars import check_calendars
+from routes import read_routes, write_routes_to_archive
+from stops import read_stops, write_stops_to_archive
+from stoptimes import check_stop_times
+from tools import find_date_range, ArchiveStore, ArchiveWriter
+from trips import check_trips
+
+# the modules with their own archive and feed directories
+DIR_MODULES = (
+    'agency', 'benchmarks', 'calendars', 'departures', 'feed', 'getgtfsdata',
+    'routes', 'shapes', 'stops', 'stoptimes', 'tools', 'transfers', 'trips',
+    'validate'
+    )
+
+RAIL_STOPS = [8600600 + i for i in range(30)] + [860430301]
+# bus stops that are mapped to stations in bus_to_station_maps.json
+BUS_STOPS = [
+    50978, 50979, 36805, 1000, 1001, 1002, 1003, 1004, 1005, 1006, 1007
+    ]
+
+T_FEED = Dict[str, List[List[str]]]
+
+
+def make_feed(
+        start: str = '20210104',
+        end: str = '20210131',
+        ntrips: int = 150,
+        seed: int = 1
+        ) -> T_FEED:
+    """
+    A random gtfs feed of rail and bus trips. The rows of each file
+    are lists of strings, the first row is the header
+
+    :param start: the first date of the feed YYYYMMDD
+    :param end: the last date of the feed YYYYMMDD
+    :param ntrips: the number of trips
+    :param seed: the random seed
+    :return: file name -> rows
+    """
+
+    rand = random.Random(seed)
+    feed: T_FEED = {}
+    feed['agency.txt'] = [
+        ['agency_id', 'agency_name', 'agency_url', 'agency_timezone'],
+        ['1', 'DSB', 'http://x', 'Europe/Copenhagen'],
+        ['2', 'Arriva', 'http://x', 'Europe/Copenhagen'],
+        ['3', 'Movia', 'http://x', 'Europe/Copenhagen'],
+        ]
+    feed['routes.txt'] = [
+        ['route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_type']
+        ] + [[f'{r}_1', str(r % 3 + 1), f'R{r}', f'Route {r}', '2'] for r in range(6)]
+    feed['stops.txt'] = [
+        ['stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'location_type']
+        ] + [[str(x), f'Stop {x}', '55.6', '12.5', '0'] for x in RAIL_STOPS + BUS_STOPS]
+    feed['calendar.txt'] = [
+        ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+         'saturday', 'sunday', 'start_date', 'end_date']
+        ] + [[str(s)] + [str(rand.randint(0, 1)) for _ in range(7)] + [start, end]
+             for s in range(1, 16)]
+    days = pd.date_range(start, end, freq='D').strftime('%Y%m%d').tolist()
+    feed['calendar_dates.txt'] = [['service_id', 'date', 'exception_type']] + [
+        [str(rand.randint(1, 18)), rand.choice(days), str(rand.choice([1, 2]))]
+        for _ in range(25)
+        ]
+
+    feed['trips.txt'] = [['route_id', 'service_id', 'trip_id', 'trip_headsign', 'shape_id']]
+    feed['stop_times.txt'] = [[
+        'trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence',
+        'pickup_type', 'drop_off_type'
+        ]]
+    for t in range(ntrips):
+        trip_id = str(1000 + 7 * t)
+        feed['trips.txt'].append([
+            f'{rand.randint(0, 5)}_1', str(rand.randint(1, 18)), trip_id,
+            f'Head {t % 4}', str(t % 5 + 1)
+            ])
+        stops = rand.sample(RAIL_STOPS if t % 2 else BUS_STOPS, rand.randint(2, 8))
+        seconds = rand.randint(4 * 3600, 25 * 3600)
+        for i, stop_id in enumerate(stops):
+            seconds += rand.randint(60, 900)
+            time = f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+            if i == len(stops) - 1:
+                pickup = '1'
+            else:
+                pickup = rand.choice(['0', '0', '0', '1', ''])
+            feed['stop_times.txt'].append(
+                [trip_id, time, time, str(stop_id), str(i), pickup, '0']
+                )
+
+    feed['shapes.txt'] = [
+        ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence']
+        ] + [[str(s), f'55.{rand.randint(100, 999)}', f'12.{rand.randint(100, 999)}', str(i)]
+             for s in range(1, 6) for i in range(rand.randint(2, 6))]
+
+    return feed
+
+
+def write_feed(feed: T_FEED, dirpath: Path) -> Path:
+    """write the feed files to a directory, replacing the txt files there"""
+
+    dirpath.mkdir(parents=True, exist_ok=True)
+    for fp in dirpath.glob('*.txt'):
+        fp.unlink()
+    for name, rows in feed.items():
+        with open(Path(dirpath, name), 'w', newline='') as f:
+            csv.writer(f, lineterminator='\n').writerows(rows)
+
+    return dirpath
+
+
+class Archive:
+    """ingest feeds into the archive of a temporary directory"""
+
+    def __init__(self, root: Path) -> None:
+
+        self.root = root
+        self.archive_dir = Path(root, 'archive')
+        self.temp_dir = Path(root, 'temp_data')
+        self.archive_dir.mkdir()
+        self.temp_dir.mkdir()
+
+    def ingest(
+            self,
+            feed: T_FEED,
+            base: Optional[str] = None,
+            compress: Optional[bool] = False,
+            chunksize: Optional[int] = None,
+            processes: Optional[int] = None
+            ) -> str:
+        """
+        Write the feed to temp_data and archive it
+
+        :return: the date range string of the archive
+        """
+
+        write_feed(feed, self.temp_dir)
+        write_agency_to_archive(read_agency(Path(self.temp_dir, 'agency.txt')))
+        write_routes_to_archive(read_routes(Path(self.temp_dir, 'routes.txt')))
+        write_stops_to_archive(read_stops(Path(self.temp_dir, 'stops.txt')))
+
+        dates = find_date_range()
+        Path(self.archive_dir, dates).mkdir(exist_ok=True)
+        writer = ArchiveWriter(
+            dates, base=base, compress=compress, replace=True
+            )
+        check_stop_times(writer, processes=processes, chunksize=chunksize)
+        check_trips(writer)
+        writer.commit()
+        check_calendars()
+
+        return dates
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    """an empty archive in tmp_path that the modules read and write"""
+
+    out = Archive(tmp_path)
+    for name in DIR_MODULES:
+        module = importlib.import_module(name)
+        if hasattr(module, 'ARCHIVE_DIR'):
+            monkeypatch.setattr(module, 'ARCHIVE_DIR', out.archive_dir)
+        if hasattr(module, 'TEMP_DIR'):
+            monkeypatch.setattr(module, 'TEMP_DIR', out.temp_dir)
+    monkeypatch.setattr(
+        departurecache, 'CACHE_DIR', Path(out.archive_dir, 'departure_cache')
+        )
+    ArchiveStore.close()
+    yield out
+    ArchiveStore.close()
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the departure engines against a synthetic archive
+"""
+
+import random
+import sys
+
+import pandas as pd
+import pytest
+
+import departures
+from conftest import make_feed, BUS_STOPS, RAIL_STOPS
+from departures import (
+    apply_departures_delta, calculate_departures, calculate_departures_between,
+    departures_delta, departures_for, remapped_stations, _parse_args, ENGINES
+    )
+from tools import load_bus_maps, ArchiveStore
+
+KEYS = ['date', 'station', 'hour']
+
+
+def _sorted(frame: pd.core.frame.DataFrame) -> pd.core.frame.DataFrame:
+    """the frame sorted on its keys with its columns in name order"""
+
+    frame = frame.loc[:, KEYS + sorted(x for x in frame.columns if x not in KEYS)]
+
+    return frame.sort_values(KEYS).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('engine', [x for x in ENGINES if x != 'records'])
+def test_engines_match_records(archive, engine):
+
+    dates = archive.ingest(make_feed())
+
+    expected = calculate_departures(dates, engine='records')
+    result = calculate_departures(dates, engine=engine)
+
+    for left, right in zip(expected, result):
+        assert not left.empty
+        pd.testing.assert_frame_equal(_sorted(left), _sorted(right))
+
+
+@pytest.mark.parametrize('engine', [x for x in ENGINES if x != 'records'])
+def test_engines_match_records_with_missing_times(archive, engine):
+
+    feed = make_feed()
+    header = feed['stop_times.txt'][0]
+    columns = [header.index(x) for x in ('arrival_time', 'departure_time')]
+    pickup = header.index('pickup_type')
+    blank = [x for x in feed['stop_times.txt'][1:] if x[pickup] == '0'][::5]
+    for row in blank:
+        for column in columns:
+            row[column] = ''
+    dates = archive.ingest(feed)
+
+    expected = calculate_departures(dates, engine='records')
+    result = calculate_departures(dates, engine=engine)
+
+    for left, right in zip(expected, result):
+        assert not left.empty
+        pd.testing.assert_frame_equal(_sorted(left), _sorted(right))
+
+
+def test_stream_processes_match_serial(archive):
+
+    dates = archive.ingest(make_feed())
+
+    expected = calculate_departures(dates, engine='stream')
+    result = calculate_departures(dates, engine='stream', processes=2)
+
+    for left, right in zip(expected, result):
+        pd.testing.assert_frame_equal(_sorted(left), _sorted(right))
+
+
+@pytest.mark.parametrize('engine', ['records', 'sparse'])
+def test_processes_only_for_stream(archive, engine):
+
+    dates = archive.ingest(make_feed())
+
+    with pytest.raises(ValueError):
+        calculate_departures(dates, engine=engine, processes=2)
+
+
+@pytest.mark.parametrize('processes', [None, 2])
+def test_cached_counts_match(archive, processes):
+
+    dates = archive.ingest(make_feed())
+
+    expected = calculate_departures(dates, engine='stream')
+    for _ in range(2):
+        result = calculate_departures(
+            dates, engine='stream', processes=processes, cache=True
+            )
+        for left, right in zip(expected, result):
+            pd.testing.assert_frame_equal(_sorted(left), _sorted(right))
+
+
+def _next_feed(feed, start='20210118', end='20210214', seed=3):
+    """the feed re-published for a later, overlapping period with some
+    trips retimed, removed and added and some services changed"""
+
+    rand = random.Random(seed)
+    feed = {k: [list(x) for x in v] for k, v in feed.items()}
+    for row in feed['calendar.txt'][1:]:
+        row[-2:] = [start, end]
+    feed['calendar.txt'][3][1:8] = ['1'] * 7
+    feed['calendar_dates.txt'] += [['5', '20210125', '1'], ['7', '20210127', '2']]
+
+    trips = [x[2] for x in feed['trips.txt'][1:]]
+    retimed = set(rand.sample(trips, 8))
+    removed = set(rand.sample(trips, 3)) - retimed
+    stop_times = [feed['stop_times.txt'][0]]
+    for row in feed['stop_times.txt'][1:]:
+        if row[0] in removed:
+            continue
+        if row[0] in retimed:
+            h, m, sec = row[2].split(':')
+            row[1] = row[2] = f'{int(h) + 3:02d}:{m}:{sec}'
+        stop_times.append(row)
+    stop_times += [
+        ['999999', '23:50:00', '23:50:00', '8600601', '0', '0', '0'],
+        ['999999', '24:10:00', '24:10:00', '8600602', '1', '0', '0'],
+        ['999999', '24:20:00', '24:20:00', '8600603', '2', '1', '0'],
+        ]
+    feed['stop_times.txt'] = stop_times
+    feed['trips.txt'] = [
+        x for x in feed['trips.txt'] if x[2] not in removed
+        ] + [['1_1', '3', '999999', 'Head x', '1']]
+
+    return feed
+
+
+def _dwh_frame(frame, columns):
+    """a dwh frame with the given count columns, sorted on its keys"""
+
+    frame = frame.reindex(columns=KEYS + columns).fillna(0)
+
+    return _sorted(frame.astype(int))
+
+
+def test_delta_matches_full_recount(archive):
+
+    feed = make_feed()
+    first = archive.ingest(feed)
+    delta = departures_delta(first)
+    dwh = [
+        apply_departures_delta(x.iloc[:0], x, delta.cells, delta.dates) for
+        x in (delta.rail, delta.bus)
+        ]
+
+    second = archive.ingest(_next_feed(feed))
+    delta = departures_delta(second)
+    assert delta.cells
+    # writing a delta again does not change the dwh
+    for _ in range(2):
+        dwh = [
+            apply_departures_delta(x, rows, delta.cells, delta.dates) for
+            x, rows in zip(dwh, (delta.rail, delta.bus))
+            ]
+
+    end = (pd.Timestamp(second[9:]) + pd.Timedelta(1, unit='D')).strftime('%Y%m%d')
+    expected = calculate_departures_between(first[:8], end)
+    for left, right in zip(expected, dwh):
+        assert not left.empty
+        columns = sorted((set(left.columns) | set(right.columns)) - set(KEYS))
+        pd.testing.assert_frame_equal(
+            _dwh_frame(left, columns), _dwh_frame(right, columns)
+            )
+
+
+def test_delta_counts_remapped_stations_again(archive, monkeypatch):
+
+    feed = make_feed()
+    first = archive.ingest(feed)
+    delta = departures_delta(first)
+    dwh = [
+        apply_departures_delta(x.iloc[:0], x, delta.cells, delta.dates) for
+        x in (delta.rail, delta.bus)
+        ]
+
+    old_maps = load_bus_maps()
+    new_maps = dict(old_maps)
+    stop_id = next(x for x in BUS_STOPS if x in old_maps)
+    new_maps[stop_id] = RAIL_STOPS[-2]
+    monkeypatch.setattr(departures, 'load_bus_maps', lambda: new_maps)
+    stations = remapped_stations(old_maps, new_maps)
+    assert stations == {old_maps[stop_id], RAIL_STOPS[-2]}
+
+    second = archive.ingest(_next_feed(feed))
+    delta = departures_delta(second, stations=stations)
+    dwh = [
+        apply_departures_delta(x, rows, delta.cells, delta.dates) for
+        x, rows in zip(dwh, (delta.rail, delta.bus))
+        ]
+
+    # the dates of the first archive only keep the old map
+    start = int(second[:8])
+    end = (pd.Timestamp(second[9:]) + pd.Timedelta(1, unit='D')).strftime('%Y%m%d')
+    expected = calculate_departures_between(first[:8], end)
+    for left, right in zip(expected, dwh):
+        left = left.loc[left['date'] >= start]
+        right = right.loc[right['date'] >= start]
+        columns = sorted((set(left.columns) | set(right.columns)) - set(KEYS))
+        pd.testing.assert_frame_equal(
+            _dwh_frame(left, columns), _dwh_frame(right, columns)
+            )
+
+
+def _between(frame, stations, start, end):
+    """the rows of the stations from start to end"""
+
+    keep = frame.loc[:, 'station'].isin(stations) & \
+        frame.loc[:, 'date'].between(start, end)
+
+    return frame.loc[keep]
+
+
+def _fail(*args, **kwargs):
+    raise AssertionError("the whole index is read")
+
+
+def test_departures_for_matches_full_count(archive, monkeypatch):
+
+    dates = archive.ingest(make_feed())
+    stations = set(RAIL_STOPS[:3]) | set(list(load_bus_maps().values())[:2])
+
+    expected = calculate_departures(dates)
+    # only the trips of the stations are looked up
+    monkeypatch.setattr(ArchiveStore, 'indexed_stops', _fail)
+    monkeypatch.setattr(ArchiveStore, 'load_service_trips', _fail)
+    load_trip_route = ArchiveStore.load_trip_route
+
+    def trip_route(dates=None, txn=None, trip_ids=None):
+        assert trip_ids is not None
+        return load_trip_route(dates=dates, txn=txn, trip_ids=trip_ids)
+
+    monkeypatch.setattr(ArchiveStore, 'load_trip_route', trip_route)
+    result = departures_for(stations, 20210110, 20210117, dates=dates)
+
+    for left, right in zip(expected, result):
+        left = _between(left, stations, 20210110, 20210117)
+        assert not left.empty
+        assert set(right.loc[:, 'station']) <= stations
+        columns = sorted((set(left.columns) | set(right.columns)) - set(KEYS))
+        pd.testing.assert_frame_equal(
+            _dwh_frame(left, columns), _dwh_frame(right, columns)
+            )
+
+    days = departures_for(
+        stations, 20210110, 20210117, granularity='day', dates=dates
+        )
+    for hours, day in zip(result, days):
+        assert 'hour' not in day.columns
+        expected_days = hours.drop('hour', axis=1).groupby(
+            ['date', 'station'], as_index=False
+            ).sum()
+        pd.testing.assert_frame_equal(
+            expected_days.reset_index(drop=True), day.reset_index(drop=True)
+            )
+
+
+def test_departures_for_granularity(archive):
+
+    dates = archive.ingest(make_feed())
+
+    with pytest.raises(ValueError):
+        departures_for(RAIL_STOPS[:1], 20210110, 20210117, granularity='week', dates=dates)
+
+
+def test_parse_args(monkeypatch):
+
+    monkeypatch.setattr(sys, 'argv', [
+        'departures.py', '8600626', '8600650', '--start', '20210110',
+        '--end', '20210117', '--granularity', 'day'
+        ])
+    args = _parse_args()
+
+    assert args.stations == [8600626, 8600650]
+    assert (args.start, args.end) == ('20210110', '20210117')
+    assert args.granularity == 'day'
+    assert args.dates is None
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the conditional and resumed gtfs download against a local
+http server
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+from feed import GTFS_ZIP
+from getgtfsdata import download_gtfs, _load_state, _save_state
+
+BODY = bytes(range(256)) * 400
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    """serve BODY with an ETag, If-None-Match and Range/If-Range"""
+
+    def do_GET(self):
+
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range') == server.etag:
+            start = int(byte_range[len('bytes='):].rstrip('-')) + server.skew
+            self.send_response(206)
+            self.send_header(
+                'Content-Range', f'bytes {start}-{len(BODY) - 1}/{len(BODY)}'
+                )
+            body = BODY[start:]
+        else:
+            self.send_response(200)
+            body = BODY
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    """a local http server of the feed"""
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+    httpd.etag = '"v1"'
+    httpd.skew = 0
+    httpd.requests = []
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}/{GTFS_ZIP}'
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _partial(dirpath: Path, size: int, etag: str) -> None:
+    """an interrupted download of the first size bytes of the feed"""
+
+    Path(dirpath, GTFS_ZIP + '.part').write_bytes(BODY[:size])
+    _save_state(dirpath, {'partial': {'etag': etag, 'last_modified': None}})
+
+
+def test_not_modified(server, tmp_path):
+
+    assert download_gtfs(server.url, tmp_path) == Path(tmp_path, GTFS_ZIP)
+    assert download_gtfs(server.url, tmp_path) is None
+
+    assert server.requests[-1]['If-None-Match'] == server.etag
+    assert Path(tmp_path, GTFS_ZIP).read_bytes() == BODY
+
+
+def test_resume_partial_download(server, tmp_path):
+
+    _partial(tmp_path, 1000, server.etag)
+
+    path = download_gtfs(server.url, tmp_path)
+
+    assert server.requests[-1]['Range'] == 'bytes=1000-'
+    assert server.requests[-1]['If-Range'] == server.etag
+    assert path.read_bytes() == BODY
+    assert not Path(tmp_path, GTFS_ZIP + '.part').exists()
+    assert 'partial' not in _load_state(tmp_path)
+
+
+def test_changed_etag_downloads_whole_feed(server, tmp_path):
+
+    _partial(tmp_path, 1000, '"v0"')
+
+    path = download_gtfs(server.url, tmp_path)
+
+    assert len(server.requests) == 1
+    assert server.requests[0]['If-Range'] == '"v0"'
+    assert path.read_bytes() == BODY
+    assert _load_state(tmp_path)['etag'] == server.etag
+
+
+def test_partial_response_at_other_offset_restarts(server, tmp_path):
+
+    _partial(tmp_path, 1000, server.etag)
+    server.skew = -10
+
+    path = download_gtfs(server.url, tmp_path)
+
+    assert len(server.requests) == 2
+    assert 'Range' not in server.requests[1]
+    assert path.read_bytes() == BODY
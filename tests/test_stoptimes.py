@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the stop_times readers and ingest
+"""
+
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import make_feed, write_feed
+from schema import read_gtfs_groups
+from stoptimes import _read_stop_times_frame, read_stop_times_parallel
+from tools import ArchiveReader, ArchiveStore, STOP_TIME_COLUMNS
+
+DB_NAMES = ('stop_times', 'stop_trips', 'trips', 'trip_route', 'service_trips')
+
+
+def test_parallel_read_matches_serial(tmp_path):
+
+    fp = write_feed(make_feed(), tmp_path) / 'stop_times.txt'
+    with open(fp, 'rb') as f:
+        expected = _read_stop_times_frame(f)
+
+    for source in (fp, fp.read_bytes()):
+        result = read_stop_times_parallel(source, processes=2)
+        pd.testing.assert_frame_equal(expected, result)
+
+
+def test_missing_pickup_type_is_not_regular(tmp_path):
+
+    feed = make_feed()
+    header = feed['stop_times.txt'][0]
+    column = header.index('pickup_type')
+    fp = write_feed(feed, tmp_path) / 'stop_times.txt'
+    with open(fp, 'rb') as f:
+        df = _read_stop_times_frame(f)
+
+    missing = [x[column] == '' for x in feed['stop_times.txt'][1:]]
+    assert any(missing)
+    assert (df.loc[missing, 'pickup_type'] == -1).all()
+    assert (df.loc[[not x for x in missing], 'pickup_type'] >= 0).all()
+
+
+def test_missing_stop_id_is_zero(tmp_path):
+
+    feed = make_feed()
+    header = feed['stop_times.txt'][0]
+    column = header.index('stop_id')
+    feed['stop_times.txt'][1][column] = ''
+    feed['stop_times.txt'][2][column] = 'G' + feed['stop_times.txt'][2][column]
+    fp = write_feed(feed, tmp_path) / 'stop_times.txt'
+    with open(fp, 'rb') as f:
+        df = _read_stop_times_frame(f)
+
+    assert df.loc[0, 'stop_id'] == 0
+    assert df.loc[1, 'stop_id'] == int(feed['stop_times.txt'][2][column][1:])
+    assert df.loc[:, 'stop_id'].dtype == np.int64
+
+
+def test_header_only_file_has_no_groups(tmp_path):
+
+    feed = make_feed()
+    feed['stop_times.txt'] = feed['stop_times.txt'][:1]
+    fp = write_feed(feed, tmp_path) / 'stop_times.txt'
+
+    assert list(read_gtfs_groups(fp, 'stop_times.txt', 'trip_id', 10)) == []
+
+
+def _drop_trips(feed, trip_ids):
+    """the feed without some trips"""
+
+    feed = dict(feed)
+    for name in ('trips.txt', 'stop_times.txt'):
+        header = feed[name][0]
+        column = header.index('trip_id')
+        feed[name] = [header] + [x for x in feed[name][1:] if x[column] not in trip_ids]
+
+    return feed
+
+
+def _snapshot(archive, dates):
+    """the values of the archive databases, the stop_times columns and
+    the archive hash"""
+
+    reader = ArchiveReader(dates)
+    try:
+        values = {
+            x: {k: bytes(v) for k, v in reader.iterate(x)} for x in DB_NAMES
+            }
+    finally:
+        reader.close()
+    column_dir = Path(archive.archive_dir, dates, STOP_TIME_COLUMNS)
+    columns = {x.name: np.load(x) for x in sorted(column_dir.glob('*.npy'))}
+    assert not list(column_dir.glob('*.part'))
+
+    return values, columns, ArchiveStore.archive_hash(dates)
+
+
+def _assert_same(left, right):
+
+    assert left[0] == right[0]
+    assert left[1].keys() == right[1].keys()
+    for name, values in left[1].items():
+        np.testing.assert_array_equal(values, right[1][name])
+    assert left[2] == right[2]
+
+
+def _remove(archive, dates):
+
+    ArchiveStore.close()
+    shutil.rmtree(Path(archive.archive_dir, dates))
+
+
+@pytest.mark.parametrize('mode', ['full', 'delta', 'zstd'])
+def test_chunked_ingest_matches_whole_file(archive, mode):
+
+    base = None
+    if mode == 'delta':
+        base = archive.ingest(make_feed(start='20201201', end='20210110'))
+    feed = make_feed()
+    changed = _drop_trips(feed, {'1000', '1007', '1700'})
+    kwargs = {'base': base, 'compress': mode == 'zstd'}
+
+    dates = archive.ingest(feed, **kwargs)
+    whole = _snapshot(archive, dates)
+    _remove(archive, dates)
+    archive.ingest(feed, chunksize=50, **kwargs)
+    _assert_same(whole, _snapshot(archive, dates))
+
+    # the trips dropped from a re-published feed are deleted in chunks too
+    archive.ingest(changed, chunksize=50, **kwargs)
+    chunked = _snapshot(archive, dates)
+    assert 1000 not in chunked[0]['stop_times']
+    _remove(archive, dates)
+    archive.ingest(changed, **kwargs)
+    _assert_same(_snapshot(archive, dates), chunked)
+
+
+def test_split_trip_is_not_read_in_chunks(tmp_path):
+
+    feed = make_feed()
+    header, rows = feed['stop_times.txt'][0], feed['stop_times.txt'][1:]
+    # the first stop of the first trip after every other trip
+    feed['stop_times.txt'] = [header] + rows[1:] + rows[:1]
+    fp = write_feed(feed, tmp_path) / 'stop_times.txt'
+
+    with pytest.raises(ValueError):
+        list(read_gtfs_groups(fp, 'stop_times.txt', 'trip_id', 20))
+
+
+def test_parallel_ingest_matches_whole_file(archive):
+
+    feed = make_feed()
+    dates = archive.ingest(feed)
+    whole = _snapshot(archive, dates)
+    _remove(archive, dates)
+
+    archive.ingest(feed, processes=2)
+    _assert_same(whole, _snapshot(archive, dates))
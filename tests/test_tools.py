@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the archive writer and reader
+"""
+
+import random
+from pathlib import Path
+
+import lmdb
+import msgpack
+import pandas as pd
+import pytest
+
+import tools
+from conftest import make_feed
+from stoptimes import write_stops_times_to_archive
+from tools import (
+    load_catalog, make_service_dates, migrate_archive_keys, previous_archive,
+    _archive_file_sizes, _write_catalog, ArchiveReader, ArchiveStore,
+    ArchiveWriter, MAX_ENVIRONMENTS
+    )
+
+
+def _drop_trip(feed, trip_id):
+    """the feed without a trip"""
+
+    feed = dict(feed)
+    for name in ('trips.txt', 'stop_times.txt'):
+        header = feed[name][0]
+        column = header.index('trip_id')
+        feed[name] = [header] + [x for x in feed[name][1:] if x[column] != trip_id]
+
+    return feed
+
+
+def test_reingest_deletes_dropped_trips(archive):
+
+    feed = make_feed()
+    dates = archive.ingest(feed)
+    assert 1000 in ArchiveStore.load_trips(dates)
+
+    archive.ingest(_drop_trip(feed, '1000'))
+
+    assert 1000 not in ArchiveStore.load_trips(dates)
+    assert 1000 not in ArchiveStore.load_stop_times(dates)
+    assert 1000 not in ArchiveStore.load_trip_route(dates)
+    assert 1000 not in set().union(*ArchiveStore.load_service_trips(dates).values())
+    assert len(ArchiveStore.load_trips(dates)) == len(feed['trips.txt']) - 2
+
+
+def test_standalone_write_keeps_other_keys(archive):
+
+    feed = make_feed()
+    dates = archive.ingest(feed)
+    stop_times = ArchiveStore.load_stop_times(dates)
+    trip_id = min(stop_times)
+    retimed = {
+        trip_id: {k: dict(v, departure_seconds=0) for k, v in stop_times[trip_id].items()}
+        }
+
+    write_stops_times_to_archive(retimed, dates)
+
+    result = ArchiveStore.load_stop_times(dates)
+    assert result == {**stop_times, **retimed}
+
+
+@pytest.mark.parametrize('chunksize', [None, 50])
+def test_indexes_match_scan(archive, chunksize):
+
+    dates = archive.ingest(make_feed(), chunksize=chunksize)
+    stop_times = ArchiveStore.load_stop_times(dates)
+    trips = ArchiveStore.load_trips(dates)
+
+    stop_trips = {}
+    for trip_id, stops in stop_times.items():
+        for x in stops.values():
+            stop_trips.setdefault(x['stop_id'], set()).add(trip_id)
+    service_trips = {}
+    for trip_id, x in trips.items():
+        service_trips.setdefault(x['service_id'], set()).add(trip_id)
+
+    assert ArchiveStore.indexed_stops(dates) == tuple(sorted(stop_trips))
+    with ArchiveStore.read_transaction(dates) as txn:
+        for stop_id, trip_ids in stop_trips.items():
+            assert ArchiveStore.trips_for_stop(stop_id, dates, txn=txn) == \
+                tuple(sorted(trip_ids))
+        for service_id, trip_ids in service_trips.items():
+            assert ArchiveStore.trips_for_service(service_id, dates, txn=txn) == \
+                tuple(sorted(trip_ids))
+    assert ArchiveStore.trips_for_stop(1, dates) == ()
+    assert ArchiveStore.trips_for_service(999999, dates) == ()
+    assert ArchiveStore.load_service_trips(dates) == {
+        k: tuple(sorted(v)) for k, v in service_trips.items()
+        }
+
+
+def _baseline_services(calendar, calendar_dates, date):
+    """the services running on a date as create_day_schedule found them
+    from the calendar and calendar_dates before the service dates"""
+
+    weekday = date.strftime("%A").lower()
+    date_int = int(date.strftime('%Y%m%d'))
+    services = {k for k, v in calendar.items() if v[weekday] == 1}
+    added = set()
+    removed = set()
+    for service_id, exceptions in calendar_dates.items():
+        for exception in exceptions:
+            if exception[0] != date_int:
+                continue
+            if exception[1] == 1:
+                added.add(service_id)
+            elif exception[1] == 2:
+                removed.add(service_id)
+
+    return services.union(added) - removed
+
+
+def test_service_dates_match_calendar(archive):
+
+    feed = make_feed()
+    weekly = next(x for x in feed['calendar.txt'][1:] if x[1] == '1')
+    # a monday removal, and an addition and removal of the same date
+    feed['calendar_dates.txt'] += [
+        [weekly[0], '20210111', '2'],
+        ['4', '20210113', '1'],
+        ['4', '20210113', '2'],
+        ]
+    dates = archive.ingest(feed)
+    calendar = ArchiveStore.load_calendar(dates)
+    calendar_dates = ArchiveStore.load_calendar_dates(dates)
+
+    built = make_service_dates(calendar, calendar_dates, dates)
+    stored = ArchiveStore.load_service_dates(dates)
+    for date in pd.date_range(dates[:8], dates[9:], freq='D'):
+        expected = _baseline_services(calendar, calendar_dates, date)
+        date_int = int(date.strftime('%Y%m%d'))
+        assert built.services_on(date_int) == expected
+        assert stored.services_on(date_int) == expected
+    assert int(weekly[0]) not in built.services_on(20210111)
+    assert 4 not in built.services_on(20210113)
+    assert built.services_on(20200101) == set()
+
+
+LEGACY_DBS = ('stop_times', 'trips', 'trip_route', 'stop_trips', 'service_trips')
+
+
+def _legacy_archive(archive, dates, name):
+    """a copy of the databases of an archive with the utf-8 string keys
+    of the archives written before big-endian keys"""
+
+    values = {}
+    reader = ArchiveReader(dates)
+    try:
+        for db_name in LEGACY_DBS:
+            values[db_name] = [(k, bytes(v)) for k, v in reader.iterate(db_name)]
+    finally:
+        reader.close()
+
+    path = Path(archive.archive_dir, name)
+    path.mkdir()
+    with lmdb.open(str(path), map_size=tools.DB_SIZE, max_dbs=tools.MAX_DBS) as env:
+        with env.begin(write=True) as txn:
+            for db_name, items in values.items():
+                db = env.open_db(bytes(db_name, 'utf-8'), txn=txn)
+                for k, v in items:
+                    txn.put(bytes(str(k), 'utf-8'), v, db=db)
+
+
+def _loaded(dates):
+    """the archive as read by the load methods"""
+
+    return (
+        ArchiveStore.load_stop_times(dates),
+        ArchiveStore.load_trips(dates),
+        ArchiveStore.load_trip_route(dates),
+        ArchiveStore.load_service_trips(dates),
+        {
+            x: ArchiveStore.trips_for_stop(x, dates) for
+            x in ArchiveStore.indexed_stops(dates)
+            },
+        )
+
+
+def test_migrate_legacy_keys(archive):
+
+    dates = archive.ingest(make_feed())
+    expected = _loaded(dates)
+    legacy = '20200101_20200131'
+    _legacy_archive(archive, dates, legacy)
+
+    reader = ArchiveReader(legacy)
+    try:
+        assert reader.legacy_keys
+    finally:
+        reader.close()
+    assert _loaded(legacy) == expected
+
+    migrate_archive_keys(legacy)
+    reader = ArchiveReader(legacy)
+    try:
+        assert not reader.legacy_keys
+        assert [k for k, _ in reader.iterate('stop_times')] == sorted(expected[0])
+    finally:
+        reader.close()
+    assert ArchiveStore.read_meta(legacy, b'key_format') == tools.KEY_FORMAT
+    assert _loaded(legacy) == expected
+
+    # a migrated archive is left unchanged
+    migrate_archive_keys(legacy)
+    assert _loaded(legacy) == expected
+
+
+def test_environment_in_use_is_not_evicted(archive):
+
+    names = [f'202101{i:02d}_202102{i:02d}' for i in range(1, MAX_ENVIRONMENTS + 3)]
+    for name in names:
+        writer = ArchiveWriter(name)
+        writer.stage('stop_times', [(1, msgpack.packb({0: {'stop_id': 1}}))])
+        writer.commit()
+
+    stop_times = ArchiveStore.lazy_stop_times(names[0])
+    for name in names[1:]:
+        ArchiveStore.environment(name)
+    assert len(ArchiveStore._environments) == MAX_ENVIRONMENTS
+    # the environment of the open mapping was not closed
+    assert dict(stop_times) == {1: {0: {'stop_id': 1}}}
+
+    # and is the least recently used once it is released
+    stop_times.close()
+    ArchiveStore.environment(names[1])
+    assert names[0] not in ArchiveStore._environments
+    assert len(ArchiveStore._environments) == MAX_ENVIRONMENTS
+
+
+def test_catalog_file_sizes_after_commit(archive):
+
+    dates = archive.ingest(make_feed())
+    writer = ArchiveWriter(dates)
+    writer.stage('extra', ((k, bytes(4096)) for k in range(256)))
+    writer.commit()
+
+    entry = load_catalog()['archives'][dates]
+    assert entry['files'] == _archive_file_sizes(dates)
+    assert not list(archive.archive_dir.glob('*.tmp'))
+
+
+def test_resolve_archives_without_catalog_files(archive):
+
+    dates = archive.ingest(make_feed())
+    catalog = load_catalog()
+    catalog['archives'][dates]['files'] = {}
+    _write_catalog(catalog)
+
+    resolved = ArchiveStore.resolve_archives(dates[:8], dates[9:])
+    assert list(resolved) == [dates]
+    assert previous_archive('20990101_20990131') == dates
+
+
+def test_dictionary_trained_once_when_map_full(archive, monkeypatch):
+
+    calls = []
+    train = tools._train_zstd_dictionary
+    monkeypatch.setattr(tools, 'DB_SIZE', 256 * 1024)
+    monkeypatch.setattr(
+        tools, '_train_zstd_dictionary', lambda x: calls.append(1) or train(x)
+        )
+    rand = random.Random(0)
+    values = {
+        k: msgpack.packb([rand.randint(0, 100) for _ in range(200)]) for
+        k in range(2000)
+        }
+
+    dates = '20210101_20210131'
+    writer = ArchiveWriter(dates, compress=True)
+    writer.stage('values', values.items())
+    writer.commit()
+
+    assert len(calls) == 1
+    reader = ArchiveReader(dates)
+    try:
+        assert all(reader.get('values', k) == v for k, v in values.items())
+    finally:
+        reader.close()
+
+
+def test_commits_in_parts(archive):
+
+    dates = '20210101_20210131'
+    values = lambda keys: ((k, msgpack.packb(k)) for k in keys)
+
+    writer = ArchiveWriter(dates, replace=True)
+    writer.stage('values', values(range(10)))
+    writer.commit()
+    digest = ArchiveStore.read_meta(dates, b'hash:values')
+
+    # an ingest in parts that did not finish
+    writer = ArchiveWriter(dates, replace=True)
+    writer.stage('values', values([1, 2]))
+    writer.commit(final=False)
+
+    writer = ArchiveWriter(dates, replace=True)
+    writer.stage('values', values([3, 12]))
+    writer.commit(final=False)
+    # the content hash is only updated by the final commit
+    assert ArchiveStore.read_meta(dates, b'hash:values') == digest
+    writer.stage('values', values([4]))
+    writer.commit()
+
+    reader = ArchiveReader(dates)
+    try:
+        assert [k for k, _ in reader.iterate('values')] == [3, 4, 12]
+    finally:
+        reader.close()
+    with ArchiveStore.read_transaction(dates) as txn:
+        env = ArchiveStore.environment(dates)
+        ingest_db = env.open_db(b'values_ingest', txn=txn, create=False)
+        assert txn.stat(ingest_db)['entries'] == 0
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the transfers reader
+"""
+
+import io
+
+from transfers import read_transfers
+
+
+def test_prefixed_stop_ids_are_read():
+
+    f = io.BytesIO(
+        b"from_stop_id,to_stop_id,transfer_type,min_transfer_time\n"
+        b"G8600626,G8600627,2,120\n"
+        b"8600001,8600002,,\n"
+        )
+
+    assert read_transfers(f) == {
+        (8600626, 8600627): {'transfer_type': 2, 'min_transfer_time': 120},
+        (8600001, 8600002): {'transfer_type': 0, 'min_transfer_time': 0},
+        }
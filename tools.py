@@ -5,24 +5,284 @@ Created on Tue Dec  1 14:28:34 2020
 @author: alkj
 """
 
+import hashlib
+import heapq
 import json
+import logging
+import os
+import re
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
 from pathlib import Path
 from itertools import chain
-from typing import Optional, Dict, Union
+from typing import (
+    Optional, Dict, Union, NamedTuple, Set, Tuple, Iterable, Iterator,
+    Callable, Any, List
+    )
 
 import lmdb
 import msgpack
+import numpy as np
 import pandas as pd
 
+from feed import open_feed
+from schema import read_gtfs
+
+log = logging.getLogger(__name__)
+
 THIS_DIR = Path(__file__).parent
 ARCHIVE_DIR = Path(THIS_DIR, 'archive')
 TEMP_DIR = Path(THIS_DIR, 'temp_data')
 
 DB_SIZE = 1 * 1024 * 1024 * 1024
+MAX_DBS = 16
+MAX_ENVIRONMENTS = 8
+
+META_DB = b'meta'
+KEY_FORMAT = b'uint64be'
+KEY_STRUCT = struct.Struct('>Q')
+
+STOP_TIME_COLUMNS = 'stop_times_columns'
+SERVICE_INDEX = 'service_trips'
+STOP_INDEX = 'stop_trips'
+SERVICE_DATES = 'service_dates.npz'
+
+ZSTD = b'zstd'
+ZSTD_LEVEL = 3
+ZSTD_DICT_SIZE = 112640
+ZSTD_SAMPLES = 20000
+
+CATALOG = 'catalog.json'
+ARCHIVE_NAME = re.compile(r'^\d{8}_\d{8}$')
+
+WEEKDAYS = (
+    'monday', 'tuesday', 'wednesday',
+    'thursday', 'friday', 'saturday', 'sunday'
+    )
+
+def load_catalog() -> Dict[str, Any]:
+    """
+    Load the archive catalog. The catalog records the date range of the
+    current feed and each date range archive with its feed hash, row
+    counts and file sizes
+
+    :return: the catalog
+    :rtype: Dict[str, Any]
+    """
+
+    fp = Path(ARCHIVE_DIR, CATALOG)
+    if not fp.is_file():
+        return {'current': None, 'archives': {}}
+
+    with open(fp, 'r') as f:
+        return json.load(f)
+
+
+def _write_catalog(catalog: Dict[str, Any]) -> None:
+    """
+    Atomically replace the archive catalog
+
+    :param catalog: the catalog
+    :type catalog: Dict[str, Any]
+    """
+
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    # a temporary file of its own, so concurrent writers do not share it
+    f = tempfile.NamedTemporaryFile(
+        'w', dir=ARCHIVE_DIR, prefix=CATALOG, suffix='.tmp', delete=False
+        )
+    try:
+        with f:
+            json.dump(catalog, f, indent=4)
+        os.replace(f.name, Path(ARCHIVE_DIR, CATALOG))
+    except BaseException:
+        Path(f.name).unlink(missing_ok=True)
+        raise
+
+
+def _archive_file_sizes(dates: str) -> Dict[str, int]:
+    """
+    The size in bytes of each file in the archive of the date range
+
+    :param dates: the date range string YYYYMMDD_YYYYMMDD
+    :type dates: str
+    :return: relative file path -> size
+    :rtype: Dict[str, int]
+    """
+
+    path = Path(ARCHIVE_DIR, dates)
+    if not path.is_dir():
+        return {}
+
+    return {
+        x.relative_to(path).as_posix(): x.stat().st_size for
+        x in sorted(path.rglob('*')) if x.is_file() and x.name != 'lock.mdb'
+        }
+
+
+def hash_feed(dirpath: Optional[Path] = None) -> str:
+    """
+    A content hash of the gtfs text files. The hash is the same for a
+    zipped and an extracted feed
+
+    :param dirpath: the directory of the gtfs feed, defaults to None
+    :type dirpath: Optional[Path], optional
+    :return: the hex digest of the feed
+    :rtype: str
+    """
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open_feed(dirpath) as feed:
+        for name in feed.members():
+            if not name.endswith('.txt'):
+                continue
+            digest.update(name.encode())
+            with feed.open(name) as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def update_catalog(
+        dates: str,
+        rows: Optional[Dict[str, int]] = None,
+        feed_hash: Optional[str] = None
+        ) -> Dict[str, Any]:
+    """
+    Record an archive in the catalog. The file sizes are always
+    refreshed, the row counts are merged with those already recorded
+
+    :param dates: the date range string YYYYMMDD_YYYYMMDD
+    :type dates: str
+    :param rows: row counts of the gtfs files in the archive,
+        defaults to None
+    :type rows: Optional[Dict[str, int]], optional
+    :param feed_hash: the content hash of the feed, defaults to None
+    :type feed_hash: Optional[str], optional
+    :return: the catalog entry of the archive
+    :rtype: Dict[str, Any]
+    """
+
+    catalog = load_catalog()
+    entry = catalog['archives'].setdefault(
+        dates, {'dates': dates, 'feed_hash': None, 'rows': {}, 'files': {}}
+        )
+    if rows:
+        entry['rows'].update(rows)
+    if feed_hash:
+        entry['feed_hash'] = feed_hash
+    entry['files'] = _archive_file_sizes(dates)
+    entry['updated'] = datetime.now().isoformat(timespec='seconds')
+
+    _write_catalog(catalog)
+
+    return entry
+
+
+def _refresh_catalog_files(dates: str) -> None:
+    """refresh the file sizes of an archive that is in the catalog"""
+
+    catalog = load_catalog()
+    entry = catalog['archives'].get(dates)
+    if entry is None:
+        return
+    entry['files'] = _archive_file_sizes(dates)
+    entry['updated'] = datetime.now().isoformat(timespec='seconds')
+    _write_catalog(catalog)
+
+
+def list_archives() -> List[Dict[str, Any]]:
+    """
+    List the date range archives, oldest first. Archives written before
+    the catalog existed are listed with only their dates and files
+
+    :return: the catalog entry of each archive
+    :rtype: List[Dict[str, Any]]
+    """
+
+    archives = dict(load_catalog()['archives'])
+    if ARCHIVE_DIR.is_dir():
+        for path in ARCHIVE_DIR.iterdir():
+            if path.is_dir() and ARCHIVE_NAME.match(path.name) and \
+                    path.name not in archives:
+                archives[path.name] = {
+                    'dates': path.name,
+                    'feed_hash': None,
+                    'rows': {},
+                    'files': _archive_file_sizes(path.name)
+                    }
+
+    return [archives[k] for k in sorted(archives)]
+
+
+def has_lmdb(dates: str) -> bool:
+    """
+    Whether the archive of the date range has an lmdb environment. The
+    filesystem is checked, the catalog may not list the files of an
+    archive that was written after it was last updated
+
+    :param dates: the date range string YYYYMMDD_YYYYMMDD
+    :type dates: str
+    :return: True if the archive has a data.mdb
+    :rtype: bool
+    """
+
+    return Path(ARCHIVE_DIR, dates, 'data.mdb').is_file()
+
+
+def previous_archive(dates: str) -> Optional[str]:
+    """
+    The newest archive that is older than the given archive
+
+    :param dates: the date range string of the archive
+    :type dates: str
+    :return: the date range string of the previous archive, None if
+        there is no older archive
+    :rtype: Optional[str]
+    """
+
+    key = lambda x: (x[:8], x[9:])
+    older = [
+        x['dates'] for x in list_archives() if
+        key(x['dates']) < key(dates) and has_lmdb(x['dates'])
+        ]
+
+    return max(older, key=key) if older else None
+
+
+def delta_base(dates: str) -> Optional[str]:
+    """
+    The full archive to write the archive as a delta of. Deltas are
+    always written against a full archive so reads never go through
+    more than one base
+
+    :param dates: the date range string of the archive
+    :type dates: str
+    :return: the date range string of the base archive, None if there
+        is no older archive
+    :rtype: Optional[str]
+    """
+
+    previous = previous_archive(dates)
+    if previous is None:
+        return None
+    base = ArchiveStore.read_meta(previous, b'base')
+
+    return base.decode() if base is not None else previous
+
 
 def find_date_range(dirpath: Optional[Path] = None) -> str:
     """
-    find the date range from the calendar.txt gtfs data
+    find the date range from the calendar.txt gtfs data. The date range
+    of the temp_data feed is kept in the archive catalog and only read
+    from calendar.txt again when the file changes. The feed is read from
+    GTFS.zip when it is in dirpath
 
     :param dirpath: [description], defaults to None
     :type dirpath: Optional[Path], optional
@@ -33,10 +293,29 @@ def find_date_range(dirpath: Optional[Path] = None) -> str:
 
     if not dirpath:
         dirpath = Path(TEMP_DIR)
-    cal_fp = Path(dirpath, 'calendar.txt')
-    dates = pd.read_csv(cal_fp).iloc[0, [-2, -1]].values
 
-    return f'{min(dates)}_{max(dates)}'
+    is_current = Path(dirpath).resolve() == TEMP_DIR.resolve()
+    with open_feed(dirpath) as feed:
+        if is_current:
+            catalog = load_catalog()
+            current = catalog.get('current')
+            if 'calendar.txt' not in feed and current:
+                # no feed downloaded, use the last one archived
+                return current['dates']
+            stat = feed.stat('calendar.txt')
+            if current and current['calendar'] == stat:
+                return current['dates']
+
+        with feed.open('calendar.txt') as f:
+            calendar = read_gtfs(f, 'calendar.txt')
+        dates = calendar.loc[0, ['start_date', 'end_date']].values
+    date_range = f'{min(dates)}_{max(dates)}'
+
+    if is_current:
+        catalog['current'] = {'dates': date_range, 'calendar': stat}
+        _write_catalog(catalog)
+
+    return date_range
 
 
 def load_config() -> Dict[str, str]:
@@ -86,6 +365,988 @@ def filter_last_stop(stoptimes):
 
     return out
 
+def encode_key(key: int) -> bytes:
+    """an integer archive key as 8 big-endian bytes, so that lmdb
+    sorts the keys numerically"""
+
+    return KEY_STRUCT.pack(key)
+
+def decode_key(key: bytes) -> int:
+    """an 8 byte big-endian archive key to an integer"""
+
+    return KEY_STRUCT.unpack(key)[0]
+
+def _decode_legacy_key(key: bytes) -> int:
+    """a utf-8 string archive key to an integer"""
+
+    return int(bytes(key).decode('utf-8'))
+
+def _archive_key_decoder(
+        env: lmdb.Environment,
+        txn: Optional[lmdb.Transaction] = None
+        ) -> Callable[[bytes], int]:
+    """
+    The key decoder of an archive. Archives written before keys were
+    stored as big-endian integers have utf-8 string keys
+
+    :param env: the open archive environment
+    :type env: lmdb.Environment
+    :param txn: a transaction to read the key format with, defaults to None
+    :type txn: Optional[lmdb.Transaction], optional
+    :return: a function decoding a key to an integer
+    :rtype: Callable[[bytes], int]
+
+    """
+
+    if _read_meta(env, b'key_format', txn=txn) == KEY_FORMAT:
+        return decode_key
+    return _decode_legacy_key
+
+def _read_meta(
+        env: lmdb.Environment,
+        key: bytes,
+        txn: Optional[lmdb.Transaction] = None
+        ) -> Optional[bytes]:
+    """read a value from the meta database of an archive"""
+
+    if txn is None:
+        with env.begin() as txn:
+            return _read_meta(env, key, txn=txn)
+    if txn.get(META_DB) is None:
+        return None
+    value = txn.get(key, db=env.open_db(META_DB, txn=txn, create=False))
+
+    return bytes(value) if value is not None else None
+
+def _retry_map_full(
+        env: lmdb.Environment,
+        dates: str,
+        func: Callable[[], Any]
+        ) -> Any:
+    """
+    Call func, doubling the memory map of the environment and
+    retrying whenever the map is full
+
+    :param env: the open archive environment
+    :type env: lmdb.Environment
+    :param dates: the date range string of the archive
+    :type dates: str
+    :param func: a function that writes to the environment in
+        a single transaction
+    :type func: Callable[[], Any]
+    :return: the result of func
+    :rtype: Any
+
+    """
+
+    while True:
+        try:
+            return func()
+        except lmdb.MapFullError:
+            map_size = env.info()['map_size'] * 2
+            log.info(f"Archive {dates} map full, resizing to {map_size}")
+            env.set_mapsize(map_size)
+
+def _hash_db(
+        env: lmdb.Environment,
+        txn: lmdb.Transaction,
+        name: str
+        ) -> Tuple[Optional[Any], bool]:
+    """
+    The '<db>_hash' database of an archive, or the database itself for
+    archives written before the hashes were kept
+
+    :param env: the open archive environment
+    :type env: lmdb.Environment
+    :param txn: a transaction on the environment
+    :type txn: lmdb.Transaction
+    :param name: the name of the lmdb database
+    :type name: str
+    :return: the database, None if the archive has neither, and whether
+        its values are hashes
+    :rtype: Tuple[Optional[Any], bool]
+
+    """
+
+    for db_name, hashed in ((f'{name}_hash', True), (name, False)):
+        key = bytes(db_name, 'utf-8')
+        if txn.get(key) is not None:
+            return env.open_db(key, txn=txn, create=False), hashed
+
+    return None, False
+
+def _train_zstd_dictionary(samples: List[bytes]) -> bytes:
+    """
+    Train a zstd dictionary on sample values. An empty dictionary is
+    returned when there are too few samples to train on
+
+    :param samples: the sample values
+    :type samples: List[bytes]
+    :return: the dictionary
+    :rtype: bytes
+
+    """
+
+    import zstandard
+
+    step = max(1, len(samples) // ZSTD_SAMPLES)
+    try:
+        return zstandard.train_dictionary(
+            ZSTD_DICT_SIZE, samples[::step], level=ZSTD_LEVEL
+            ).as_bytes()
+    except zstandard.ZstdError:
+        log.info(f"too few values to train a zstd dictionary on: {len(samples)}")
+        return b''
+
+def _zstd_compressor(dictionary: bytes):
+    """a zstd compressor using the dictionary if it is not empty"""
+
+    import zstandard
+
+    dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dict_data)
+
+def _zstd_decompressor(dictionary: bytes):
+    """a zstd decompressor using the dictionary if it is not empty"""
+
+    import zstandard
+
+    dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+    return zstandard.ZstdDecompressor(dict_data=dict_data)
+
+def migrate_archive_keys(dates: str) -> None:
+    """
+    Rewrite the utf-8 string keys of an archive's lmdb databases as
+    big-endian integer keys. Archives that are already migrated are
+    left unchanged
+
+    :param dates: the date range string of the archive
+    :type dates: str
+
+    """
+
+    archive_loc = str(Path(ARCHIVE_DIR, dates))
+    # a process must not have the same environment open twice
+    ArchiveStore.close(dates)
+
+    with lmdb.open(archive_loc, map_size=DB_SIZE, max_dbs=MAX_DBS) as env:
+        if _read_meta(env, b'key_format') == KEY_FORMAT:
+            return
+
+        with env.begin() as txn:
+            names = [bytes(k) for k, _ in txn.cursor() if bytes(k) != META_DB]
+        dbs = [env.open_db(name) for name in names]
+        meta_db = env.open_db(META_DB)
+
+        def migrate():
+            with env.begin(write=True) as txn:
+                for db in dbs:
+                    items = sorted(
+                        (encode_key(_decode_legacy_key(k)), bytes(v))
+                        for k, v in txn.cursor(db=db)
+                        )
+                    txn.drop(db, delete=False)
+                    txn.cursor(db=db).putmulti(items, append=True)
+                txn.put(b'key_format', KEY_FORMAT, db=meta_db)
+
+        _retry_map_full(env, dates, migrate)
+
+    log.info(f"Archive keys migrated to {KEY_FORMAT.decode()} in : {dates}")
+
+
+class ArchiveWriter:
+
+    def __init__(
+            self,
+            dates: str,
+            base: Optional[str] = None,
+            compress: Optional[bool] = False,
+            replace: Optional[bool] = False
+            ) -> None:
+        """
+        Stage writes to the lmdb databases of an archive and commit them
+        together in a single transaction. A content hash of every value
+        is kept in a '<db>_hash' database so that unchanged values are
+        not rewritten. With replace the keys of a written database that
+        are not staged are deleted, so a feed re-published for the same
+        period does not keep the trips it dropped. The memory map is grown
+        when it is full
+
+        With a base archive the archive is written as a delta of it. Only
+        the values that differ from the base are written and, with replace,
+        the keys of the base that are not staged are recorded as removed.
+        Read the archive with ArchiveReader to see every value
+
+        The writer can be committed more than once to bound the staged
+        values, see commit
+
+        :param dates: the date range string of the archive
+        :type dates: str
+        :param base: the date range string of the archive to write a
+            delta of, defaults to None - write every value
+        :type base: Optional[str], optional
+        :param compress: compress the values of new databases with zstd
+            and a dictionary trained on the staged values. The dictionary
+            is stored in the meta key 'zstd_dict' and databases stay
+            compressed once they are, defaults to False
+        :type compress: Optional[bool], optional
+        :param replace: the staged values are every value of the databases
+            they are written to, so the keys that are not staged are deleted
+            on the final commit. Otherwise the staged values are added to
+            the values in the archive, defaults to False
+        :type replace: Optional[bool], optional
+        :rtype: None
+
+        """
+
+        self.dates = dates
+        self.base = base
+        self.compress = compress
+        self.replace = replace
+        self._staged: Dict[str, Dict[int, bytes]] = {}
+        # the databases written by the commits that were not final, their
+        # keys are kept in the '<db>_ingest' database of the archive
+        self._committed: Set[str] = set()
+
+    def stage(self, db_name: str, items: Iterable[Tuple[int, bytes]]) -> None:
+        """
+        Stage key/value pairs to be written to a database on commit
+
+        :param db_name: the name of the lmdb database
+        :type db_name: str
+        :param items: the integer key/value pairs
+        :type items: Iterable[Tuple[int, bytes]]
+
+        """
+
+        self._staged.setdefault(db_name, {}).update(items)
+
+    def commit(self, final: Optional[bool] = True) -> Dict[str, int]:
+        """
+        Write the staged values in one transaction, skipping the values
+        that are unchanged in the archive. Keys are written in order as
+        big-endian integers, appending to empty databases. Archives with
+        string keys are migrated first
+
+        Values can be written in parts with commits that are not final.
+        With replace, the keys that are in none of the commits are only
+        deleted, or recorded as removed from the base of a delta archive,
+        by the final commit, so until then the archive may still have
+        values of the last ingest. The parts are not written atomically. The keys of
+        the parts are kept in a '<db>_ingest' database of the archive
+        instead of in memory, and the content hashes of the databases
+        in the meta keys 'hash:<db>' are only updated by the final commit
+
+        :param final: whether this is the last commit of the values,
+            defaults to True
+        :type final: Optional[bool], optional
+        :return: the number of values written to each database
+        :rtype: Dict[str, int]
+
+        """
+
+        archive_loc = str(Path(ARCHIVE_DIR, self.dates))
+        exists = has_lmdb(self.dates)
+        if exists:
+            migrate_archive_keys(self.dates)
+        delta = False
+        if self.base is not None:
+            migrate_archive_keys(self.base)
+            delta = self._is_delta(exists)
+        # a process must not have the same environment open twice
+        ArchiveStore.close(self.dates)
+
+        names = set(self._staged)
+        if final:
+            names.update(self._committed)
+        # the base hashes are looked up key by key, not read into memory
+        base_env = ArchiveStore.acquire(self.base) if delta else None
+        try:
+            with lmdb.open(archive_loc, map_size=DB_SIZE, max_dbs=MAX_DBS) as env:
+                dbs = {
+                    name: (env.open_db(bytes(name, 'utf-8')),
+                           env.open_db(bytes(f'{name}_hash', 'utf-8')))
+                    for name in sorted(names)
+                    }
+                ingest_dbs = {
+                    name: env.open_db(bytes(f'{name}_ingest', 'utf-8')) for
+                    name in sorted(names) if not final or name in self._committed
+                    }
+                meta_db = env.open_db(META_DB)
+                # trained once, not again by each retry of a full map
+                dictionary = self._zstd_dictionary(env, dbs, meta_db)
+                written = _retry_map_full(
+                    env, self.dates,
+                    lambda: self._write(
+                        env, dbs, meta_db, ingest_dbs, base_env,
+                        final=final, dictionary=dictionary
+                        )
+                    )
+        finally:
+            if base_env is not None:
+                ArchiveStore.release(self.base)
+
+        for name, n in written.items():
+            log.info(
+                f"{n} of {len(self._staged.get(name, {}))} {name} values "
+                f"written to archive in : {self.dates}"
+                )
+        if final:
+            self._committed = set()
+            # the sizes recorded before this commit are stale
+            _refresh_catalog_files(self.dates)
+        else:
+            self._committed.update(self._staged)
+        self._staged = {}
+
+        return written
+
+    def _compressed(self, txn: lmdb.Transaction, dbs, meta_db) -> Set[str]:
+        """the databases whose values are compressed. Only empty
+        databases start being compressed"""
+
+        names = set()
+        for name, (db, _) in dbs.items():
+            key = bytes(f'compression:{name}', 'utf-8')
+            if txn.get(key, db=meta_db) == ZSTD:
+                names.add(name)
+            elif self.compress and txn.stat(db)['entries'] == 0:
+                names.add(name)
+
+        return names
+
+    def _zstd_dictionary(
+            self,
+            env: lmdb.Environment,
+            dbs,
+            meta_db
+            ) -> Optional[bytes]:
+        """the zstd dictionary of the archive, trained on the staged
+        values when a database is compressed and the archive has no
+        dictionary yet. None if no database is compressed"""
+
+        with env.begin() as txn:
+            names = self._compressed(txn, dbs, meta_db)
+            if not names:
+                return None
+            dictionary = txn.get(b'zstd_dict', db=meta_db)
+            if dictionary is not None:
+                return bytes(dictionary)
+
+        return _train_zstd_dictionary([
+            v for name in sorted(names) for
+            v in self._staged.get(name, {}).values()
+            ])
+
+    def _compressor(
+            self,
+            txn: lmdb.Transaction,
+            dbs,
+            meta_db,
+            dictionary: Optional[bytes]
+            ) -> Dict[str, Callable[[bytes], bytes]]:
+        """the zstd compress function of each database whose values are
+        compressed, see _zstd_dictionary"""
+
+        names = self._compressed(txn, dbs, meta_db)
+        for name, (db, _) in dbs.items():
+            key = bytes(f'compression:{name}', 'utf-8')
+            if name in names:
+                txn.put(key, ZSTD, db=meta_db)
+            elif self.compress:
+                log.warning(
+                    f"{name} in archive {self.dates} is not compressed, "
+                    f"its values are written uncompressed"
+                    )
+        if not names:
+            return {}
+
+        if txn.get(b'zstd_dict', db=meta_db) is None:
+            txn.put(b'zstd_dict', dictionary, db=meta_db)
+        compress = _zstd_compressor(dictionary).compress
+
+        return {name: compress for name in names}
+
+    def _is_delta(self, exists: bool) -> bool:
+        """whether the archive is written as a delta of the base. An
+        archive that exists and is not a delta of the base is not"""
+
+        if exists:
+            base = ArchiveStore.read_meta(self.dates, b'base')
+            if base != self.base.encode():
+                log.warning(
+                    f"Archive {self.dates} exists and is not a delta of "
+                    f"{self.base}, writing every value"
+                    )
+                return False
+
+        return True
+
+    def _write(
+            self,
+            env: lmdb.Environment,
+            dbs,
+            meta_db,
+            ingest_dbs,
+            base_env: Optional[lmdb.Environment] = None,
+            final: Optional[bool] = True,
+            dictionary: Optional[bytes] = None
+            ) -> Dict[str, int]:
+        """write the staged values of every database in one transaction"""
+
+        written = {}
+        with env.begin(write=True) as txn, \
+                (base_env.begin() if base_env is not None else nullcontext()) as base_txn:
+            txn.put(b'key_format', KEY_FORMAT, db=meta_db)
+            if base_txn is not None:
+                txn.put(b'base', self.base.encode(), db=meta_db)
+            compressor = self._compressor(txn, dbs, meta_db, dictionary)
+            for name, (db, hash_db) in dbs.items():
+                staged = self._staged.get(name, {})
+                # values are hashed before they are compressed
+                items = [
+                    (encode_key(k), v, hashlib.blake2b(v, digest_size=16).digest())
+                    for k, v in sorted(staged.items())
+                    ]
+                keys = {x[0] for x in items}
+                ingest_db = ingest_dbs.get(name)
+                if ingest_db is not None and name not in self._committed:
+                    # the keys of an earlier ingest that did not finish
+                    txn.drop(ingest_db, delete=False)
+
+                def seen(key: bytes) -> bool:
+                    """whether the key is in this ingest"""
+                    return key in keys or (
+                        name in self._committed and
+                        txn.get(key, db=ingest_db) is not None
+                        )
+
+                append = txn.stat(db)['entries'] == 0
+                if base_txn is not None:
+                    base_db, hashed = _hash_db(base_env, base_txn, name)
+
+                    def base_hash(key: bytes) -> Optional[bytes]:
+                        """the hash of the base value of a key"""
+                        if base_db is None:
+                            return None
+                        value = base_txn.get(key, db=base_db)
+                        if value is None or hashed:
+                            return value
+                        return hashlib.blake2b(value, digest_size=16).digest()
+
+                    # values equal to the base are read from the base
+                    same = {x[0] for x in items if base_hash(x[0]) == x[2]}
+                    for key in same:
+                        if txn.get(key, db=hash_db) is not None:
+                            txn.delete(key, db=db)
+                            txn.delete(key, db=hash_db)
+                    items = [
+                        x for x in items if x[0] not in same and
+                        txn.get(x[0], db=hash_db) != x[2]
+                        ]
+                    if final and self.replace:
+                        removed = [] if base_db is None else [
+                            decode_key(k) for k in
+                            base_txn.cursor(db=base_db).iternext(values=False)
+                            if not seen(k)
+                            ]
+                        stale = [
+                            bytes(k) for k in txn.cursor(db=db).iternext(values=False)
+                            if not seen(bytes(k))
+                            ]
+                        for key in stale:
+                            txn.delete(key, db=db)
+                            txn.delete(key, db=hash_db)
+                        txn.put(
+                            bytes(f'removed:{name}', 'utf-8'),
+                            msgpack.packb(removed), db=meta_db
+                            )
+                    elif not self.replace:
+                        # the staged keys are no longer removed from the base
+                        removed_key = bytes(f'removed:{name}', 'utf-8')
+                        value = txn.get(removed_key, db=meta_db)
+                        if value is not None:
+                            removed = [
+                                x for x in msgpack.unpackb(value) if x not in staged
+                                ]
+                            txn.put(removed_key, msgpack.packb(removed), db=meta_db)
+                elif not append:
+                    items = [x for x in items if txn.get(x[0], db=hash_db) != x[2]]
+                    if final and self.replace:
+                        # keys of the last ingest that are not in this one
+                        stale = [
+                            bytes(k) for k in txn.cursor(db=db).iternext(values=False)
+                            if not seen(bytes(k))
+                            ]
+                        for key in stale:
+                            txn.delete(key, db=db)
+                            txn.delete(key, db=hash_db)
+                        if stale:
+                            log.info(
+                                f"{len(stale)} {name} values not in the ingest "
+                                f"deleted from archive in : {self.dates}"
+                                )
+                if name in compressor:
+                    items = [(k, compressor[name](v), d) for k, v, d in items]
+
+                txn.cursor(db=db).putmulti(
+                    [(k, v) for k, v, _ in items], append=append
+                    )
+                txn.cursor(db=hash_db).putmulti(
+                    [(k, digest) for k, _, digest in items], append=append
+                    )
+                written[name] = len(items)
+
+                if ingest_db is None:
+                    pass
+                elif final:
+                    txn.drop(ingest_db, delete=False)
+                else:
+                    txn.cursor(db=ingest_db).putmulti(
+                        [(k, b'') for k in sorted(keys)]
+                        )
+
+                if final:
+                    # the content hash of the whole database
+                    digest = hashlib.blake2b(digest_size=16)
+                    for k, v in txn.cursor(db=hash_db):
+                        digest.update(k)
+                        digest.update(v)
+                    txn.put(
+                        bytes(f'hash:{name}', 'utf-8'), digest.digest(), db=meta_db
+                        )
+
+        return written
+
+
+class ServiceDates(NamedTuple):
+    """The activity of every service on every date of an archive.
+    active[i, j] is True if service_ids[i] runs on dates[j]"""
+
+    service_ids: np.ndarray
+    dates: np.ndarray
+    active: np.ndarray
+
+    def services_on(self, date_int: int) -> Set[int]:
+        """
+        The services that run on the given date
+
+        :param date_int: the date as an int YYYYMMDD
+        :type date_int: int
+        :return: set of service_ids
+        :rtype: Set[int]
+
+        """
+
+        idx = np.searchsorted(self.dates, date_int)
+        if idx == len(self.dates) or self.dates[idx] != date_int:
+            return set()
+
+        return set(self.service_ids[self.active[:, idx]].tolist())
+
+
+def make_service_dates(
+        calendar: Dict[int, Dict[str, int]],
+        calendar_dates: Dict[int, Tuple[Tuple[int, int], ...]],
+        dates: str
+        ) -> ServiceDates:
+    """
+    Build the service by date activity matrix from the weekday calendar
+    and the calendar exceptions. Added services (exception_type 1) are
+    applied before removed services (exception_type 2)
+
+    :param calendar: the calendar from ArchiveStore.load_calendar
+    :type calendar: Dict[int, Dict[str, int]]
+    :param calendar_dates: the exceptions from ArchiveStore.load_calendar_dates
+    :type calendar_dates: Dict[int, Tuple[Tuple[int, int], ...]]
+    :param dates: the date range string of the archive
+    :type dates: str
+    :return: the service dates of the archive
+    :rtype: ServiceDates
+
+    """
+
+    start, end = dates.split('_')
+    date_range = pd.date_range(start, end, freq='D')
+    date_ints = date_range.strftime('%Y%m%d').astype(int).values
+
+    service_ids = np.array(sorted(set(calendar) | set(calendar_dates)), dtype=np.int64)
+
+    week = np.array([
+        [calendar.get(service_id, {}).get(day) == 1 for day in WEEKDAYS]
+        for service_id in service_ids.tolist()
+        ], dtype=bool).reshape(len(service_ids), len(WEEKDAYS))
+    active = week[:, date_range.weekday]
+
+    rows = {k: i for i, k in enumerate(service_ids.tolist())}
+    columns = {k: i for i, k in enumerate(date_ints.tolist())}
+
+    removed = []
+    for service_id, exceptions in calendar_dates.items():
+        for date_int, exception_type in exceptions:
+            if date_int not in columns:
+                continue
+            if exception_type == 1:
+                active[rows[service_id], columns[date_int]] = True
+            elif exception_type == 2:
+                removed.append((rows[service_id], columns[date_int]))
+    for row, column in removed:
+        active[row, column] = False
+
+    return ServiceDates(service_ids, date_ints, active)
+
+
+def _unpack_stop_times(
+        value: bytes,
+        pickup_type: Optional[int] = None
+        ) -> Dict[int, Dict[str, Union[str, int]]]:
+    """unpack the stop_times of a trip, keeping only the stops with
+    the pickup_type if it is given"""
+
+    val = msgpack.unpackb(value, strict_map_key=False)
+    if pickup_type is not None:
+        val = {
+            key: value for
+            key, value in val.items() if value['pickup_type'] == pickup_type
+            }
+    return val
+
+
+def _without_last_stop(
+        trip: Dict[int, Dict[str, Union[str, int]]]
+        ) -> Dict[int, Dict[str, Union[str, int]]]:
+    """drop the stop with the highest stop_sequence from a trip's
+    stop_times, unless it is the first stop. A trip without stops
+    is returned as it is"""
+
+    nstops = max(trip, default=0)
+    if nstops == 0:
+        return trip
+    return {k: v for k, v in trip.items() if k != nstops}
+
+
+class _ArchiveLayer(NamedTuple):
+    """an open read transaction on one archive of a delta chain"""
+
+    dates: str
+    env: lmdb.Environment
+    txn: lmdb.Transaction
+    decode: Callable[[bytes], int]
+    encode: Callable[[int], bytes]
+
+
+class ArchiveReader:
+
+    def __init__(
+            self,
+            dates: str,
+            txn: Optional[lmdb.Transaction] = None
+            ) -> None:
+        """
+        Read the databases of an archive. A delta archive only holds the
+        values that changed from its base archive, the base archive is
+        stored in the meta key 'base' and the keys removed from it in the
+        meta keys 'removed:<db>'. Values are read from the newest archive
+        of the chain that has them, so a delta archive reads as if it held
+        every value. Compressed values are decompressed
+
+        :param dates: the date range string of the archive
+        :type dates: str
+        :param txn: a read transaction on the archive, defaults to None
+        :type txn: Optional[lmdb.Transaction], optional
+        :rtype: None
+
+        """
+
+        self.dates = dates
+        self._layers: List[_ArchiveLayer] = []
+        self._owned: List[lmdb.Transaction] = []
+        self._dbs: Dict[Tuple[int, str], Any] = {}
+        self._removed: Dict[Tuple[int, str], Set[int]] = {}
+        self._decompress: Dict[Tuple[int, str], Optional[Callable]] = {}
+
+        # the environments are not closed by the pool until the reader is
+        self._acquired: List[str] = []
+
+        name: Optional[str] = dates
+        try:
+            while name is not None:
+                if any(x.dates == name for x in self._layers):
+                    raise ValueError(f"Archive {dates} has a cyclic base {name}")
+                env = ArchiveStore.acquire(name)
+                self._acquired.append(name)
+                if txn is not None and name == dates:
+                    layer_txn = txn
+                else:
+                    layer_txn = env.begin(buffers=True)
+                    self._owned.append(layer_txn)
+                decode = _archive_key_decoder(env, txn=layer_txn)
+                if decode is decode_key:
+                    encode = encode_key
+                else:
+                    encode = lambda k: bytes(str(k), 'utf-8')
+                self._layers.append(_ArchiveLayer(name, env, layer_txn, decode, encode))
+
+                base = _read_meta(env, b'base', txn=layer_txn)
+                name = base.decode() if base is not None else None
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def legacy_keys(self) -> bool:
+        """whether the archive has utf-8 string keys"""
+
+        return self._layers[0].decode is not decode_key
+
+    def _db(self, i: int, db_name: str):
+        """the database of the i-th archive in the chain, None if it
+        does not have it"""
+
+        if (i, db_name) not in self._dbs:
+            layer = self._layers[i]
+            try:
+                db = layer.env.open_db(
+                    bytes(db_name, 'utf-8'), txn=layer.txn, create=False
+                    )
+            except lmdb.NotFoundError:
+                db = None
+            self._dbs[(i, db_name)] = db
+
+        return self._dbs[(i, db_name)]
+
+    def _decompressor(self, i: int, db_name: str) -> Optional[Callable]:
+        """the decompress function of the database of the i-th archive,
+        None if its values are not compressed"""
+
+        if (i, db_name) not in self._decompress:
+            layer = self._layers[i]
+            compression = _read_meta(
+                layer.env, bytes(f'compression:{db_name}', 'utf-8'), txn=layer.txn
+                )
+            func = None
+            if compression == ZSTD:
+                dictionary = _read_meta(layer.env, b'zstd_dict', txn=layer.txn)
+                func = _zstd_decompressor(dictionary or b'').decompress
+            self._decompress[(i, db_name)] = func
+
+        return self._decompress[(i, db_name)]
+
+    def _value(self, i: int, db_name: str, value: bytes) -> bytes:
+        """the value as it was staged"""
+
+        decompress = self._decompressor(i, db_name)
+        return decompress(value) if decompress is not None else value
+
+    def _removed_keys(self, i: int, db_name: str) -> Set[int]:
+        """the keys of the database removed by the i-th archive"""
+
+        if db_name.endswith('_hash'):
+            db_name = db_name[:-len('_hash')]
+        if (i, db_name) not in self._removed:
+            layer = self._layers[i]
+            value = _read_meta(
+                layer.env, bytes(f'removed:{db_name}', 'utf-8'), txn=layer.txn
+                )
+            self._removed[(i, db_name)] = \
+                set(msgpack.unpackb(value)) if value is not None else set()
+
+        return self._removed[(i, db_name)]
+
+    def _check_db(self, db_name: str) -> None:
+
+        if all(self._db(i, db_name) is None for i in range(len(self._layers))):
+            raise lmdb.NotFoundError(f"No {db_name} database in archive {self.dates}")
+
+    def get(self, db_name: str, key: int) -> Optional[bytes]:
+        """
+        The value of a key
+
+        :param db_name: the name of the lmdb database
+        :type db_name: str
+        :param key: the integer key
+        :type key: int
+        :return: the value, None if the key is not in the archive
+        :rtype: Optional[bytes]
+
+        """
+
+        self._check_db(db_name)
+        for i, layer in enumerate(self._layers):
+            db = self._db(i, db_name)
+            if db is not None:
+                value = layer.txn.get(layer.encode(key), db=db)
+                if value is not None:
+                    return self._value(i, db_name, value)
+            if key in self._removed_keys(i, db_name):
+                return None
+
+        return None
+
+    def iterate(
+            self,
+            db_name: str,
+            first: Optional[int] = None
+            ) -> Iterator[Tuple[int, bytes]]:
+        """
+        Iterate over the keys and values of a database in key order
+
+        :param db_name: the name of the lmdb database
+        :type db_name: str
+        :param first: start from this key, defaults to None
+        :type first: Optional[int], optional
+        :yield: key, value pairs
+        :rtype: Iterator[Tuple[int, bytes]]
+
+        """
+
+        self._check_db(db_name)
+
+        def _layer_items(i):
+            layer = self._layers[i]
+            db = self._db(i, db_name)
+            if db is None:
+                return
+            cursor = layer.txn.cursor(db=db)
+            if first is not None and not cursor.set_range(layer.encode(first)):
+                return
+            for k, v in cursor:
+                yield layer.decode(k), i, v
+
+        if len(self._layers) == 1:
+            decompress = self._decompressor(0, db_name)
+            for k, _, v in _layer_items(0):
+                yield k, decompress(v) if decompress is not None else v
+            return
+
+        # the newest archive of a key comes first
+        last = None
+        for k, i, v in heapq.merge(
+                *(_layer_items(i) for i in range(len(self._layers))),
+                key=lambda x: (x[0], x[1])
+                ):
+            if k == last:
+                continue
+            last = k
+            if any(k in self._removed_keys(j, db_name) for j in range(i)):
+                continue
+            yield k, self._value(i, db_name, v)
+
+    def count(self, db_name: str) -> int:
+        """
+        The number of keys in a database
+
+        :param db_name: the name of the lmdb database
+        :type db_name: str
+        :return: the number of keys
+        :rtype: int
+
+        """
+
+        if len(self._layers) == 1:
+            self._check_db(db_name)
+            return self._layers[0].txn.stat(self._db(0, db_name))['entries']
+
+        return sum(1 for _ in self.iterate(db_name))
+
+    def close(self) -> None:
+        """end the read transactions opened by the reader and release
+        its environments"""
+
+        for txn in self._owned:
+            txn.abort()
+        self._owned = []
+        for name in self._acquired:
+            ArchiveStore.release(name)
+        self._acquired = []
+
+
+class LazyStopTimes(Mapping):
+
+    def __init__(
+            self,
+            reader: ArchiveReader,
+            pickup_type: Optional[int] = None,
+            drop_last_stop: Optional[bool] = False
+            ) -> None:
+        """
+        A read-only mapping of trip_id -> stop_times backed by open
+        lmdb read transactions. The stop_times of a trip are only
+        decoded when the trip is accessed
+
+        :param reader: the archive reader
+        :type reader: ArchiveReader
+        :param pickup_type: only keep the stops with this pickup_type,
+            defaults to None
+        :type pickup_type: Optional[int], optional
+        :param drop_last_stop: drop the last remaining stop of each trip,
+            defaults to False
+        :type drop_last_stop: Optional[bool], optional
+        :rtype: None
+
+        """
+
+        self.pickup_type = pickup_type
+        self.drop_last_stop = drop_last_stop
+
+        self._reader = reader
+
+    def _unpack(self, value: bytes) -> Dict[int, Dict[str, Union[str, int]]]:
+
+        trip = _unpack_stop_times(value, self.pickup_type)
+        if self.drop_last_stop:
+            trip = _without_last_stop(trip)
+        return trip
+
+    def __getitem__(self, trip_id: int) -> Dict[int, Dict[str, Union[str, int]]]:
+
+        value = self._reader.get('stop_times', trip_id)
+        if value is None:
+            raise KeyError(trip_id)
+        return self._unpack(value)
+
+    def __contains__(self, trip_id: object) -> bool:
+
+        try:
+            return self._reader.get('stop_times', trip_id) is not None
+        except (TypeError, ValueError, struct.error):
+            return False
+
+    def __iter__(self) -> Iterator[int]:
+
+        for k, _ in self._reader.iterate('stop_times'):
+            yield k
+
+    def __len__(self) -> int:
+
+        return self._reader.count('stop_times')
+
+    def subset(
+            self,
+            trip_ids: Iterable[int]
+            ) -> Iterator[Tuple[int, Dict[int, Dict[str, Union[str, int]]]]]:
+        """
+        Iterate over the stop_times of the given trip_ids in key order.
+        trip_ids that are not in the archive are skipped
+
+        :param trip_ids: the trip_ids to read
+        :type trip_ids: Iterable[int]
+        :yield: trip_id, stop_times pairs
+        :rtype: Iterator[Tuple[int, Dict[int, Dict[str, Union[str, int]]]]]
+
+        """
+
+        for trip_id in sorted(trip_ids):
+            value = self._reader.get('stop_times', trip_id)
+            if value is not None:
+                yield trip_id, self._unpack(value)
+
+    def close(self) -> None:
+        """end the read transactions"""
+
+        self._reader.close()
+
+
 class ArchiveStore:
 
     def __init__(self, dates: Optional[str] = None) -> None:
@@ -99,6 +1360,225 @@ class ArchiveStore:
 
         self.dates = dates
 
+    # read-only environments of the archives, least recently used first
+    _environments: 'OrderedDict[str, lmdb.Environment]' = OrderedDict()
+    # the number of readers and transactions using each environment
+    _users: Dict[str, int] = {}
+    _lock = threading.RLock()
+
+    @classmethod
+    def environment(cls, dates: Optional[str] = None) -> lmdb.Environment:
+        """
+        The shared read-only lmdb environment of an archive. Environments
+        are kept open and reused. The least recently used environments
+        that are not in use are closed when more than MAX_ENVIRONMENTS are
+        open. Use acquire for an environment that must stay open while
+        other threads open environments
+
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+        :return: the open environment
+        :rtype: lmdb.Environment
+
+        """
+
+        if dates is None:
+            dates = find_date_range()
+
+        with cls._lock:
+            env = cls._environments.get(dates)
+            if env is not None:
+                cls._environments.move_to_end(dates)
+                return env
+
+            archive_loc = str(Path(ARCHIVE_DIR, dates))
+            env = lmdb.open(
+                archive_loc, map_size=DB_SIZE, max_dbs=MAX_DBS, readonly=True
+                )
+            cls._environments[dates] = env
+            cls._evict()
+
+        return env
+
+    @classmethod
+    def _evict(cls) -> None:
+        """close the least recently used environments that are not in
+        use until at most MAX_ENVIRONMENTS are open"""
+
+        with cls._lock:
+            unused = [x for x in cls._environments if not cls._users.get(x)]
+            for name in unused[:max(len(cls._environments) - MAX_ENVIRONMENTS, 0)]:
+                cls._environments.pop(name).close()
+
+    @classmethod
+    def acquire(cls, dates: Optional[str] = None) -> lmdb.Environment:
+        """
+        The shared environment of an archive, kept open until it is
+        released. Every acquire must be matched by a release
+
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+        :return: the open environment
+        :rtype: lmdb.Environment
+
+        """
+
+        if dates is None:
+            dates = find_date_range()
+
+        with cls._lock:
+            env = cls.environment(dates)
+            cls._users[dates] = cls._users.get(dates, 0) + 1
+
+        return env
+
+    @classmethod
+    def release(cls, dates: str) -> None:
+        """
+        Release an environment from acquire, so that it can be closed
+        when the pool is full
+
+        :param dates: the date range string of the archive
+        :type dates: str
+
+        """
+
+        with cls._lock:
+            users = cls._users.pop(dates, 0) - 1
+            if users > 0:
+                cls._users[dates] = users
+            cls._evict()
+
+    @classmethod
+    def close(cls, dates: Optional[str] = None) -> None:
+        """
+        Close the shared environment of an archive, or of all
+        archives if dates is None. Readers still using it can no
+        longer read
+
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+
+        """
+
+        with cls._lock:
+            if dates is None:
+                names = list(cls._environments)
+            else:
+                names = [dates]
+            for name in names:
+                env = cls._environments.pop(name, None)
+                if env is not None:
+                    if cls._users.pop(name, 0):
+                        log.warning(f"Archive {name} closed while it is in use")
+                    env.close()
+
+    @classmethod
+    def read_meta(cls, dates: str, key: bytes) -> Optional[bytes]:
+        """
+        Read a value from the meta database of an archive
+
+        :param dates: the date range string of the archive
+        :type dates: str
+        :param key: the meta key
+        :type key: bytes
+        :return: the value, None if the key is not set
+        :rtype: Optional[bytes]
+
+        """
+
+        env = cls.acquire(dates)
+        try:
+            return _read_meta(env, key)
+        finally:
+            cls.release(dates)
+
+    @classmethod
+    @contextmanager
+    def read_transaction(
+            cls,
+            dates: Optional[str] = None
+            ) -> Iterator[lmdb.Transaction]:
+        """
+        A read transaction on the shared environment of an archive. Pass
+        it as txn to the load methods to make several reads from one
+        snapshot without beginning a new transaction for each
+
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+        :yield: the read transaction
+        :rtype: Iterator[lmdb.Transaction]
+
+        """
+
+        if dates is None:
+            dates = find_date_range()
+
+        env = cls.acquire(dates)
+        try:
+            with env.begin(buffers=True) as txn:
+                yield txn
+        finally:
+            cls.release(dates)
+
+    @staticmethod
+    def resolve_archives(
+            start_date: Union[int, str],
+            end_date: Union[int, str]
+            ) -> Dict[str, List[pd.Timestamp]]:
+        """
+        Find the archive to read for each date from start_date to
+        end_date. Feed periods overlap when a new feed is published
+        before the old one ends, so each date is read from the newest
+        archive that covers it. Dates that no archive covers are skipped
+
+        :param start_date: the first date YYYYMMDD
+        :type start_date: Union[int, str]
+        :param end_date: the last date YYYYMMDD
+        :type end_date: Union[int, str]
+        :return: the date range string of each archive to read and
+            the dates to read from it
+        :rtype: Dict[str, List[pd.Timestamp]]
+
+        """
+
+        archives = sorted(
+            (x['dates'] for x in list_archives() if has_lmdb(x['dates'])),
+            key=lambda x: (x[:8], x[9:]), reverse=True
+            )
+
+        resolved: Dict[str, List[pd.Timestamp]] = {}
+        missing = []
+        for date in pd.date_range(str(start_date), str(end_date), freq='D'):
+            day = date.strftime('%Y%m%d')
+            for dates in archives:
+                if dates[:8] <= day <= dates[9:]:
+                    resolved.setdefault(dates, []).append(date)
+                    break
+            else:
+                missing.append(day)
+        if missing:
+            log.warning(
+                f"no archive for {len(missing)} dates from "
+                f"{missing[0]} to {missing[-1]}"
+                )
+
+        return resolved
+
+    @classmethod
+    def _iterate_db(
+            cls,
+            dates: str,
+            db_name: str,
+            txn: Optional[lmdb.Transaction] = None
+            ) -> Iterator[Tuple[int, bytes]]:
+        """iterate over the decoded keys and values of an archive database"""
+
+        reader = ArchiveReader(dates, txn=txn)
+        try:
+            yield from reader.iterate(db_name)
+        finally:
+            reader.close()
 
     def load_agency():
         fp = Path(ARCHIVE_DIR, 'agency.json')
@@ -119,13 +1599,23 @@ class ArchiveStore:
         with open(fp, 'r') as f:
             return json.load(f)
 
-    @staticmethod
-    def load_trip_route(dates: Optional[str] = None) -> Dict[int, str]:
+    @classmethod
+    def load_trip_route(
+            cls,
+            dates: Optional[str] = None,
+            txn: Optional[lmdb.Transaction] = None,
+            trip_ids: Optional[Iterable[int]] = None
+            ) -> Dict[int, str]:
         """
         Load the mapping of trip_id -> route_id
 
         :param dates: , defaults to None
         :type dates: Optional[str], optional
+        :param txn: a transaction from read_transaction, defaults to None
+        :type txn: Optional[lmdb.Transaction], optional
+        :param trip_ids: only look up these trips one by one instead of
+            reading every trip, defaults to None
+        :type trip_ids: Optional[Iterable[int]], optional
         :return: dictionary of trip_ids to route_ids
         :rtype: Dict[int, str]
 
@@ -134,16 +1624,20 @@ class ArchiveStore:
         if dates is None:
             dates = find_date_range()
 
-        archive_loc = str(Path(ARCHIVE_DIR, dates))
-
-        out = {}
-        with lmdb.open(archive_loc, map_size=DB_SIZE, max_dbs=5) as env:
-            child_db = env.open_db(bytes('trip_route', 'utf-8'))
-            with env.begin(db=child_db) as txn:
-                cursor = txn.cursor()
-                for k, v in cursor:
-                    out[int(k.decode('utf-8'))] = v.decode('utf-8')
-        return out
+        if trip_ids is not None:
+            reader = ArchiveReader(dates, txn=txn)
+            try:
+                values = ((k, reader.get('trip_route', k)) for k in trip_ids)
+                return {
+                    k: bytes(v).decode('utf-8') for k, v in values if v is not None
+                    }
+            finally:
+                reader.close()
+
+        return {
+            k: bytes(v).decode('utf-8') for
+            k, v in cls._iterate_db(dates, 'trip_route', txn=txn)
+            }
 
     @staticmethod
     def load_calendar(dates=None):
@@ -189,15 +1683,99 @@ class ArchiveStore:
 
         return {int(k): tuple(tuple(x) for x in v) for k, v in cal_exceptions.items()}
 
-    @staticmethod
+    @classmethod
+    def archive_hash(cls, dates: Optional[str] = None) -> str:
+        """
+        A hash of the archive content that departures are counted from.
+        It changes when the lmdb databases, the service dates or the
+        routes change. Archives written before content hashes were kept
+        are hashed by the size and modification time of data.mdb
+
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+        :return: the hex digest of the archive
+        :rtype: str
+
+        """
+
+        if dates is None:
+            dates = find_date_range()
+
+        env = cls.acquire(dates)
+        try:
+            with env.begin() as txn:
+                hashes = []
+                if txn.get(META_DB) is not None:
+                    meta_db = env.open_db(META_DB, txn=txn, create=False)
+                    hashes = [
+                        (bytes(k), bytes(v)) for k, v in txn.cursor(db=meta_db)
+                        if bytes(k).startswith((b'hash:', b'removed:'))
+                        ]
+                base = _read_meta(env, b'base', txn=txn)
+        finally:
+            cls.release(dates)
+
+        digest = hashlib.blake2b(digest_size=16)
+        if base is not None:
+            digest.update(cls.archive_hash(base.decode()).encode())
+        if hashes:
+            for k, v in hashes:
+                digest.update(k)
+                digest.update(v)
+        else:
+            stat = Path(ARCHIVE_DIR, dates, 'data.mdb').stat()
+            digest.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+
+        for fp in (Path(ARCHIVE_DIR, dates, SERVICE_DATES),
+                   Path(ARCHIVE_DIR, dates, 'calendar.json'),
+                   Path(ARCHIVE_DIR, dates, 'calendar_dates.json'),
+                   Path(ARCHIVE_DIR, 'routes.json')):
+            if fp.is_file():
+                digest.update(fp.read_bytes())
+
+        return digest.hexdigest()
+
+    @classmethod
+    def load_service_dates(cls, dates: Optional[str] = None) -> ServiceDates:
+        """
+        Load the service by date activity matrix. It is read from the
+        archive if it has been written, otherwise it is built from
+        the calendar and calendar exceptions
+
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+        :return: the service dates of the archive
+        :rtype: ServiceDates
+
+        """
+
+        if dates is None:
+            dates = find_date_range()
+
+        fp = Path(ARCHIVE_DIR, dates, SERVICE_DATES)
+        if fp.is_file():
+            with np.load(fp) as arrays:
+                return ServiceDates(
+                    arrays['service_ids'], arrays['dates'], arrays['active']
+                    )
+
+        return make_service_dates(
+            cls.load_calendar(dates), cls.load_calendar_dates(dates), dates
+            )
+
+    @classmethod
     def load_stop_times(
+            cls,
             dates: Optional[str] = None,
+            txn: Optional[lmdb.Transaction] = None,
             **kwargs
             ) -> Dict[int, Dict[int, Dict[str, Union[str, int]]]]:
         """Load the stop_times for a given date
 
         :param dates: [description], defaults to None
         :type dates: Optional[str], optional
+        :param txn: a transaction from read_transaction, defaults to None
+        :type txn: Optional[lmdb.Transaction], optional
         :return: [description]
         :rtype: Dict[int, Dict[int, Dict[str, Union[str, int]]]]
         """
@@ -206,45 +1784,285 @@ class ArchiveStore:
         if dates is None:
             dates = find_date_range()
 
-        archive_loc = str(Path(ARCHIVE_DIR, dates))
+        return {
+            k: _unpack_stop_times(v, pickup_type) for
+            k, v in cls._iterate_db(dates, 'stop_times', txn=txn)
+            }
+
+    @classmethod
+    def lazy_stop_times(
+            cls,
+            dates: Optional[str] = None,
+            pickup_type: Optional[int] = None,
+            drop_last_stop: Optional[bool] = False
+            ) -> LazyStopTimes:
+        """Open the stop_times of an archive as a lazy mapping. Trips are
+        decoded when they are accessed, so only the trips that are used
+        are held in memory. The mapping holds a read transaction on the
+        shared environment until it is closed
+
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+        :param pickup_type: only keep the stops with this pickup_type,
+            defaults to None
+        :type pickup_type: Optional[int], optional
+        :param drop_last_stop: drop the last remaining stop of each trip,
+            defaults to False
+        :type drop_last_stop: Optional[bool], optional
+        :return: the lazy stop_times mapping
+        :rtype: LazyStopTimes
+        """
+
+        if dates is None:
+            dates = find_date_range()
+
+        return LazyStopTimes(
+            ArchiveReader(dates),
+            pickup_type=pickup_type,
+            drop_last_stop=drop_last_stop
+            )
+
+    @classmethod
+    def load_stop_times_between(
+            cls,
+            first_trip: int,
+            last_trip: int,
+            dates: Optional[str] = None,
+            **kwargs
+            ) -> Dict[int, Dict[int, Dict[str, Union[str, int]]]]:
+        """Load the stop_times of the trip_ids from first_trip to
+        last_trip inclusive with a range scan of the archive
+
+        :param first_trip: the first trip_id of the range
+        :type first_trip: int
+        :param last_trip: the last trip_id of the range
+        :type last_trip: int
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+        :return: the stop_times of the trips in the range
+        :rtype: Dict[int, Dict[int, Dict[str, Union[str, int]]]]
+        """
+        pickup_type = kwargs.pop('pickup_type', None)
+
+        if dates is None:
+            dates = find_date_range()
+
+        reader = ArchiveReader(dates)
 
         out = {}
-        with lmdb.open(archive_loc, map_size=DB_SIZE, max_dbs=5) as env:
-            child_db = env.open_db(bytes('stop_times', 'utf-8'))
-            with env.begin(db=child_db) as txn:
-                cursor = txn.cursor()
-                for k, v in cursor:
-                    val = msgpack.unpackb(v, strict_map_key=False)
-                    if pickup_type is not None:
-                        val = {
-                            key: value for
-                            key, value in val.items() if value['pickup_type'] == pickup_type
-                            }
-                    out[int(k.decode('utf-8'))] = val
+        try:
+            if reader.legacy_keys:
+                raise ValueError(
+                    f"Archive {dates} has string keys, run migrate_archive_keys"
+                    )
+            for k, v in reader.iterate('stop_times', first=first_trip):
+                if k > last_trip:
+                    break
+                out[k] = _unpack_stop_times(v, pickup_type)
+        finally:
+            reader.close()
 
         return out
+
     @staticmethod
-    def load_trips(dates=None):
+    def load_stop_time_columns(
+            dates: Optional[str] = None,
+            mmap: Optional[bool] = True
+            ) -> Dict[str, np.ndarray]:
+        """Load the columnar stop_times for a given date range. The
+        rows of trip trips[i] are offsets[i]:offsets[i + 1]
+
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+        :param mmap: memory map the arrays read-only, defaults to True
+        :type mmap: Optional[bool], optional
+        :return: dictionary of column name to array. trip_id, stop_sequence,
+            stop_id, arrival_seconds, departure_seconds, pickup_type,
+            drop_off_type, trips and offsets
+        :rtype: Dict[str, np.ndarray]
+        """
 
         if dates is None:
             dates = find_date_range()
 
-        archive_loc = str(Path(ARCHIVE_DIR, dates))
+        column_dir = Path(ARCHIVE_DIR, dates, STOP_TIME_COLUMNS)
+        if not column_dir.is_dir():
+            raise FileNotFoundError(f"No stop_times columns in archive {dates}")
+        mmap_mode = 'r' if mmap else None
 
-        out = {}
-        with lmdb.open(archive_loc, map_size=DB_SIZE, max_dbs=5) as env:
-            child_db = env.open_db(bytes('trips', 'utf-8'))
-            with env.begin(db=child_db) as txn:
-                cursor = txn.cursor()
-                for k, v in cursor:
-                    out[int(k.decode('utf-8'))] = msgpack.unpackb(v, strict_map_key=False)
+        return {
+            fp.stem: np.load(fp, mmap_mode=mmap_mode) for
+            fp in sorted(column_dir.glob('*.npy'))
+            }
+
+    @classmethod
+    def load_trips(
+            cls,
+            dates: Optional[str] = None,
+            txn: Optional[lmdb.Transaction] = None
+            ):
+
+        if dates is None:
+            dates = find_date_range()
+
+        return {
+            k: msgpack.unpackb(v, strict_map_key=False) for
+            k, v in cls._iterate_db(dates, 'trips', txn=txn)
+            }
+
+    @classmethod
+    def _index_lookup(
+            cls,
+            index: str,
+            key: int,
+            dates: Optional[str] = None,
+            txn: Optional[lmdb.Transaction] = None
+            ) -> Tuple[int, ...]:
+        """look up the trip_ids of a key in an index database"""
+
+        if dates is None:
+            dates = find_date_range()
+
+        reader = ArchiveReader(dates, txn=txn)
+        try:
+            value = reader.get(index, key)
+            if value is None:
+                return ()
+            return tuple(msgpack.unpackb(value))
+        finally:
+            reader.close()
+
+    @classmethod
+    def trips_for_service(
+            cls,
+            service_id: int,
+            dates: Optional[str] = None,
+            txn: Optional[lmdb.Transaction] = None
+            ) -> Tuple[int, ...]:
+        """
+        The trip_ids that run on a service, from the service index
+
+        :param service_id: the service_id
+        :type service_id: int
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+        :param txn: a transaction from read_transaction, defaults to None
+        :type txn: Optional[lmdb.Transaction], optional
+        :return: the sorted trip_ids
+        :rtype: Tuple[int, ...]
+
+        """
+
+        return cls._index_lookup(SERVICE_INDEX, service_id, dates=dates, txn=txn)
+
+    @classmethod
+    def trips_for_stop(
+            cls,
+            stop_id: int,
+            dates: Optional[str] = None,
+            txn: Optional[lmdb.Transaction] = None
+            ) -> Tuple[int, ...]:
+        """
+        The trip_ids that serve a stop, from the stop index
+
+        :param stop_id: the stop_id
+        :type stop_id: int
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+        :param txn: a transaction from read_transaction, defaults to None
+        :type txn: Optional[lmdb.Transaction], optional
+        :return: the sorted trip_ids
+        :rtype: Tuple[int, ...]
+
+        """
+
+        return cls._index_lookup(STOP_INDEX, stop_id, dates=dates, txn=txn)
+
+    @classmethod
+    def indexed_stops(
+            cls,
+            dates: Optional[str] = None,
+            txn: Optional[lmdb.Transaction] = None
+            ) -> Tuple[int, ...]:
+        """
+        The stop_ids in the stop index
+
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+        :param txn: a transaction from read_transaction, defaults to None
+        :type txn: Optional[lmdb.Transaction], optional
+        :return: the sorted stop_ids
+        :rtype: Tuple[int, ...]
+
+        """
+
+        if dates is None:
+            dates = find_date_range()
+
+        return tuple(k for k, _ in cls._iterate_db(dates, STOP_INDEX, txn=txn))
+
+    @classmethod
+    def load_service_trips(
+            cls,
+            dates: Optional[str] = None
+            ) -> Dict[int, Tuple[int, ...]]:
+        """
+        Load the service_id -> trip_ids index. Archives written before
+        the index have it built from the trips
+
+        :param dates: the date range string of the archive, defaults to None
+        :type dates: Optional[str], optional
+        :return: dictionary of service_id to sorted trip_ids
+        :rtype: Dict[int, Tuple[int, ...]]
+
+        """
+
+        if dates is None:
+            dates = find_date_range()
+
+        try:
+            return {
+                k: tuple(msgpack.unpackb(v)) for
+                k, v in cls._iterate_db(dates, SERVICE_INDEX)
+                }
+        except lmdb.NotFoundError:
+            out = {}
+            for k, v in cls.trip_service_map(dates).items():
+                out.setdefault(v, []).append(k)
+            return {k: tuple(sorted(v)) for k, v in out.items()}
+
+    @classmethod
+    def value_hashes(cls, dates: str, db_name: str) -> Dict[int, bytes]:
+        """
+        The content hash of every value in an archive database. They are
+        read from the '<db>_hash' database kept by the ArchiveWriter, or
+        hashed from the values for archives written before it
+
+        :param dates: the date range string of the archive
+        :type dates: str
+        :param db_name: the name of the lmdb database
+        :type db_name: str
+        :return: key -> hash of the value
+        :rtype: Dict[int, bytes]
+
+        """
+
+        try:
+            return {
+                k: bytes(v) for k, v in
+                cls._iterate_db(dates, f'{db_name}_hash')
+                }
+        except lmdb.NotFoundError:
+            return {
+                k: hashlib.blake2b(v, digest_size=16).digest() for
+                k, v in cls._iterate_db(dates, db_name)
+                }
 
-        return out
     @classmethod
-    def trip_agency_map(cls, dates=None):
+    def trip_agency_map(cls, dates=None, txn=None, trip_ids=None):
 
         routes = cls.load_routes()
-        triproutes = cls.load_trip_route(dates=dates)
+        triproutes = cls.load_trip_route(dates=dates, txn=txn, trip_ids=trip_ids)
 
         return {k: routes[v]['agency_id'] for k, v in triproutes.items()}
 
@@ -255,3 +2073,56 @@ class ArchiveStore:
 
         return {k: v['service_id'] for k, v in trips.items()}
 
+
+class ArchiveDiff(NamedTuple):
+    """The difference in the departures data of two archives"""
+
+    # trips that are added, removed or changed
+    trips: Set[int]
+    # services that start or stop running on a date YYYYMMDD
+    services: Dict[int, Set[int]]
+    # the dates YYYYMMDD of both archives
+    dates: Tuple[int, ...]
+
+
+def diff_archives(old_dates: str, new_dates: str) -> ArchiveDiff:
+    """
+    Compare two archives at the trip, service and service date level.
+    Trips are compared by the content hashes of their stop_times, trip
+    and route. Services are compared on the dates the archives share, so
+    changes to both the calendar and calendar_dates are found
+
+    :param old_dates: the date range string of the previous archive
+    :type old_dates: str
+    :param new_dates: the date range string of the new archive
+    :type new_dates: str
+    :return: the changed trips and services
+    :rtype: ArchiveDiff
+
+    """
+
+    trips = set()
+    for db_name in ('stop_times', 'trips', 'trip_route'):
+        old = ArchiveStore.value_hashes(old_dates, db_name)
+        new = ArchiveStore.value_hashes(new_dates, db_name)
+        trips.update(k for k in old.keys() | new.keys() if old.get(k) != new.get(k))
+
+    old_service_dates = ArchiveStore.load_service_dates(old_dates)
+    new_service_dates = ArchiveStore.load_service_dates(new_dates)
+    dates = sorted(
+        set(old_service_dates.dates.tolist()) & set(new_service_dates.dates.tolist())
+        )
+
+    services = {}
+    for date in dates:
+        changed = old_service_dates.services_on(date) ^ \
+            new_service_dates.services_on(date)
+        if changed:
+            services[date] = changed
+
+    log.info(
+        f"{len(trips)} trips changed and services changed on {len(services)} "
+        f"of {len(dates)} dates from {old_dates} to {new_dates}"
+        )
+
+    return ArchiveDiff(trips, services, tuple(dates))
@@ -11,8 +11,10 @@ import logging
 from pathlib import Path
 from typing import Dict, Union, Tuple
 
+import numpy as np
 
-import pandas as pd
+from feed import open_feed
+from schema import read_gtfs
 
 log = logging.getLogger(__name__)
 
@@ -25,28 +27,18 @@ T_TRANSFER = Dict[Tuple[int, int], Dict[str, Union[str, int]]]
 
 def read_transfers(filepath: Path) -> T_TRANSFER:
 
-    df = pd.read_csv(
-        filepath,
-        usecols=['transfer_type', 'min_transfer_time',
-                  'from_stop_id', 'to_stop_id',
-                  'from_route_id', 'to_route_id']
-        )
+    df = read_gtfs(filepath, 'transfers.txt')
+    # this deals with older format gtfs from Rejseplan
+    for col in ('from_stop_id', 'to_stop_id'):
+        df.loc[:, col] = df.loc[:, col].str.strip('G').astype(np.int64)
     df = df.set_index(['from_stop_id', 'to_stop_id'])
-    cols = df.columns
 
-    null_columns = []
-    for col in cols:
-        if df.loc[:, col].isnull().all():
-            null_columns.append(col)
-
-    new_cols = [x for x in df.columns if x not in null_columns]
-    df = df.loc[:, new_cols]
-
-    for col in df.columns:
-        if col in ('transfer_type', 'min_transfer_time'):
-            df.loc[:, col] = df.loc[:, col].fillna(0).astype(int)
-        else:
-            df.loc[:, col] = df.loc[:, col].fillna('')
+    # the route columns are dropped when no transfer has a route
+    null_columns = [
+        x for x in ('from_route_id', 'to_route_id') if
+        x in df.columns and (df.loc[:, x] == '').all()
+        ]
+    df = df.drop(null_columns, axis=1)
 
     return df.T.to_dict()
 
@@ -101,7 +93,6 @@ def check_transfers():
 
     base_data = Path(THIS_DIR, 'base_data2', 'transfers.txt')
     archive_data = Path(ARCHIVE_DIR, 'transfers.json')
-    new_data = Path(TEMP_DIR, 'transfers.txt')
 
     if not archive_data.is_file():
         try:
@@ -111,7 +102,8 @@ def check_transfers():
             pass
 
     archive_transfers = read_archive_transfers()
-    new_transfers = read_transfers(new_data)
+    with open_feed(TEMP_DIR) as feed, feed.open('transfers.txt') as f:
+        new_transfers = read_transfers(f)
 
     diff_check(archive_transfers, new_transfers)
 
@@ -6,13 +6,13 @@ Created on Thu Dec  3 15:34:55 2020
 """
 from pathlib import Path
 import logging
-from typing import Dict, Union
+from typing import Dict, Union, Optional, List
 
-import pandas as pd
 import msgpack
-import lmdb
 
-from tools import find_date_range
+from feed import open_feed
+from schema import read_gtfs
+from tools import find_date_range, update_catalog, ArchiveWriter, SERVICE_INDEX
 
 
 log = logging.getLogger(__name__)
@@ -24,8 +24,6 @@ THIS_DIR = Path(__file__).parent
 ARCHIVE_DIR = Path(THIS_DIR, 'archive')
 TEMP_DIR = Path(THIS_DIR, 'temp_data')
 
-DB_SIZE = 1 * 1024 * 1024 * 1024
-
 
 def read_trips(filepath: Path) -> T_TRIPS:
     """
@@ -37,7 +35,7 @@ def read_trips(filepath: Path) -> T_TRIPS:
 
     """
 
-    df = pd.read_csv(filepath, low_memory=False).fillna('')
+    df = read_gtfs(filepath, 'trips.txt')
 
     trip_routes = dict(zip(df.loc[:, 'trip_id'], df.loc[:, 'route_id']))
 
@@ -47,7 +45,8 @@ def read_trips(filepath: Path) -> T_TRIPS:
 def write_trips_to_archive(
         trips: T_TRIPS,
         trip_dict,
-        dates: str
+        dates: str,
+        writer: Optional[ArchiveWriter] = None
         ) -> None:
     """
 
@@ -57,44 +56,101 @@ def write_trips_to_archive(
     :type trip_dict: TYPE
     :param dates: DESCRIPTION
     :type dates: str
+    :param writer: stage the trips in this writer instead of
+        committing them, defaults to None
+    :type writer: Optional[ArchiveWriter], optional
     :return: DESCRIPTION
     :rtype: None
 
     """
 
-    archive_loc =str(Path(ARCHIVE_DIR, dates))
-
-    with lmdb.open(archive_loc, map_size=DB_SIZE, max_dbs=5) as env:
-        child_db = env.open_db(bytes('trip_route', 'utf-8'))
-        with env.begin(db=child_db, write=True) as txn:
-            for k, v in trips.items():
-                key = bytes(str(k), 'utf-8')
-                value = bytes(str(v), 'utf-8')
-                txn.put(key, value)
-    log.info(f"Trip/Routes data written to archive in : {dates}")
-
-    with lmdb.open(archive_loc, map_size=DB_SIZE, max_dbs=5) as env:
-        child_db = env.open_db(bytes('trips', 'utf-8'))
-        with env.begin(db=child_db, write=True) as txn:
-            for k, v in trip_dict.items():
-                key = bytes(str(k), 'utf-8')
-                value = msgpack.packb(v)
-                txn.put(key, value)
-    log.info(f"Trips data written to archive in : {dates}")
-
-def check_trips() -> None:
+    commit = writer is None
+    if commit:
+        writer = ArchiveWriter(dates)
+
+    writer.stage(
+        'trip_route',
+        ((k, bytes(str(v), 'utf-8')) for k, v in trips.items())
+        )
+    writer.stage(
+        'trips',
+        ((k, msgpack.packb(v)) for k, v in trip_dict.items())
+        )
+
+    if commit:
+        writer.commit()
+
+def make_service_index(trip_dict) -> Dict[int, List[int]]:
+    """
+
+    :param trip_dict: the trips from read_trips
+    :type trip_dict: TYPE
+    :return: dictionary of service_id to its sorted trip_ids
+    :rtype: Dict[int, List[int]]
+
+    """
+
+    service_index = {}
+    for k, v in trip_dict.items():
+        service_index.setdefault(v['service_id'], []).append(k)
+
+    return {k: sorted(v) for k, v in service_index.items()}
+
+def write_service_index_to_archive(
+        service_index: Dict[int, List[int]],
+        dates: str,
+        writer: Optional[ArchiveWriter] = None
+        ) -> None:
     """
 
+    :param service_index: the index from make_service_index
+    :type service_index: Dict[int, List[int]]
+    :param dates: DESCRIPTION
+    :type dates: str
+    :param writer: stage the index in this writer instead of
+        committing it, defaults to None
+    :type writer: Optional[ArchiveWriter], optional
     :return: DESCRIPTION
     :rtype: None
 
     """
 
-    new_data = Path(TEMP_DIR, 'trips.txt')
+    commit = writer is None
+    if commit:
+        writer = ArchiveWriter(dates)
 
+    writer.stage(
+        SERVICE_INDEX,
+        ((k, msgpack.packb(v)) for k, v in service_index.items())
+        )
+
+    if commit:
+        writer.commit()
+
+def check_trips(writer: Optional[ArchiveWriter] = None) -> None:
+    """
+
+    :param writer: stage the trips in this writer instead of
+        committing them, defaults to None
+    :type writer: Optional[ArchiveWriter], optional
+    :return: DESCRIPTION
+    :rtype: None
+
+    """
 
     new_dates = find_date_range(TEMP_DIR)
-    new_trip_route, trips = read_trips(new_data)
-    write_trips_to_archive(new_trip_route, trips, new_dates)
+    with open_feed(TEMP_DIR) as feed, feed.open('trips.txt') as f:
+        new_trip_route, trips = read_trips(f)
+
+    commit = writer is None
+    if commit:
+        writer = ArchiveWriter(new_dates, replace=True)
+
+    write_trips_to_archive(new_trip_route, trips, new_dates, writer=writer)
+    write_service_index_to_archive(make_service_index(trips), new_dates, writer=writer)
+
+    if commit:
+        writer.commit()
+    update_catalog(new_dates, rows={'trips': len(trips)})
 
     return
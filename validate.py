@@ -5,10 +5,11 @@ Created on Tue Dec  1 13:11:18 2020
 @author: alkj
 """
 
-import os
 from pathlib import Path
 import logging
 
+from feed import open_feed
+
 log = logging.getLogger(__name__)
 
 THIS_DIR = Path(__file__).parent
@@ -36,7 +37,8 @@ ADDITIONAL_FILES = {
 
 def validate_files() -> None:
 
-    files_in_path = os.listdir(TEMP_DIR)
+    with open_feed(TEMP_DIR) as feed:
+        files_in_path = feed.members()
     if not all(x in files_in_path for x in REQUIRED_DEPARTURE_FILES):
         missing = set(files_in_path).symmetric_difference(
             REQUIRED_DEPARTURE_FILES) - ADDITIONAL_FILES